@@ -0,0 +1,321 @@
+# Columnar loader for Akeneo exports (shared by all pages that read SKU files)
+#
+# "All Attributes" exports carry hundreds of columns while the pages only
+# need one or two (sku, pzns_in_set). Instead of materialising the whole
+# sheet, only the requested columns are parsed:
+#
+#   CSV   the header line is read once to sniff the delimiter and locate the
+#         columns, then pandas parses just those positions (usecols)
+#   XLSX  the first sheet's XML is streamed with lxml iterparse; the header
+#         row gives the column letters, then each row is searched (by cell
+#         reference) only for those columns, and only the shared strings
+#         they point to are read. openpyxl, even read-only, builds every
+#         cell of a row, which is what made 300-column exports slow. Date
+#         cells come back as their serial number (SKU columns are text).
+#
+# Column names are matched case-insensitively and ignoring surrounding
+# whitespace; the result uses the requested spelling and dtype str, like
+# pd.read_*(dtype=str) did before.
+#
+# iter_column is the lazy variant for lists too large to hold as a frame:
+# it yields one column's values while reading the file in blocks.
+
+import io
+import csv
+import codecs
+import zipfile
+from typing import Iterator, List, Optional, Sequence
+
+import pandas as pd
+from lxml import etree
+from openpyxl import load_workbook
+
+CSV_DELIMITERS = ";,\t"
+DEFAULT_DELIMITER = ";"
+SNIFF_BYTES = 64 * 1024
+READ_BLOCK_BYTES = 1024 * 1024
+EXCEL_SUFFIXES = (".xlsx", ".xlsm")
+XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+
+def _as_bytes(source) -> bytes:
+    """bytes, BytesIO or a Streamlit UploadedFile -> bytes (no copy for bytes)."""
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source.read()
+
+
+def sniff_delimiter(sample: str, default: str = DEFAULT_DELIMITER) -> str:
+    """Delimiter of a CSV sample among ; , and tab (falls back to the most frequent in the header)."""
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        header = sample.split("\n", 1)[0]
+        counts = {d: header.count(d) for d in CSV_DELIMITERS}
+        best = max(counts, key=counts.get)
+        return best if counts[best] else default
+
+
+def _match_columns(header: Sequence, columns: Sequence[str]) -> dict:
+    """{position in header: requested name} for the requested columns present in header."""
+    wanted = {c.strip().lower(): c for c in columns}
+    positions = {}
+    for i, name in enumerate(header):
+        key = str(name).strip().lstrip("\ufeff").lower() if name is not None else ""
+        if key in wanted:
+            positions[i] = wanted.pop(key)
+    return positions
+
+
+def _read_csv_columns(data: bytes, columns: Sequence[str], default_delimiter: str) -> pd.DataFrame:
+    sample = data[:SNIFF_BYTES].decode("utf-8-sig", errors="ignore")
+    if not sample.strip():
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    delimiter = sniff_delimiter(sample, default_delimiter)
+    header = next(csv.reader(io.StringIO(sample), delimiter=delimiter), [])
+    positions = _match_columns(header, columns)
+    if not positions:
+        return pd.DataFrame(columns=[])
+    df = pd.read_csv(io.BytesIO(data), sep=delimiter, dtype=str, usecols=sorted(positions))
+    df.columns = [positions[i] for i in sorted(positions)]
+    return df
+
+
+def _cell_to_str(value) -> Optional[str]:
+    # Same conversion as pd.read_excel(dtype=str): integral floats lose ".0".
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _column_index(ref: str) -> int:
+    """0-based column of a cell reference ("AB12" -> 27)."""
+    index = 0
+    for ch in ref:
+        if not ch.isalpha():
+            break
+        index = index * 26 + ord(ch.upper()) - 64
+    return index - 1
+
+
+def _first_sheet_path(archive: zipfile.ZipFile) -> str:
+    """Part name of the first sheet in tab order (openpyxl's worksheets[0])."""
+    workbook = etree.fromstring(archive.read("xl/workbook.xml"))
+    sheet = workbook.find(f"{XLSX_NS}sheets/{XLSX_NS}sheet")
+    if sheet is None:
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    rels = etree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    target = next(rel.get("Target") for rel in rels if rel.get("Id") == sheet.get(f"{XLSX_REL_NS}id"))
+    return target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+
+
+def _text_of(element) -> str:
+    # <si>/<is>: plain <t>, or rich-text runs <r><t>; phonetic runs (<rPh>) are not part of the value
+    plain = element.find(f"{XLSX_NS}t")
+    if plain is not None:
+        return plain.text or ""
+    return "".join(t.text or "" for t in element.iterfind(f"{XLSX_NS}r/{XLSX_NS}t"))
+
+
+def _cell_value(cell):
+    """Cell content as str, an int shared-string index (resolved later), or None."""
+    kind = cell.get("t")
+    if kind == "inlineStr":
+        inline = cell.find(f"{XLSX_NS}is")
+        return _text_of(inline) if inline is not None else None
+    v = cell.find(f"{XLSX_NS}v")
+    if v is None or v.text is None:
+        return None
+    if kind == "s":
+        return int(v.text)
+    if kind == "b":
+        return "True" if v.text == "1" else "False"
+    if kind in ("str", "e", "d"):
+        return v.text
+    # openpyxl's rule: a number with "." or an exponent is a float, otherwise an int
+    text = v.text
+    return _cell_to_str(float(text) if "." in text or "E" in text.upper() else int(text))
+
+
+def _find_cell(row, index: int):
+    """
+    The <c> of column `index` in a row. Cells are stored in column order and
+    blanks are omitted, so it sits at position <= index: binary search on the
+    references instead of walking the hundreds of cells of the row.
+    """
+    lo, hi = 0, min(len(row), index + 1)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        ref = row[mid].get("r")
+        if ref is None:
+            # references are optional: then the cells are positional
+            return row[index] if index < len(row) else None
+        column = _column_index(ref)
+        if column == index:
+            return row[mid]
+        if column < index:
+            lo = mid + 1
+        else:
+            hi = mid
+    return None
+
+
+def _header_names(archive: zipfile.ZipFile, row) -> List[Optional[str]]:
+    by_column = {}
+    for position, cell in enumerate(row):
+        ref = cell.get("r")
+        by_column[_column_index(ref) if ref else position] = _cell_value(cell)
+    shared = _shared_strings(archive, {v for v in by_column.values() if isinstance(v, int)})
+    header: List[Optional[str]] = [None] * (max(by_column) + 1 if by_column else 0)
+    for column, value in by_column.items():
+        header[column] = shared.get(value) if isinstance(value, int) else value
+    return header
+
+
+def _read_xlsx_columns(data: bytes, columns: Sequence[str]) -> pd.DataFrame:
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        positions = None
+        values = {}
+        with archive.open(_first_sheet_path(archive)) as sheet:
+            for _, row in etree.iterparse(sheet, events=("end",), tag=f"{XLSX_NS}row", huge_tree=True):
+                if positions is None:
+                    positions = _match_columns(_header_names(archive, row), columns)
+                    if not positions:
+                        return pd.DataFrame(columns=[])
+                    order = sorted(positions)
+                    values = {i: [] for i in order}
+                else:
+                    cells = [_find_cell(row, i) for i in order]
+                    cells = [_cell_value(c) if c is not None else None for c in cells]
+                    if any(c is not None for c in cells):
+                        for i, cell in zip(order, cells):
+                            values[i].append(cell)
+                # keep memory flat: drop the parsed row and the ones before it
+                row.clear()
+                while row.getprevious() is not None:
+                    del row.getparent()[0]
+        if positions is None:
+            raise pd.errors.EmptyDataError("No columns to parse from file")
+        shared = _shared_strings(archive, {v for column in values.values() for v in column if isinstance(v, int)})
+    return pd.DataFrame({
+        positions[i]: pd.Series([shared.get(v) if isinstance(v, int) else v for v in values[i]], dtype=object)
+        for i in order
+    })
+
+
+def _shared_strings(archive: zipfile.ZipFile, wanted: set) -> dict:
+    """{index: text} of the shared strings in `wanted` only (the table of a wide export is large)."""
+    found = {}
+    if not wanted or "xl/sharedStrings.xml" not in archive.namelist():
+        return found
+    last = max(wanted)
+    with archive.open("xl/sharedStrings.xml") as table:
+        for index, (_, si) in enumerate(etree.iterparse(table, events=("end",), tag=f"{XLSX_NS}si", huge_tree=True)):
+            if index in wanted:
+                found[index] = _text_of(si)
+            si.clear()
+            while si.getprevious() is not None:
+                del si.getparent()[0]
+            if index >= last:
+                break
+    return found
+
+
+def read_akeneo_columns(source, file_name: str, columns: Sequence[str],
+                        default_delimiter: str = DEFAULT_DELIMITER) -> pd.DataFrame:
+    """
+    Read only `columns` from a CSV or Excel export. Columns missing from the
+    file are missing from the result (callers report them); raises
+    pd.errors.EmptyDataError for an empty file.
+    """
+    data = _as_bytes(source)
+    name = file_name.lower()
+    if name.endswith(EXCEL_SUFFIXES):
+        df = _read_xlsx_columns(data, columns)
+    elif name.endswith(".xls"):
+        wanted = {c.strip().lower() for c in columns}
+        df = pd.read_excel(io.BytesIO(data), dtype=str, usecols=lambda c: str(c).strip().lower() in wanted)
+        by_key = {c.strip().lower(): c for c in columns}
+        df.columns = [by_key[str(c).strip().lower()] for c in df.columns]
+    else:
+        df = _read_csv_columns(data, columns, default_delimiter)
+    return df[[c for c in columns if c in df.columns]]
+
+
+def read_sku_column(source, file_name: str, column: str = "sku") -> Optional[List[str]]:
+    """Stripped, non-empty values of the sku column in file order, or None if the column is missing."""
+    df = read_akeneo_columns(source, file_name, [column])
+    if column not in df.columns:
+        return None
+    values = df[column].dropna().astype(str).str.strip()
+    return values[values != ""].tolist()
+
+
+def _iter_text_lines(first: bytes, stream) -> Iterator[str]:
+    """Decode a byte stream into lines for csv.reader, holding one block at a time."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    block = first
+    while block:
+        pending += decoder.decode(block)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+        block = stream.read(READ_BLOCK_BYTES)
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def iter_column(source, file_name: str, column: str = "sku",
+                default_delimiter: str = DEFAULT_DELIMITER) -> Iterator[str]:
+    """
+    Stripped, non-empty values of one column, read lazily. `source` is a
+    path or a readable binary stream (need not be seekable; it is closed at
+    the end). Raises
+    ValueError on the first next() when the column is missing.
+    """
+    stream = open(source, "rb") if isinstance(source, str) else source
+    try:
+        if file_name.lower().endswith(EXCEL_SUFFIXES):
+            # xlsx is a ZIP: openpyxl needs random access, the sheet itself is still streamed.
+            workbook_source = source if isinstance(source, str) else io.BytesIO(stream.read())
+            workbook = load_workbook(workbook_source, read_only=True, data_only=True)
+            try:
+                sheet = workbook.worksheets[0]
+                header = next(sheet.iter_rows(max_row=1, values_only=True), None) or ()
+                positions = _match_columns(header, [column])
+                if not positions:
+                    raise ValueError(f"Column '{column}' not found in file.")
+                col = next(iter(positions)) + 1
+                for (value,) in sheet.iter_rows(min_row=2, min_col=col, max_col=col, values_only=True):
+                    value = _cell_to_str(value)
+                    if value is not None and value.strip():
+                        yield value.strip()
+            finally:
+                workbook.close()
+            return
+
+        first = stream.read(SNIFF_BYTES)
+        delimiter = sniff_delimiter(first.decode("utf-8-sig", errors="ignore"), default_delimiter)
+        reader = csv.reader(_iter_text_lines(first, stream), delimiter=delimiter)
+        positions = _match_columns(next(reader, []), [column])
+        if not positions:
+            raise ValueError(f"Column '{column}' not found in file.")
+        index = next(iter(positions))
+        for row in reader:
+            if index < len(row) and row[index].strip():
+                yield row[index].strip()
+    finally:
+        stream.close()
+
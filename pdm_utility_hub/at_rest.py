@@ -0,0 +1,229 @@
+# At-rest protection for job folders and output artifacts
+#
+# Off by default. With PDM_AT_REST=on, uploads, checkpoint blobs, ZIPs and
+# reports are written encrypted, and small records (job params, log
+# messages, checkpoint manifest lines) are sealed as Fernet tokens.
+#
+# Files use a streaming chunked AES-256-GCM format, so nothing has to be held
+# in memory in full:
+#
+#   MAGIC | 7-byte random nonce prefix | { 4-byte length | ciphertext+tag }*
+#
+# Chunk i is sealed with nonce = prefix | i (4 bytes) | last-flag (1 byte),
+# which detects reordered, dropped or truncated chunks (STREAM construction).
+#
+# Key: PDM_AT_REST_KEY (urlsafe base64 of 32 random bytes). Without it a
+# random key is generated per process: data stays protected but becomes
+# unreadable after a restart (jobs and checkpoints then start over).
+
+import os
+import base64
+import struct
+import hashlib
+import threading
+from typing import Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"PDMAR1\n"
+NONCE_PREFIX_SIZE = 7
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+_LENGTH = struct.Struct(">I")
+
+
+class AtRestError(Exception):
+    """Raised when an encrypted file or record cannot be decrypted (wrong key, corruption, truncation)."""
+
+
+def _derive(master_key: bytes, label: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"pdm-at-rest/" + label).derive(master_key)
+
+
+def is_encrypted(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class AtRestCipher:
+    """Key holder with writers/readers for chunked files and helpers for small records."""
+
+    def __init__(self, master_key: bytes):
+        if len(master_key) != 32:
+            raise ValueError("at-rest key must be 32 bytes")
+        self._aead = AESGCM(_derive(master_key, b"files"))
+        self._fernet = Fernet(base64.urlsafe_b64encode(_derive(master_key, b"records")))
+        # Public fingerprint to notice a key change (e.g. checkpoint folders).
+        self.key_id = hashlib.sha256(_derive(master_key, b"key-id")).hexdigest()[:16]
+
+    # ---------- files ----------
+    def open_writer(self, path: str) -> "EncryptedWriter":
+        return EncryptedWriter(open(path, "wb"), self._aead)
+
+    def open_reader(self, path: str) -> "DecryptedReader":
+        return DecryptedReader(open(path, "rb"), self._aead)
+
+    def write_bytes(self, path: str, data: bytes):
+        with self.open_writer(path) as f:
+            f.write(data)
+
+    def read_bytes(self, path: str) -> bytes:
+        with self.open_reader(path) as f:
+            return f.read()
+
+    def encrypt_file(self, path: str):
+        """Encrypt a plaintext file in place (streamed through a temporary file)."""
+        if is_encrypted(path):
+            return
+        tmp_path = f"{path}.{threading.get_ident()}.enc-tmp"
+        with open(path, "rb") as src, self.open_writer(tmp_path) as dst:
+            while True:
+                block = src.read(CHUNK_SIZE)
+                if not block:
+                    break
+                dst.write(block)
+        os.replace(tmp_path, path)
+
+    # ---------- small records ----------
+    def seal(self, text: str) -> str:
+        return self._fernet.encrypt(text.encode("utf-8")).decode("ascii")
+
+    def unseal(self, token: str) -> str:
+        try:
+            return self._fernet.decrypt(token.encode("ascii")).decode("utf-8")
+        except (InvalidToken, ValueError) as e:
+            raise AtRestError("record cannot be decrypted") from e
+
+
+class EncryptedWriter:
+    """Write-only binary stream; plaintext is buffered and sealed CHUNK_SIZE bytes at a time."""
+
+    def __init__(self, raw, aead: AESGCM):
+        self._raw = raw
+        self._aead = aead
+        self._prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self._buffer = bytearray()
+        self._counter = 0
+        self.closed = False
+        raw.write(MAGIC + self._prefix)
+
+    def _seal(self, chunk: bytes, last: bool):
+        nonce = self._prefix + struct.pack(">IB", self._counter, 1 if last else 0)
+        sealed = self._aead.encrypt(nonce, chunk, None)
+        self._raw.write(_LENGTH.pack(len(sealed)) + sealed)
+        self._counter += 1
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed EncryptedWriter")
+        self._buffer += data
+        # Keep at least one byte back so the final chunk is always sealed by close().
+        while len(self._buffer) > CHUNK_SIZE:
+            self._seal(bytes(self._buffer[:CHUNK_SIZE]), last=False)
+            del self._buffer[:CHUNK_SIZE]
+        return len(data)
+
+    def flush(self):
+        self._raw.flush()
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self._seal(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        self._raw.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DecryptedReader:
+    """Read-only binary stream over a file written by EncryptedWriter."""
+
+    def __init__(self, raw, aead: AESGCM):
+        self._raw = raw
+        self._aead = aead
+        header = raw.read(len(MAGIC) + NONCE_PREFIX_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raw.close()
+            raise AtRestError("not an at-rest encrypted file")
+        self._prefix = header[len(MAGIC):]
+        self._counter = 0
+        self._buffer = b""
+        self._finished = False
+        self.closed = False
+
+    def _next_chunk(self) -> bytes:
+        head = self._raw.read(_LENGTH.size)
+        if len(head) != _LENGTH.size:
+            raise AtRestError("encrypted file is truncated")
+        sealed = self._raw.read(_LENGTH.unpack(head)[0])
+        last = self._raw.peek(1)[:1] == b"" if hasattr(self._raw, "peek") else False
+        nonce = self._prefix + struct.pack(">IB", self._counter, 1 if last else 0)
+        try:
+            chunk = self._aead.decrypt(nonce, sealed, None)
+        except Exception as e:
+            raise AtRestError("encrypted file cannot be decrypted") from e
+        self._counter += 1
+        self._finished = last
+        return chunk
+
+    def read(self, size: int = -1) -> bytes:
+        parts = [self._buffer]
+        have = len(self._buffer)
+        while (size < 0 or have < size) and not self._finished:
+            chunk = self._next_chunk()
+            parts.append(chunk)
+            have += len(chunk)
+        data = b"".join(parts)
+        if size < 0:
+            self._buffer = b""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_cipher: Optional[AtRestCipher] = None
+_default_cipher_lock = threading.Lock()
+
+
+def get_default_cipher() -> Optional[AtRestCipher]:
+    """
+    Process-wide cipher, or None when at-rest protection is off:
+    PDM_AT_REST ("on" enables it) and PDM_AT_REST_KEY (see module header).
+    """
+    global _default_cipher
+    if os.environ.get("PDM_AT_REST", "off").lower() not in ("on", "1", "true", "yes"):
+        return None
+    with _default_cipher_lock:
+        if _default_cipher is None:
+            key = os.environ.get("PDM_AT_REST_KEY")
+            _default_cipher = AtRestCipher(base64.urlsafe_b64decode(key) if key else os.urandom(32))
+        return _default_cipher
@@ -0,0 +1,290 @@
+# Checkpoint manifest for resumable Bundle&Set jobs
+#
+# A job is identified by the uploaded file and the options that change the
+# output (layout, language fallback, compositing mode), so re-uploading the
+# same file after a rerun, a websocket drop or a container restart finds the
+# same checkpoint folder:
+#
+#   <root>/<job key>/manifest.jsonl   one JSON line per completed bundle
+#   <root>/<job key>/blobs/ab/<sha>   every output file, content-addressed
+#
+# A manifest line is only appended once all files of the bundle are on disk,
+# so a crash mid-bundle simply re-processes that bundle. On resume the ZIP
+# and the reports are rebuilt from the manifest and only the remaining
+# bundles are processed.
+#
+# With an at-rest cipher (at_rest.py) blobs are stored encrypted and every
+# manifest line is a sealed token. key.id records which key (or "plain")
+# wrote the folder; a folder written under another key is started over.
+#
+# A checkpoint is held by one job at a time: <root>/<job key>.lock is locked
+# (flock) while the job runs, so a second job on the same file and options
+# runs without checkpoint instead of sharing or wiping the folder, and
+# discard_checkpoint / the stale purge leave a held folder alone.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+from at_rest import AtRestCipher, AtRestError
+
+try:
+    import fcntl
+except ImportError:  # Windows: the in-process registry below is the only lock
+    fcntl = None
+
+DEFAULT_JOBS_DIR = os.path.join(tempfile.gettempdir(), "pdm_bundle_jobs")
+DEFAULT_MAX_AGE_SECONDS = 3 * 24 * 3600
+PLAIN_KEY_ID = "plain"
+
+_held_keys = set()
+_held_keys_lock = threading.Lock()
+
+
+class CheckpointBusy(OSError):
+    """Another job currently holds the checkpoint of this key."""
+
+
+class _KeyLock:
+    """Exclusive, non-blocking lock on one job key: in-process registry plus flock for other processes."""
+
+    def __init__(self, root: str, key: str):
+        self.path = os.path.join(root, f"{key}.lock")
+        self.key = (root, key)
+        self._file = None
+
+    def acquire(self):
+        with _held_keys_lock:
+            if self.key in _held_keys:
+                raise CheckpointBusy(f"checkpoint {self.key[1][:8]} is in use by another job")
+            _held_keys.add(self.key)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a")
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            self.release()
+            raise CheckpointBusy(f"checkpoint {self.key[1][:8]} is in use by another job") from e
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with _held_keys_lock:
+            _held_keys.discard(self.key)
+
+
+def job_key(file_bytes: bytes, **options) -> str:
+    """Stable key of a job: sha256 of the upload plus the output-affecting options."""
+    digest = hashlib.sha256(file_bytes)
+    for name in sorted(options):
+        digest.update(f"\0{name}={options[name]}".encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+class BundleCheckpoint:
+    """
+    Append-only manifest of completed bundles plus their output blobs. The
+    key lock is taken on creation (CheckpointBusy if another job holds it)
+    and held until close().
+    """
+
+    def __init__(self, key: str, root: Optional[str] = None, cipher: Optional[AtRestCipher] = None):
+        self.key = key
+        self.cipher = cipher
+        self.root = root or os.environ.get("PDM_BUNDLE_JOBS_DIR", DEFAULT_JOBS_DIR)
+        self._key_lock = _KeyLock(self.root, key)
+        self._key_lock.acquire()
+        self.folder = os.path.join(self.root, key)
+        self.blob_dir = os.path.join(self.folder, "blobs")
+        self.manifest_path = os.path.join(self.folder, "manifest.jsonl")
+        self.key_id_path = os.path.join(self.folder, "key.id")
+        self._lock = threading.Lock()
+        self._records: Dict[str, Dict] = {}
+        self.resumed = 0
+        try:
+            self._check_key()
+            self._load()
+        except BaseException:
+            self._key_lock.release()
+            raise
+
+    def close(self):
+        self._key_lock.release()
+
+    def _check_key(self):
+        key_id = self.cipher.key_id if self.cipher is not None else PLAIN_KEY_ID
+        try:
+            with open(self.key_id_path, "r", encoding="ascii") as f:
+                stored = f.read().strip()
+        except OSError:
+            stored = None
+        if stored != key_id:
+            # Unknown or different key: nothing in the folder is usable.
+            shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        if stored != key_id:
+            with open(self.key_id_path, "w", encoding="ascii") as f:
+                f.write(key_id)
+
+    def _decode_line(self, line: bytes) -> Dict:
+        text = line.decode("utf-8")
+        if self.cipher is not None:
+            text = self.cipher.unseal(text.strip())
+        return json.loads(text)
+
+    def _encode_record(self, record: Dict) -> str:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        return self.cipher.seal(line) if self.cipher is not None else line
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        valid_size = 0
+        with open(self.manifest_path, "rb") as f:
+            for line in f:
+                try:
+                    record = self._decode_line(line)
+                except (UnicodeDecodeError, json.JSONDecodeError, AtRestError):
+                    # Torn last line from an interrupted append: cut it off below.
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                valid_size += len(line)
+                if all(os.path.exists(self._blob_path(d)) for d in record["files"].values()):
+                    self._records[record["sku"]] = record
+        if valid_size < os.path.getsize(self.manifest_path):
+            with open(self.manifest_path, "r+b") as f:
+                f.truncate(valid_size)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    # ---------- recording ----------
+    def store_blob(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            if self.cipher is not None:
+                self.cipher.write_bytes(tmp_path, data)
+            else:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def recorder(self, sink) -> "BundleRecorder":
+        return BundleRecorder(self, sink)
+
+    def commit(self, sku: str, outcome: Dict, files: Dict[str, str]):
+        """Append the completed bundle to the manifest (flushed to disk)."""
+        record = {
+            "sku": sku,
+            "row": outcome["row"],
+            "errors": [list(e) for e in outcome["errors"]],
+            "warnings": list(outcome["warnings"]),
+            "files": files,
+            "completed_at": time.time(),
+        }
+        line = self._encode_record(record)
+        with self._lock:
+            with open(self.manifest_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._records[sku] = record
+
+    # ---------- resuming ----------
+    def is_done(self, sku: str) -> bool:
+        return sku in self._records
+
+    @property
+    def completed(self) -> int:
+        return len(self._records)
+
+    def replay(self, sku: str, sink) -> Dict:
+        """Write the recorded files of a completed bundle into `sink` and return its outcome."""
+        record = self._records[sku]
+        for arcname, digest in record["files"].items():
+            path = self._blob_path(digest)
+            if self.cipher is not None:
+                sink.write(arcname, self.cipher.read_bytes(path))
+            else:
+                with open(path, "rb") as f:
+                    sink.write(arcname, f.read())
+        self.resumed += 1
+        return {
+            "sku": sku,
+            "row": record["row"],
+            "errors": [tuple(e) for e in record["errors"]],
+            "warnings": record["warnings"],
+        }
+
+    def discard(self):
+        with self._lock:
+            self._records.clear()
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self._check_key()
+
+    def summary(self) -> str:
+        return f"Checkpoint {self.key[:8]}: {self.completed} bundles recorded, {self.resumed} restored from a previous run."
+
+
+class BundleRecorder:
+    """ZipSink stand-in for one bundle: every file goes to the sink and to the checkpoint blobs."""
+
+    def __init__(self, checkpoint: BundleCheckpoint, sink):
+        self.checkpoint = checkpoint
+        self.sink = sink
+        self.files: Dict[str, str] = {}
+
+    def write(self, arcname: str, data: bytes):
+        self.files[arcname] = self.checkpoint.store_blob(data)
+        self.sink.write(arcname, data)
+
+
+def discard_checkpoint(key: str, root: Optional[str] = None) -> bool:
+    """Remove the checkpoint of `key` unless a running job holds it; True when nothing is left."""
+    root = root or os.environ.get("PDM_BUNDLE_JOBS_DIR", DEFAULT_JOBS_DIR)
+    folder = os.path.join(root, key)
+    if not os.path.isdir(folder):
+        return True
+    lock = _KeyLock(root, key)
+    try:
+        lock.acquire()
+    except CheckpointBusy:
+        return False
+    try:
+        shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        lock.release()
+    return True
+
+
+def purge_stale_checkpoints(root: Optional[str] = None, max_age_seconds: int = DEFAULT_MAX_AGE_SECONDS) -> List[str]:
+    """Remove job folders whose manifest has not been touched for max_age_seconds."""
+    root = root or os.environ.get("PDM_BUNDLE_JOBS_DIR", DEFAULT_JOBS_DIR)
+    removed = []
+    if not os.path.isdir(root):
+        return removed
+    cutoff = time.time() - max_age_seconds
+    for name in os.listdir(root):
+        folder = os.path.join(root, name)
+        if not os.path.isdir(folder):
+            continue
+        manifest = os.path.join(folder, "manifest.jsonl")
+        try:
+            mtime = os.path.getmtime(manifest if os.path.exists(manifest) else folder)
+        except OSError:
+            continue
+        if mtime < cutoff and discard_checkpoint(name, root):
+            removed.append(name)
+    return removed
@@ -0,0 +1,114 @@
+# Command-line entry point for the Bundle&Set engine (nightly runs, benchmarks)
+#
+#   python bundle_cli.py bundles.xlsx --out ./bundle_output --layout automatic --language "NL FR"
+#
+# Writes Bundle&Set.zip, bundle_list.xlsx and missing_images.xlsx into --out.
+# Progress and messages go to stderr as JSON lines, e.g.
+#   {"event": "progress", "fraction": 0.42, "text": "Batch 1/3 – 123 (42/100)", "ts": 1700000000.0}
+#   {"event": "info", "message": "File loaded: 250 bundles found.", "ts": ...}
+# and a final {"event": "done", "outputs": {...}, "elapsed": ...} line. The
+# exit code is 0 on success, 1 when the run failed or produced nothing, 2 on
+# bad arguments.
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from bundle_engine import (
+    DEFAULT_BUNDLE_CONCURRENCY, LANGUAGE_OPTIONS, LAYOUT_OPTIONS, RetryPolicy, fallback_ext_for_language, run_pipeline
+)
+from bundle_imaging import COMPOSITE_TILED, COMPOSITE_MERGE, default_image_workers
+
+
+class JsonLinesReporter:
+    """Engine reporter writing one JSON object per line to a stream (stderr by default)."""
+
+    def __init__(self, stream=None, progress_interval: float = 0.5):
+        self.stream = stream or sys.stderr
+        self.progress_interval = progress_interval
+        self._last_progress = 0.0
+
+    def emit(self, event: str, **fields):
+        fields.update(event=event, ts=round(time.time(), 3))
+        self.stream.write(json.dumps(fields, ensure_ascii=False, default=str) + "\n")
+        self.stream.flush()
+
+    def progress(self, fraction: float, text=None):
+        now = time.monotonic()
+        if fraction >= 1.0 or now - self._last_progress >= self.progress_interval:
+            self._last_progress = now
+            self.emit("progress", fraction=round(float(fraction), 4), text=text)
+
+    def info(self, message: str):
+        self.emit("info", message=message)
+
+    def success(self, message: str):
+        self.emit("success", message=message)
+
+    def warning(self, message: str):
+        self.emit("warning", message=message)
+
+    def error(self, message: str):
+        self.emit("error", message=message)
+
+    def check_cancelled(self):
+        pass
+
+
+def _choice(options):
+    by_key = {o.lower(): o for o in options}
+
+    def parse(value: str) -> str:
+        try:
+            return by_key[value.lower()]
+        except KeyError:
+            raise argparse.ArgumentTypeError(f"choose from {', '.join(options)}")
+    return parse
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Create Bundle&Set images from an Akeneo sku/pzns_in_set export.")
+    parser.add_argument("input", help="CSV (';', ',' or tab separated) or XLSX file with 'sku' and 'pzns_in_set' columns")
+    parser.add_argument("--out", default="bundle_output", help="output directory (default: %(default)s)")
+    parser.add_argument("--layout", type=_choice(LAYOUT_OPTIONS), default="Automatic", help="Automatic, Horizontal or Vertical")
+    parser.add_argument("--language", type=_choice(LANGUAGE_OPTIONS), default="None",
+                        help="language specific photos: None, FR, DE or 'NL FR'")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_BUNDLE_CONCURRENCY, help="bundles processed in parallel")
+    parser.add_argument("--image-workers", type=int, default=default_image_workers(),
+                        help="image processing processes (0 = threads only)")
+    parser.add_argument("--composite", choices=[COMPOSITE_TILED, COMPOSITE_MERGE], default=COMPOSITE_TILED,
+                        help="double/triple compositing mode")
+    parser.add_argument("--attempts", type=int, default=4, help="download attempts per image")
+    parser.add_argument("--timeout", type=float, default=20.0, help="per-request timeout in seconds")
+    parser.add_argument("--resume", action="store_true", help="restore bundles completed by a previous run of the same file")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    reporter = JsonLinesReporter()
+    if not os.path.isfile(args.input):
+        reporter.error(f"Input file not found: {args.input}")
+        return 2
+
+    start = time.time()
+    try:
+        outputs = run_pipeline(
+            args.input, args.out, reporter,
+            layout=args.layout, fallback_ext=fallback_ext_for_language(args.language),
+            max_concurrent_bundles=args.concurrency, image_workers=args.image_workers, composite_mode=args.composite,
+            retry_policy=RetryPolicy(request_timeout=args.timeout, max_attempts=args.attempts),
+            resume=args.resume
+        )
+    except Exception as e:
+        reporter.emit("failed", message=f"{type(e).__name__}: {e}", elapsed=round(time.time() - start, 3))
+        return 1
+    reporter.emit("done", outputs=outputs, elapsed=round(time.time() - start, 3))
+    # Nothing written means the input was rejected (the reason was reported above).
+    return 0 if outputs else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,928 @@
+# Bundle&Set engine: the image pipeline behind the Bundle Creator page
+#
+# Everything here is independent of Streamlit so the same code runs in the
+# page's background job, from the command line (bundle_cli.py) and from
+# benchmarks. User-facing output goes through a `reporter` object with
+#
+#   info(msg) / success(msg) / warning(msg) / error(msg)
+#   progress(fraction, text=None)
+#   check_cancelled()            (raise to abort; checked before each bundle)
+#
+# which job_runner.JobContext and bundle_cli.JsonLinesReporter implement.
+#
+# Entry points: process_file_async (bytes in, ZIP + report bytes out),
+# run_pipeline / run_pipeline_bytes (file or bytes in, files in an output
+# directory out) and run_bundle_job (job runner handler). An optional
+# at_rest.AtRestCipher makes every file written by the pipeline encrypted.
+
+import os
+import aiohttp
+import asyncio
+import pandas as pd
+import time
+import zipfile
+import random
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from typing import Optional, Dict, List, Set
+from akeneo_loader import read_akeneo_columns
+from at_rest import AtRestCipher
+from bundle_checkpoint import BundleCheckpoint, job_key, purge_stale_checkpoints
+from http_pool import ConnectionStats, create_client_session
+from bundle_imaging import ImageWorkerPool, COMPOSITE_TILED
+from image_cache import (
+    DiskImageCache, NegativeLookupIndex, get_default_cache, get_default_missing_index, fetch_with_cache_async
+)
+
+# ---------------------- Helper Functions ----------------------
+# The CDN base can be pointed at a local stand-in server (e.g. for benchmarking).
+CDN_BASE_URL = os.environ.get("BUNDLE_CDN_BASE_URL", "https://cdn.shop-apotheke.com/images").rstrip("/")
+# Number of bundles processed concurrently inside a batch.
+DEFAULT_BUNDLE_CONCURRENCY = 8
+# Language choices of the page / CLI ("None", "FR", "DE", "NL FR").
+LANGUAGE_OPTIONS = ["None", "FR", "DE", "NL FR"]
+LAYOUT_OPTIONS = ["Automatic", "Horizontal", "Vertical"]
+
+def fallback_ext_for_language(language: Optional[str]) -> Optional[str]:
+    """Image extension used for language specific photos ("NL FR" is handled as a pair)."""
+    if not language or language == "None":
+        return None
+    if language == "NL FR":
+        return "NL FR"
+    return f"1-{language.lower()}"
+
+class RetryPolicy:
+    """Timeouts and exponential backoff (with full jitter) for CDN downloads."""
+
+    def __init__(self, request_timeout: float = 20.0, total_timeout: float = 90.0, max_attempts: int = 4,
+                 backoff_base: float = 0.5, backoff_max: float = 15.0,
+                 retry_statuses=(408, 425, 429, 500, 502, 503, 504)):
+        self.request_timeout = request_timeout
+        self.total_timeout = total_timeout
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = set(retry_statuses)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+class ThrottleBreaker:
+    """
+    Circuit breaker shared by all downloads of a run. After `threshold`
+    consecutive throttling answers (429/503) it opens and every request waits
+    out a cooldown that doubles on each new trip (up to max_cooldown). The
+    first success after a cooldown closes it again.
+    """
+
+    def __init__(self, threshold: int = 5, base_cooldown: float = 2.0, max_cooldown: float = 60.0):
+        self.threshold = threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = base_cooldown
+        self.consecutive_throttles = 0
+        self.open_until = 0.0
+        self.trips = 0
+
+    async def wait(self):
+        delay = self.open_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_success(self):
+        self.consecutive_throttles = 0
+        if self.open_until and time.monotonic() >= self.open_until:
+            self.open_until = 0.0
+            self.cooldown = self.base_cooldown
+
+    def record_throttle(self):
+        self.consecutive_throttles += 1
+        if self.consecutive_throttles >= self.threshold and time.monotonic() >= self.open_until:
+            self.trips += 1
+            self.open_until = time.monotonic() + self.cooldown
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self.consecutive_throttles = 0
+
+class ImageFetchCache:
+    """
+    Per-run fetch layer for CDN images.
+
+    Concurrent requests for the same URL share a single in-flight download
+    (single-flight) and every result is memoized for the rest of the run,
+    including misses (404 or failed downloads), so each URL is hit at most once.
+    Image bytes are kept up to max_bytes (least recently used evicted first);
+    misses cost nothing and are never evicted. Downloads go through the
+    persistent disk cache when one is configured, so repeated runs over the
+    same catalogue are mostly served locally, and URLs listed in the
+    known-missing index are skipped without a request.
+
+    Transient failures (timeouts, connection errors, 429/5xx) are retried per
+    the RetryPolicy while the ThrottleBreaker slows everyone down if the CDN
+    throttles. Only a 404 counts as "missing"; URLs that still fail are kept
+    in `failures` with their final reason.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, disk_cache: Optional[DiskImageCache] = None,
+                 missing_index: Optional[NegativeLookupIndex] = None, retry_policy: Optional[RetryPolicy] = None):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.disk_cache = disk_cache
+        self.missing_index = missing_index
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = ThrottleBreaker()
+        self.failures: Dict[str, Dict] = {}
+        self.retries = 0
+        self.max_bytes = max_bytes
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # Image bytes in LRU order; misses live in a separate set that is never evicted.
+        self._images: "OrderedDict[str, bytes]" = OrderedDict()
+        self._missing: Set[str] = set()
+        self._stored_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, session: aiohttp.ClientSession):
+        self.session = session
+
+    async def _download(self, url: str, product_code: Optional[str], extension: Optional[str]) -> Optional[bytes]:
+        if self.missing_index is not None:
+            if await asyncio.to_thread(self.missing_index.is_known_missing, url):
+                self.missing_index.skipped += 1
+                return None
+        policy = self.retry_policy
+        deadline = time.monotonic() + policy.total_timeout
+        reason = None
+        attempts = 0
+        while attempts < policy.max_attempts:
+            await self.breaker.wait()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                reason = "total timeout exceeded"
+                break
+            attempts += 1
+            retryable = True
+            try:
+                content, status = await asyncio.wait_for(
+                    fetch_with_cache_async(self.session, url, self.disk_cache),
+                    timeout=min(policy.request_timeout, remaining)
+                )
+            except asyncio.TimeoutError:
+                reason = "timeout"
+            except aiohttp.ClientError as e:
+                reason = f"connection error ({type(e).__name__})"
+            except Exception as e:
+                reason = f"error ({type(e).__name__}: {e})"
+                retryable = False
+            else:
+                if status == 200:
+                    self.breaker.record_success()
+                    return content
+                if status == 404:
+                    self.breaker.record_success()
+                    if self.missing_index is not None:
+                        await asyncio.to_thread(self.missing_index.record, url, product_code, extension, status)
+                    return None
+                reason = f"HTTP {status}"
+                if status in (429, 503):
+                    self.breaker.record_throttle()
+                retryable = status in policy.retry_statuses
+            if not retryable or attempts >= policy.max_attempts:
+                break
+            self.retries += 1
+            await asyncio.sleep(policy.backoff(attempts - 1))
+
+        self.failures[url] = {
+            "PZN": product_code, "extension": extension, "URL": url,
+            "reason": reason or "unknown", "attempts": attempts
+        }
+        return None
+
+    def url_failure_reason(self, url: str) -> Optional[str]:
+        """Final failure reason of one URL, or None if it was downloaded or genuinely missing."""
+        failure = self.failures.get(url)
+        return failure["reason"] if failure else None
+
+    def tracker(self) -> "FetchTracker":
+        return FetchTracker(self)
+
+    def failure_reason(self, product_code: str) -> Optional[str]:
+        """Final failure reasons recorded for one PZN, or None if its images were genuinely missing."""
+        reasons = sorted({
+            f"p{f['extension']}: {f['reason']}" for f in self.failures.values()
+            if f["PZN"] == product_code
+        })
+        return "; ".join(reasons) if reasons else None
+
+    def _remember(self, url: str, content: Optional[bytes]):
+        if not content:
+            self._missing.add(url)
+            return
+        self._images[url] = content
+        self._stored_bytes += len(content)
+        while self._stored_bytes > self.max_bytes and self._images:
+            _, evicted = self._images.popitem(last=False)
+            self._stored_bytes -= len(evicted)
+
+    async def get(self, url: str, product_code: Optional[str] = None, extension: Optional[str] = None) -> Optional[bytes]:
+        if url in self._missing:
+            self.hits += 1
+            return None
+        content = self._images.get(url)
+        if content is not None:
+            self.hits += 1
+            self._images.move_to_end(url)
+            return content
+
+        task = self._inflight.get(url)
+        if task is not None:
+            self.hits += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.ensure_future(self._download(url, product_code, extension))
+        self._inflight[url] = task
+        try:
+            content = await asyncio.shield(task)
+        finally:
+            self._inflight.pop(url, None)
+        self._remember(url, content)
+        return content
+
+    def summary(self) -> str:
+        return (
+            f"Image fetch cache: {self.hits} hits, {self.misses} misses ({len(self._images) + len(self._missing)} URLs memoized). "
+            f"Retries: {self.retries}, failed downloads: {len(self.failures)}, throttle pauses: {self.breaker.trips}."
+        )
+
+class FetchTracker:
+    """ImageFetchCache view for one bundle: records every URL the bundle asked for."""
+
+    def __init__(self, cache: ImageFetchCache):
+        self.cache = cache
+        self.urls: List[str] = []
+
+    async def get(self, url: str, product_code: Optional[str] = None, extension: Optional[str] = None) -> Optional[bytes]:
+        self.urls.append(url)
+        return await self.cache.get(url, product_code, extension)
+
+    def failed_codes(self) -> List[str]:
+        """PZNs with at least one URL of this bundle that ended in a download failure (not a 404)."""
+        return sorted({self.cache.failures[u]["PZN"] for u in self.urls if u in self.cache.failures})
+
+async def async_download_image(product_code: str, extension: str, fetcher: ImageFetchCache):
+    pzn = product_code
+    if product_code.startswith(('2', '1', '0')):
+        product_code = f"D{product_code}"
+    url = f"{CDN_BASE_URL}/{product_code}-p{extension}.jpg"
+    content = await fetcher.get(url, pzn, extension)
+    if content:
+        return content, url
+    return None, None
+
+# ---------------------- Streaming ZIP output ----------------------
+# Root folder of every entry inside the generated archive.
+ZIP_ROOT = "Bundle&Set"
+
+class ZipSink:
+    """
+    Streaming ZIP writer: entries are appended to the archive on disk as soon as
+    they are produced, with no intermediate folder tree. JPEGs are stored (they
+    are already compressed); anything else is deflated. Safe to call from
+    worker threads. With a cipher the archive is encrypted while it is written.
+    """
+
+    def __init__(self, zip_path: str, cipher: Optional[AtRestCipher] = None):
+        self.zip_path = zip_path
+        self._raw = cipher.open_writer(zip_path) if cipher is not None else None
+        self._zip = zipfile.ZipFile(self._raw if self._raw is not None else zip_path, "w", zipfile.ZIP_DEFLATED)
+        self._lock = threading.Lock()
+        self._names = set()
+
+    def write(self, arcname: str, data: bytes):
+        arcname = arcname.replace(os.sep, "/")
+        compress_type = zipfile.ZIP_STORED if arcname.lower().endswith((".jpg", ".jpeg")) else zipfile.ZIP_DEFLATED
+        with self._lock:
+            if arcname in self._names:
+                return
+            self._names.add(arcname)
+            self._zip.writestr(arcname, data, compress_type=compress_type)
+
+    @property
+    def entries(self) -> int:
+        return len(self._names)
+
+    def close(self) -> Optional[str]:
+        """Finalize the archive; returns its path, or None (and removes it) if empty."""
+        with self._lock:
+            self._zip.close()
+            if self._raw is not None:
+                self._raw.close()
+        if not self._names:
+            try:
+                os.remove(self.zip_path)
+            except OSError:
+                pass
+            return None
+        return self.zip_path
+
+    def abort(self):
+        """Close the handles and delete the partial archive (failed or cancelled run)."""
+        with self._lock:
+            try:
+                self._zip.close()
+                if self._raw is not None:
+                    self._raw.close()
+            except (OSError, ValueError):
+                pass
+        try:
+            os.remove(self.zip_path)
+        except OSError:
+            pass
+
+async def save_trimmed_image_to_zip(sink: ZipSink, image_pool: ImageWorkerPool, arcname: str, image_bytes: bytes):
+    data = await image_pool.trim(image_bytes)
+    await asyncio.to_thread(sink.write, arcname, data)
+
+# ---------- Cross-country folder routing ----------
+def get_uniform_folder(base_folder: str, num_products: int, is_cross_country: bool) -> str:
+    if is_cross_country:
+        return os.path.join(base_folder, "cross-country", f"bundle_{num_products}")
+    return os.path.join(base_folder, f"bundle_{num_products}")
+
+def get_mixed_root(base_folder: str, is_cross_country: bool) -> str:
+    if is_cross_country:
+        return os.path.join(base_folder, "cross-country", "mixed_sets")
+    return os.path.join(base_folder, "mixed_sets")
+
+# ---------- Download extra p2..p9 (standard or language-specific) ----------
+async def async_download_p2_to_p9(product_code: str, fetcher: ImageFetchCache, lang_suffix: Optional[str] = None) -> Dict[int, bytes]:
+    if lang_suffix:
+        exts = [f"{i}-{lang_suffix}" for i in range(2, 10)]
+    else:
+        exts = [str(i) for i in range(2, 10)]
+
+    tasks = [async_download_image(product_code, ext, fetcher) for ext in exts]
+    results = await asyncio.gather(*tasks)
+
+    out: Dict[int, bytes] = {}
+    for ext, (content, _url) in zip(exts, results):
+        if not content:
+            continue
+        p_num = int(str(ext).split("-")[0])
+        out[p_num] = content
+    return out
+
+# ---------- NL/FR p1 lookup ----------
+async def async_get_nl_fr_images(product_code: str, fetcher: ImageFetchCache) -> Dict[str, bytes]:
+    tasks = [
+        async_download_image(product_code, "1-fr", fetcher),
+        async_download_image(product_code, "1-nl", fetcher)
+    ]
+    results = await asyncio.gather(*tasks)
+    images: Dict[str, bytes] = {}
+    if results[0][0]:
+        images["1-fr"] = results[0][0]
+    if results[1][0]:
+        images["1-nl"] = results[1][0]
+    return images
+
+async def async_get_image_with_fallback(product_code: str, fetcher: ImageFetchCache, fallback_ext: Optional[str] = None):
+    # NL FR: return dict if at least one exists
+    if fallback_ext == "NL FR":
+        images_dict = await async_get_nl_fr_images(product_code, fetcher)
+        if images_dict:
+            return images_dict, "NL FR"
+
+    # default: try p1 then p10
+    tasks = [async_download_image(product_code, ext, fetcher) for ext in ["1", "10"]]
+    results = await asyncio.gather(*tasks)
+    for ext, result in zip(["1", "10"], results):
+        content, _url = result
+        if content:
+            return content, ext
+
+    # fallback single language p1-fr/p1-de/p1-nl
+    if fallback_ext and fallback_ext != "NL FR":
+        content, _ = await async_download_image(product_code, fallback_ext, fetcher)
+        if content:
+            return content, fallback_ext
+
+    return None, None
+
+# ---------------------- Single Bundle Processing ----------------------
+async def process_bundle(row, fetcher: ImageFetchCache, sink: ZipSink, image_pool: ImageWorkerPool, layout: str, fallback_ext: Optional[str]) -> Dict:
+    """
+    Download, compose and write the images of one bundle row into the ZIP.
+
+    Returns a dict with the bundle_list row (None if the bundle was skipped),
+    the missing-image errors and the warnings raised while processing, so the
+    caller can report them in input order regardless of completion order.
+    """
+    bundle_code = str(row['sku']).strip()
+    pzns_in_set_str = str(row['pzns_in_set']).strip()
+    product_codes = [code.strip() for code in pzns_in_set_str.split(',') if code.strip()]
+
+    base_folder = ZIP_ROOT
+    errors = []
+    warnings = []
+
+    if not product_codes:
+        warnings.append(f"Skipping bundle {bundle_code}: No valid product codes found.")
+        errors.append((bundle_code, "No valid PZNs listed", "unknown"))
+        return {"sku": bundle_code, "row": None, "errors": errors, "warnings": warnings}
+
+    num_products = len(product_codes)
+    is_uniform = (len(set(product_codes)) == 1)
+    bundle_type = f"bundle of {num_products}" if is_uniform else "mixed"
+    bundle_cross_country = False
+
+    # ---------------- UNIFORM BUNDLE ----------------
+    if is_uniform:
+        product_code = product_codes[0]
+
+        is_cross_country_mode = fallback_ext in ["NL FR", "1-fr", "1-de", "1-nl"]
+        folder_name = get_uniform_folder(base_folder, num_products, is_cross_country_mode)
+
+        result, used_ext = await async_get_image_with_fallback(product_code, fetcher, fallback_ext)
+
+        # --------- NL FR dict result (p1-fr and/or p1-nl exist) ----------
+        if used_ext == "NL FR" and isinstance(result, dict):
+            bundle_cross_country = True
+            folder_name = get_uniform_folder(base_folder, num_products, True)
+
+            processed_keys = []
+            for lang, image_data in result.items():
+                suffix = "-fr-h1" if lang == "1-fr" else "-nl-h1"
+                try:
+                    final_jpeg = await image_pool.compose(image_data, num_products, layout)
+                    save_path = os.path.join(folder_name, f"{bundle_code}{suffix}.jpg")
+                    await asyncio.to_thread(sink.write, save_path, final_jpeg)
+                    processed_keys.append(lang)
+                except Exception as e:
+                    warnings.append(f"Error processing {lang} image for bundle {bundle_code} (PZN: {product_code}): {e}")
+                    errors.append((bundle_code, f"{product_code} ({lang} processing error)", bundle_type))
+
+            # duplicate missing lang for h1 (keep your behaviour)
+            if "1-fr" not in processed_keys and "1-nl" in processed_keys:
+                try:
+                    final_jpeg_dup = await image_pool.compose(result["1-nl"], num_products, layout)
+                    dup_save_path = os.path.join(folder_name, f"{bundle_code}-fr-h1.jpg")
+                    await asyncio.to_thread(sink.write, dup_save_path, final_jpeg_dup)
+                except Exception as e:
+                    warnings.append(f"Error duplicating 1-fr for bundle {bundle_code} (PZN: {product_code}): {e}")
+                    errors.append((bundle_code, f"{product_code} (dup 1-fr processing error)", bundle_type))
+
+            if "1-nl" not in processed_keys and "1-fr" in processed_keys:
+                try:
+                    final_jpeg_dup = await image_pool.compose(result["1-fr"], num_products, layout)
+                    dup_save_path = os.path.join(folder_name, f"{bundle_code}-nl-h1.jpg")
+                    await asyncio.to_thread(sink.write, dup_save_path, final_jpeg_dup)
+                except Exception as e:
+                    warnings.append(f"Error duplicating 1-nl for bundle {bundle_code} (PZN: {product_code}): {e}")
+                    errors.append((bundle_code, f"{product_code} (dup 1-nl processing error)", bundle_type))
+
+            # ===== extras p2..p9 ONLY if p1 exists for that language =====
+            try:
+                has_p1_fr = "1-fr" in result
+                has_p1_nl = "1-nl" in result
+
+                if has_p1_fr:
+                    extra_fr = await async_download_p2_to_p9(product_code, fetcher, lang_suffix="fr")
+                    for p_num, img_bytes in extra_fr.items():
+                        extra_path = os.path.join(folder_name, f"{bundle_code}-fr-h{p_num}.jpg")
+                        await asyncio.to_thread(sink.write, extra_path, img_bytes)
+
+                if has_p1_nl:
+                    extra_nl = await async_download_p2_to_p9(product_code, fetcher, lang_suffix="nl")
+                    for p_num, img_bytes in extra_nl.items():
+                        extra_path = os.path.join(folder_name, f"{bundle_code}-nl-h{p_num}.jpg")
+                        await asyncio.to_thread(sink.write, extra_path, img_bytes)
+
+            except Exception as e:
+                warnings.append(f"Error downloading NL/FR extras p2..p9 for bundle {bundle_code} (PZN: {product_code}): {e}")
+                errors.append((bundle_code, f"{product_code} (NL/FR p2..p9 download error)", bundle_type))
+
+        # --------- Single image result (p1, p10, or 1-fr/1-de/1-nl) ----------
+        elif result:
+            used_is_lang = used_ext in ["1-fr", "1-de", "1-nl"]
+
+            # If actual used image is language-specific, put into cross-country folder tree
+            if used_is_lang:
+                bundle_cross_country = True
+                folder_name = get_uniform_folder(base_folder, num_products, True)
+
+            try:
+                final_jpeg = await image_pool.compose(result, num_products, layout)
+
+                # If fallback_ext == "NL FR" but NOT dict, p1-fr/p1-nl do not exist -> NO extras
+                if fallback_ext == "NL FR" and used_ext != "NL FR":
+                    folder_name = get_uniform_folder(base_folder, num_products, True)
+                    bundle_cross_country = True
+
+                    save_path_nl = os.path.join(folder_name, f"{bundle_code}-nl-h1.jpg")
+                    save_path_fr = os.path.join(folder_name, f"{bundle_code}-fr-h1.jpg")
+                    await asyncio.to_thread(sink.write, save_path_nl, final_jpeg)
+                    await asyncio.to_thread(sink.write, save_path_fr, final_jpeg)
+
+                else:
+                    if used_ext == "1-fr":
+                        save_path = os.path.join(folder_name, f"{bundle_code}-fr-h1.jpg")
+                        await asyncio.to_thread(sink.write, save_path, final_jpeg)
+                        try:
+                            extra = await async_download_p2_to_p9(product_code, fetcher, lang_suffix="fr")
+                            for p_num, img_bytes in extra.items():
+                                extra_path = os.path.join(folder_name, f"{bundle_code}-fr-h{p_num}.jpg")
+                                await asyncio.to_thread(sink.write, extra_path, img_bytes)
+                        except Exception as e:
+                            warnings.append(f"Error downloading FR extras p2..p9 for bundle {bundle_code} (PZN: {product_code}): {e}")
+                            errors.append((bundle_code, f"{product_code} (FR p2..p9 download error)", bundle_type))
+
+                    elif used_ext == "1-de":
+                        save_path = os.path.join(folder_name, f"{bundle_code}-de-h1.jpg")
+                        await asyncio.to_thread(sink.write, save_path, final_jpeg)
+                        try:
+                            extra = await async_download_p2_to_p9(product_code, fetcher, lang_suffix="de")
+                            for p_num, img_bytes in extra.items():
+                                extra_path = os.path.join(folder_name, f"{bundle_code}-de-h{p_num}.jpg")
+                                await asyncio.to_thread(sink.write, extra_path, img_bytes)
+                        except Exception as e:
+                            warnings.append(f"Error downloading DE extras p2..p9 for bundle {bundle_code} (PZN: {product_code}): {e}")
+                            errors.append((bundle_code, f"{product_code} (DE p2..p9 download error)", bundle_type))
+
+                    elif used_ext == "1-nl":
+                        save_path = os.path.join(folder_name, f"{bundle_code}-nl-h1.jpg")
+                        await asyncio.to_thread(sink.write, save_path, final_jpeg)
+                        try:
+                            extra = await async_download_p2_to_p9(product_code, fetcher, lang_suffix="nl")
+                            for p_num, img_bytes in extra.items():
+                                extra_path = os.path.join(folder_name, f"{bundle_code}-nl-h{p_num}.jpg")
+                                await asyncio.to_thread(sink.write, extra_path, img_bytes)
+                        except Exception as e:
+                            warnings.append(f"Error downloading NL extras p2..p9 for bundle {bundle_code} (PZN: {product_code}): {e}")
+                            errors.append((bundle_code, f"{product_code} (NL p2..p9 download error)", bundle_type))
+
+                    else:
+                        save_path = os.path.join(folder_name, f"{bundle_code}-h1.jpg")
+                        await asyncio.to_thread(sink.write, save_path, final_jpeg)
+
+                        # extras standard ONLY if p1 exists => used_ext == "1"
+                        if used_ext == "1":
+                            try:
+                                extra = await async_download_p2_to_p9(product_code, fetcher, lang_suffix=None)
+                                for p_num, img_bytes in extra.items():
+                                    extra_path = os.path.join(folder_name, f"{bundle_code}-h{p_num}.jpg")
+                                    await asyncio.to_thread(sink.write, extra_path, img_bytes)
+                            except Exception as e:
+                                warnings.append(f"Error downloading extras p2..p9 for bundle {bundle_code} (PZN: {product_code}): {e}")
+                                errors.append((bundle_code, f"{product_code} (p2..p9 download error)", bundle_type))
+
+            except Exception as e:
+                warnings.append(f"Error processing image for bundle {bundle_code} (PZN: {product_code}, Ext: {used_ext}): {e}")
+                errors.append((bundle_code, f"{product_code} (Ext: {used_ext} processing error)", bundle_type))
+
+        else:
+            errors.append((bundle_code, product_code, bundle_type))
+
+    # ---------------- MIXED SET ----------------
+    else:
+        is_cross_country_mode = fallback_ext in ["NL FR", "1-fr", "1-de", "1-nl"]
+        mixed_root = get_mixed_root(base_folder, is_cross_country_mode)
+        bundle_folder = os.path.join(mixed_root, bundle_code)
+
+        item_is_cross_country = False
+
+        for p_code in product_codes:
+            result, used_ext = await async_get_image_with_fallback(p_code, fetcher, fallback_ext)
+
+            if used_ext == "NL FR" and isinstance(result, dict):
+                item_is_cross_country = True
+                prod_folder = os.path.join(bundle_folder, "cross-country")
+
+                processed_keys = []
+                for lang, image_data in result.items():
+                    suffix = "-fr-h1" if lang == "1-fr" else "-nl-h1"
+                    file_path = os.path.join(prod_folder, f"{p_code}{suffix}.jpg")
+                    await save_trimmed_image_to_zip(sink, image_pool, file_path, image_data)
+                    processed_keys.append(lang)
+
+                if "1-fr" not in processed_keys and "1-nl" in processed_keys:
+                    file_path_dup = os.path.join(prod_folder, f"{p_code}-fr-h1.jpg")
+                    await save_trimmed_image_to_zip(sink, image_pool, file_path_dup, result["1-nl"])
+                elif "1-nl" not in processed_keys and "1-fr" in processed_keys:
+                    file_path_dup = os.path.join(prod_folder, f"{p_code}-nl-h1.jpg")
+                    await save_trimmed_image_to_zip(sink, image_pool, file_path_dup, result["1-fr"])
+
+            elif result:
+                prod_folder = bundle_folder
+                if used_ext in ["1-fr", "1-de", "1-nl"] or fallback_ext == "NL FR":
+                    item_is_cross_country = True
+                    prod_folder = os.path.join(bundle_folder, "cross-country")
+
+                if fallback_ext == "NL FR":
+                    file_path_nl = os.path.join(prod_folder, f"{p_code}-nl-h1.jpg")
+                    file_path_fr = os.path.join(prod_folder, f"{p_code}-fr-h1.jpg")
+                    await save_trimmed_image_to_zip(sink, image_pool, file_path_nl, result)
+                    await save_trimmed_image_to_zip(sink, image_pool, file_path_fr, result)
+                else:
+                    suffix = f"-p{used_ext}" if used_ext else "-h1"
+                    file_path = os.path.join(prod_folder, f"{p_code}{suffix}.jpg")
+                    await save_trimmed_image_to_zip(sink, image_pool, file_path, result)
+            else:
+                errors.append((bundle_code, p_code, bundle_type))
+
+        if item_is_cross_country:
+            bundle_cross_country = True
+
+    # Downloads that failed after retries (p2..p9 extras included) are reported per bundle,
+    # even when the bundle itself was produced.
+    if isinstance(fetcher, FetchTracker):
+        reported = {str(e[1]) for e in errors}
+        for code in fetcher.failed_codes():
+            if code not in reported:
+                errors.append((bundle_code, code, bundle_type))
+
+    row_out = [bundle_code, ', '.join(product_codes), bundle_type, "Yes" if bundle_cross_country else "No"]
+    return {"sku": bundle_code, "row": row_out, "errors": errors, "warnings": warnings}
+
+# ---------------------- Main Processing Function ----------------------
+BUNDLE_COLUMNS = ("sku", "pzns_in_set")
+
+def checkpoint_key(file_bytes: bytes, layout: str, fallback_ext: Optional[str], composite_mode: str) -> str:
+    """Checkpoint key of a run (the page uses it to discard checkpoints on reset)."""
+    return job_key(file_bytes, layout=layout, fallback_ext=fallback_ext, composite_mode=composite_mode)
+
+def read_bundle_table(file_bytes: bytes, file_name: str) -> pd.DataFrame:
+    """Parse only the sku/pzns_in_set columns straight from the upload buffer."""
+    return read_akeneo_columns(file_bytes, file_name, BUNDLE_COLUMNS)
+
+async def process_file_async(file_bytes: bytes, file_name: str, zip_path: str, reporter, layout="horizontal",
+                             fallback_ext: Optional[str] = None, max_concurrent_bundles=DEFAULT_BUNDLE_CONCURRENCY,
+                             image_workers=None, composite_mode=COMPOSITE_TILED, retry_policy: Optional[RetryPolicy] = None,
+                             resume: bool = False, cipher: Optional[AtRestCipher] = None):
+    """
+    Build the bundle ZIP and reports for one uploaded file. Everything
+    user-facing goes through `reporter` (see the module header). With a
+    cipher, the ZIP and the checkpoint folder are encrypted at rest.
+    """
+    try:
+        data = read_bundle_table(file_bytes, file_name)
+    except pd.errors.EmptyDataError:
+        reporter.error("The uploaded file is empty or could not be read.")
+        return None, None, None, None
+    except Exception as e:
+        reporter.error(f"Error reading file: {e}")
+        return None, None, None, None
+
+    required_columns = set(BUNDLE_COLUMNS)
+    missing_columns = required_columns - set(data.columns)
+    if missing_columns:
+        reporter.error(f"Missing required columns: {', '.join(missing_columns)}")
+        return None, None, None, None
+
+    data.dropna(subset=['sku', 'pzns_in_set'], inplace=True)
+    if data.empty:
+        reporter.error("The file is empty or contains no valid rows after cleaning!")
+        return None, None, None, None
+
+    total_rows = len(data)
+    reporter.info(f"File loaded: {total_rows} bundles found.")
+
+    # Checkpoint: completed bundles are recorded as they finish, so an interrupted
+    # run of the same file with the same options only processes the remainder.
+    checkpoint = None
+    try:
+        purge_stale_checkpoints()
+        checkpoint = BundleCheckpoint(checkpoint_key(file_bytes, layout, fallback_ext, composite_mode), cipher=cipher)
+        if not resume:
+            checkpoint.discard()
+        elif checkpoint.completed:
+            reporter.info(f"Resuming: {checkpoint.completed} bundles already completed in a previous run will be restored.")
+    except OSError as e:
+        # CheckpointBusy included: another job is running on the same file and options.
+        reporter.warning(f"Checkpointing disabled: {e}")
+        if checkpoint is not None:
+            checkpoint.close()
+            checkpoint = None
+
+    sink = None
+    try:
+        sink = ZipSink(zip_path, cipher=cipher)
+        image_pool = ImageWorkerPool(image_workers, composite_mode=composite_mode)
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+        if checkpoint is not None:
+            checkpoint.close()
+        raise
+    try:
+        # Batch
+        chunk_size = 1000
+        batches = []
+        for start in range(0, total_rows, chunk_size):
+            end = min(start + chunk_size, total_rows)
+            batches.append(data.iloc[start:end])
+
+        total_batches = len(batches)
+        reporter.info(f"Processing in {total_batches} batch(es) of up to {chunk_size} bundles each.")
+
+        error_list = []
+        bundle_list = []
+        fetch_cache = ImageFetchCache(
+            disk_cache=get_default_cache(), missing_index=get_default_missing_index(), retry_policy=retry_policy
+        )
+
+        # One connection pool for the whole job: keep-alive connections and DNS
+        # entries stay warm across batches.
+        connection_stats = ConnectionStats()
+        async with create_client_session(stats=connection_stats) as session:
+            fetch_cache.bind(session)
+            for batch_index, batch_df in enumerate(batches, start=1):
+                batch_size = len(batch_df)
+                reporter.progress(0.0, text=f"Processing batch {batch_index}/{total_batches} ({batch_size} bundles)")
+
+                # Bounded-concurrency scheduler: up to max_concurrent_bundles bundles in flight,
+                # results collected in input order so the reports stay deterministic.
+                semaphore = asyncio.Semaphore(max(1, int(max_concurrent_bundles)))
+                completed = 0
+
+                async def run_bundle(row):
+                    nonlocal completed
+                    sku = str(row['sku']).strip()
+                    async with semaphore:
+                        # a cancel stops the bundles still waiting for a slot, not only the next batch
+                        reporter.check_cancelled()
+                        if checkpoint is not None and checkpoint.is_done(sku):
+                            outcome = await asyncio.to_thread(checkpoint.replay, sku, sink)
+                        elif checkpoint is not None:
+                            recorder = checkpoint.recorder(sink)
+                            tracker = fetch_cache.tracker()
+                            outcome = await process_bundle(row, tracker, recorder, image_pool, layout, fallback_ext)
+                            # Bundles with any failed download (p1 or extras) are retried on resume.
+                            if not any(fetch_cache.url_failure_reason(url) for url in tracker.urls):
+                                await asyncio.to_thread(checkpoint.commit, sku, outcome, recorder.files)
+                        else:
+                            outcome = await process_bundle(row, fetch_cache.tracker(), sink, image_pool, layout, fallback_ext)
+                    completed += 1
+                    reporter.progress(
+                        completed / batch_size,
+                        text=f"Batch {batch_index}/{total_batches} – {outcome['sku']} ({completed}/{batch_size})"
+                    )
+                    return outcome
+
+                tasks = [asyncio.ensure_future(run_bundle(row)) for _, row in batch_df.iterrows()]
+                try:
+                    outcomes = await asyncio.gather(*tasks)
+                except Exception:
+                    # let the bundles in flight finish before the sink and the checkpoint are closed
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+
+                for outcome in outcomes:
+                    for message in outcome["warnings"]:
+                        reporter.warning(message)
+                    error_list.extend(outcome["errors"])
+                    if outcome["row"] is not None:
+                        bundle_list.append(outcome["row"])
+
+                reporter.progress(1.0, text=f"Batch {batch_index}/{total_batches} completed")
+                reporter.check_cancelled()
+
+        reporter.info(fetch_cache.summary())
+        reporter.info(connection_stats.summary())
+        if checkpoint is not None:
+            reporter.info(checkpoint.summary())
+        if fetch_cache.disk_cache is not None:
+            reporter.info(fetch_cache.disk_cache.summary())
+        if fetch_cache.missing_index is not None:
+            reporter.info(fetch_cache.missing_index.summary())
+        reporter.info(image_pool.summary())
+        # ZIP (entries were streamed in while processing)
+        zip_file_path = sink.close()
+    except BaseException:
+        # error or cancellation: no handle left open, no truncated ZIP left behind
+        sink.abort()
+        raise
+    finally:
+        image_pool.shutdown()
+        if checkpoint is not None:
+            checkpoint.close()
+
+    # Reports
+    missing_images_data = None
+    missing_images_df = pd.DataFrame(columns=["PZN Bundle", "bundle type", "PZN with image missing", "PZN with download failure"])
+    if error_list:
+        # A PZN whose downloads ended in timeouts/5xx is not "missing" on the CDN:
+        # keep it apart from the genuine 404s, together with the final reason.
+        errors_df = pd.DataFrame(error_list, columns=["PZN Bundle", "PZN", "bundle type"])
+        errors_df["PZN"] = errors_df["PZN"].map(str)
+        errors_df["reason"] = errors_df["PZN"].map(fetch_cache.failure_reason)
+        failed = errors_df["reason"].notna()
+        errors_df.loc[failed, "PZN"] = errors_df.loc[failed, "PZN"] + " (" + errors_df.loc[failed, "reason"] + ")"
+        join_codes = lambda x: ', '.join(sorted(set(x)))
+        keys = ["PZN Bundle", "bundle type"]
+        missing_images_df = pd.concat([
+            errors_df[~failed].groupby(keys)["PZN"].agg(join_codes).rename("PZN with image missing"),
+            errors_df[failed].groupby(keys)["PZN"].agg(join_codes).rename("PZN with download failure"),
+        ], axis=1).fillna("").reset_index()
+    # The report is written whenever something is missing or failed, even if every bundle got its p1.
+    if error_list or fetch_cache.failures:
+        try:
+            missing_buffer = BytesIO()
+            with pd.ExcelWriter(missing_buffer) as writer:
+                missing_images_df.to_excel(writer, sheet_name="Missing images", index=False)
+                if fetch_cache.missing_index is not None and error_list:
+                    run_codes = set(errors_df.loc[~failed, "PZN"])
+                    known_missing_df = pd.DataFrame(
+                        fetch_cache.missing_index.rows(run_codes), columns=NegativeLookupIndex.COLUMNS
+                    )
+                    known_missing_df.to_excel(writer, sheet_name="Known missing URLs", index=False)
+                if fetch_cache.failures:
+                    failures_df = pd.DataFrame(
+                        list(fetch_cache.failures.values()), columns=["PZN", "extension", "URL", "reason", "attempts"]
+                    )
+                    failures_df.to_excel(writer, sheet_name="Download failures", index=False)
+            missing_images_data = missing_buffer.getvalue()
+        except Exception as e:
+            reporter.error(f"Failed to create missing images Excel file: {e}")
+
+    bundle_list_data = None
+    bundle_list_df = pd.DataFrame(columns=["sku", "pzns_in_set", "bundle type", "cross-country"])
+    if bundle_list:
+        bundle_list_df = pd.DataFrame(bundle_list, columns=["sku", "pzns_in_set", "bundle type", "cross-country"])
+        try:
+            bundle_list_buffer = BytesIO()
+            bundle_list_df.to_excel(bundle_list_buffer, index=False)
+            bundle_list_data = bundle_list_buffer.getvalue()
+        except Exception as e:
+            reporter.error(f"Failed to create bundle list Excel file: {e}")
+
+    return zip_file_path, missing_images_data, missing_images_df, bundle_list_data
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+BUNDLE_JOB_KIND = "bundle"
+ZIP_FILE_NAME = "Bundle&Set.zip"
+BUNDLE_LIST_FILE_NAME = "bundle_list.xlsx"
+MISSING_IMAGES_FILE_NAME = "missing_images.xlsx"
+
+# ---------------------- File-level entry points ----------------------
+def run_pipeline(input_path: str, output_dir: str, reporter, **options) -> Dict[str, str]:
+    """
+    Process the sku/pzns_in_set file at input_path and write the ZIP and the
+    reports into output_dir. Returns {"zip" | "bundle_list" | "missing": path}
+    for the files actually written. Options as for run_pipeline_bytes.
+    """
+    with open(input_path, "rb") as f:
+        file_bytes = f.read()
+    return run_pipeline_bytes(file_bytes, os.path.basename(input_path), output_dir, reporter, **options)
+
+def run_pipeline_bytes(file_bytes: bytes, file_name: str, output_dir: str, reporter, layout="horizontal",
+                       fallback_ext: Optional[str] = None, max_concurrent_bundles=DEFAULT_BUNDLE_CONCURRENCY,
+                       image_workers=None, composite_mode=COMPOSITE_TILED, retry_policy: Optional[RetryPolicy] = None,
+                       resume: bool = False, cipher: Optional[AtRestCipher] = None) -> Dict[str, str]:
+    """run_pipeline for an upload already in memory; with a cipher every output is written encrypted."""
+    os.makedirs(output_dir, exist_ok=True)
+    zip_file_path, missing_images_data, _, bundle_list_data = asyncio.run(
+        process_file_async(
+            file_bytes, file_name, os.path.join(output_dir, ZIP_FILE_NAME), reporter,
+            layout=layout, fallback_ext=fallback_ext, max_concurrent_bundles=max_concurrent_bundles,
+            image_workers=image_workers, composite_mode=composite_mode, retry_policy=retry_policy, resume=resume,
+            cipher=cipher
+        )
+    )
+    outputs = {}
+    if zip_file_path:
+        outputs["zip"] = zip_file_path
+    for name, data, file_name in (
+        ("bundle_list", bundle_list_data, BUNDLE_LIST_FILE_NAME),
+        ("missing", missing_images_data, MISSING_IMAGES_FILE_NAME),
+    ):
+        if data:
+            path = os.path.join(output_dir, file_name)
+            if cipher is not None:
+                cipher.write_bytes(path, data)
+            else:
+                with open(path, "wb") as f:
+                    f.write(data)
+            outputs[name] = path
+    return outputs
+
+def run_bundle_job(ctx):
+    """Job handler: process the uploaded file and publish ZIP and reports as artifacts."""
+    params = ctx.params
+    outputs = run_pipeline_bytes(
+        ctx.read_input(params["file_name"]), params["file_name"], ctx.folder, ctx,
+        layout=params["layout"], fallback_ext=params["fallback_ext"],
+        max_concurrent_bundles=params["max_concurrent_bundles"], image_workers=params["image_workers"],
+        composite_mode=params["composite_mode"],
+        retry_policy=RetryPolicy(request_timeout=params["request_timeout"], max_attempts=params["download_attempts"]),
+        resume=params["resume"], cipher=ctx.cipher
+    )
+    short_id = ctx.job_id[:8]
+    if "zip" in outputs:
+        ctx.add_artifact("zip", outputs["zip"], "Download Bundle Images (ZIP)", f"BundleSet_{short_id}.zip", "application/zip")
+    else:
+        ctx.info("Processing complete, but no ZIP file was generated (likely no images saved).")
+    if "bundle_list" in outputs:
+        ctx.add_artifact("bundle_list", outputs["bundle_list"], "Download Bundle List", f"bundle_list_{short_id}.xlsx", XLSX_MIME)
+    if "missing" in outputs:
+        ctx.add_artifact("missing", outputs["missing"], "Download Missing List", f"missing_images_{short_id}.xlsx", XLSX_MIME)
@@ -0,0 +1,309 @@
+# Image compositing for the Bundle & Set creator
+#
+# Pure functions (bytes in, JPEG bytes out) so they can run in a process pool:
+# the asyncio loop keeps downloading while the CPU cores trim, paste and
+# resize. ImageWorkerPool wraps the pool for the async pipeline.
+#
+# Two compositing modes produce the same layout:
+#   - "merge": paste full-resolution copies into a large canvas, then resize
+#     the whole canvas to fit 1000x1000 (the original implementation);
+#   - "tiled": compute the final tile size first, decode JPEGs at a reduced
+#     scale (Image.draft), resize the trimmed product once and tile the small
+#     copy onto the 1000x1000 canvas. Much less memory and CPU per bundle.
+
+import os
+import asyncio
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+from PIL import Image, ImageChops
+
+JPEG_QUALITY = 75
+CANVAS_SIZE = 1000
+COMPOSITE_TILED = "tiled"
+COMPOSITE_MERGE = "merge"
+
+
+def trim(im: Image.Image) -> Image.Image:
+    # single-band sources (grayscale JPEGs) take a scalar white
+    white = 255 if im.mode in ("1", "L", "I", "F") else (255, 255, 255)
+    bg = Image.new(im.mode, im.size, white)
+    diff = ImageChops.difference(im, bg)
+    bbox = diff.getbbox()
+    if bbox:
+        return im.crop(bbox)
+    return im
+
+
+# ---------------------- FIXED AUTO LAYOUT (IMPORTANT) ----------------------
+def _resolve_layout(layout: str, width: int, height: int) -> str:
+    layout_l = (layout or "horizontal").lower()
+    if layout_l == "automatic":
+        # INVERTED: choose vertical for landscape/square, horizontal for portrait
+        return "vertical" if width >= height else "horizontal"
+    if layout_l in ("horizontal", "vertical"):
+        return layout_l
+    return "horizontal"
+
+
+def process_double_bundle_image(image: Image.Image, layout: str = "horizontal") -> Image.Image:
+    image = trim(image)
+    width, height = image.size
+    chosen_layout = _resolve_layout(layout, width, height)
+
+    if chosen_layout == "horizontal":
+        merged_width, merged_height = width * 2, height
+        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
+        merged_image.paste(image, (0, 0))
+        merged_image.paste(image, (width, 0))
+    else:
+        merged_width, merged_height = width, height * 2
+        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
+        merged_image.paste(image, (0, 0))
+        merged_image.paste(image, (0, height))
+
+    scale_factor = min(1000 / merged_width, 1000 / merged_height) if merged_width and merged_height else 1
+    new_size = (int(merged_width * scale_factor), int(merged_height * scale_factor))
+    resized_image = merged_image.resize(new_size, Image.LANCZOS)
+
+    final_image = Image.new("RGB", (1000, 1000), (255, 255, 255))
+    x_offset = (1000 - new_size[0]) // 2
+    y_offset = (1000 - new_size[1]) // 2
+    final_image.paste(resized_image, (x_offset, y_offset))
+    return final_image
+
+
+def process_triple_bundle_image(image: Image.Image, layout: str = "horizontal") -> Image.Image:
+    image = trim(image)
+    width, height = image.size
+    chosen_layout = _resolve_layout(layout, width, height)
+
+    if chosen_layout == "horizontal":
+        merged_width, merged_height = width * 3, height
+        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
+        merged_image.paste(image, (0, 0))
+        merged_image.paste(image, (width, 0))
+        merged_image.paste(image, (width * 2, 0))
+    else:
+        merged_width, merged_height = width, height * 3
+        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
+        merged_image.paste(image, (0, 0))
+        merged_image.paste(image, (0, height))
+        merged_image.paste(image, (0, height * 2))
+
+    scale_factor = min(1000 / merged_width, 1000 / merged_height) if merged_width and merged_height else 1
+    new_size = (int(merged_width * scale_factor), int(merged_height * scale_factor))
+    resized_image = merged_image.resize(new_size, Image.LANCZOS)
+
+    final_image = Image.new("RGB", (1000, 1000), (255, 255, 255))
+    x_offset = (1000 - new_size[0]) // 2
+    y_offset = (1000 - new_size[1]) // 2
+    final_image.paste(resized_image, (x_offset, y_offset))
+    return final_image
+
+
+# ---------------------- Target-resolution compositing ----------------------
+def _bundle_geometry(width: int, height: int, count: int, layout: str) -> Tuple[str, Tuple[int, int], Tuple[int, int]]:
+    """
+    Layout, tile size and top-left offset of the first tile on the canvas.
+    Mirrors the merge-then-resize arithmetic of process_double/triple_bundle_image.
+    """
+    chosen_layout = _resolve_layout(layout, width, height)
+    if chosen_layout == "horizontal":
+        merged_width, merged_height = width * count, height
+    else:
+        merged_width, merged_height = width, height * count
+
+    scale_factor = min(CANVAS_SIZE / merged_width, CANVAS_SIZE / merged_height) if merged_width and merged_height else 1
+    new_size = (int(merged_width * scale_factor), int(merged_height * scale_factor))
+    if chosen_layout == "horizontal":
+        tile_size = (max(1, new_size[0] // count), max(1, new_size[1]))
+    else:
+        tile_size = (max(1, new_size[0]), max(1, new_size[1] // count))
+    x_offset = (CANVAS_SIZE - new_size[0]) // 2
+    y_offset = (CANVAS_SIZE - new_size[1]) // 2
+    return chosen_layout, tile_size, (x_offset, y_offset)
+
+
+def _open_reduced(image_bytes: bytes, count: int, layout: str) -> Tuple[Image.Image, Optional[str]]:
+    """
+    Open the source for compositing and resolve its layout. JPEGs are decoded
+    with draft() at the largest 1/2, 1/4 or 1/8 scale that still leaves the
+    trimmed product at least as large as its tile, so nothing gets upscaled
+    by the reduction. The layout is decided on the full-scale trimmed size
+    (from a 1/8 probe) before draft(); a near-square product that the probe
+    cannot place is decoded at full scale and gets None, as do non-JPEGs:
+    the layout is then resolved on the trimmed image, like the merge mode.
+    """
+    img = Image.open(BytesIO(image_bytes))
+    if img.format != "JPEG":
+        return img, None
+
+    full_width, full_height = img.size
+    probe = Image.open(BytesIO(image_bytes))
+    probe.draft(probe.mode, (max(1, full_width // 8), max(1, full_height // 8)))
+    probe_scale = full_width / probe.size[0]
+    probe_trimmed = trim(probe)
+    est_width = probe_trimmed.size[0] * probe_scale
+    est_height = probe_trimmed.size[1] * probe_scale
+    if (layout or "").lower() == "automatic" and abs(est_width - est_height) <= 2 * probe_scale:
+        return img, None
+    chosen_layout = _resolve_layout(layout, int(est_width), int(est_height))
+    _, tile_size, _ = _bundle_geometry(int(est_width), int(est_height), count, chosen_layout)
+
+    # keep one extra power of two as a margin for the probe's imprecision
+    reduction = min(est_width / tile_size[0], est_height / tile_size[1]) / 2
+    factor = 1
+    while factor < 8 and factor * 2 <= reduction:
+        factor *= 2
+    if factor > 1:
+        # same mode as a plain decode, so trim() sees what the merge mode sees
+        img.draft(img.mode, (max(1, full_width // factor), max(1, full_height // factor)))
+    return img, chosen_layout
+
+
+def compose_bundle_tiled(image_bytes: bytes, count: int, layout: str = "horizontal") -> Image.Image:
+    """Build a double/triple bundle by tiling a once-resized copy on the 1000x1000 canvas."""
+    image, chosen_layout = _open_reduced(image_bytes, count, layout)
+    # trim in the source mode first, then convert: the merge mode's order
+    image = trim(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    width, height = image.size
+    chosen_layout, tile_size, (x_offset, y_offset) = _bundle_geometry(width, height, count, chosen_layout or layout)
+
+    tile = image.resize(tile_size, Image.LANCZOS, reducing_gap=3.0)
+    final_image = Image.new("RGB", (CANVAS_SIZE, CANVAS_SIZE), (255, 255, 255))
+    for i in range(count):
+        if chosen_layout == "horizontal":
+            final_image.paste(tile, (x_offset + i * tile_size[0], y_offset))
+        else:
+            final_image.paste(tile, (x_offset, y_offset + i * tile_size[1]))
+    return final_image
+
+
+def encode_jpeg(img: Image.Image, quality: int = JPEG_QUALITY) -> bytes:
+    buffer = BytesIO()
+    img.convert("RGB").save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+# ---------------------- Process-pool workers ----------------------
+def compose_bundle_jpeg(image_bytes: bytes, num_products: int, layout: str, mode: str = COMPOSITE_TILED) -> bytes:
+    """Decode, composite (double/triple bundles) and encode one uniform bundle image."""
+    if mode == COMPOSITE_TILED and num_products in (2, 3):
+        return encode_jpeg(compose_bundle_tiled(image_bytes, num_products, layout))
+    img = Image.open(BytesIO(image_bytes))
+    if num_products == 2:
+        img = process_double_bundle_image(img, layout)
+    elif num_products == 3:
+        img = process_triple_bundle_image(img, layout)
+    return encode_jpeg(img)
+
+
+def trimmed_jpeg(image_bytes: bytes) -> bytes:
+    """Decode, trim the white border and encode one mixed-set product image."""
+    img = Image.open(BytesIO(image_bytes))
+    return encode_jpeg(trim(img))
+
+
+def default_image_workers() -> int:
+    """BUNDLE_IMAGE_WORKERS overrides the pool size; 0 runs the work in threads instead."""
+    try:
+        return max(0, int(os.environ.get("BUNDLE_IMAGE_WORKERS", os.cpu_count() or 1)))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+class ImageWorkerPool:
+    """
+    Async facade over a process pool for the CPU-bound image steps.
+    With max_workers=0 the work runs in the default thread pool instead.
+
+    Derived images are encoded once per run: results are memoized by
+    (operation, source digest, parameters), and concurrent requests for the
+    same derivation share one job. The NL/FR copies of a bundle and every
+    mixed set containing the same PZN therefore reuse the same JPEG bytes.
+    Memoized outputs are bounded by memo_max_bytes (LRU).
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, composite_mode: str = COMPOSITE_TILED,
+                 memo_max_bytes: int = 256 * 1024 * 1024):
+        self.max_workers = default_image_workers() if max_workers is None else max(0, int(max_workers))
+        self.composite_mode = composite_mode
+        self.memo_max_bytes = memo_max_bytes
+        self._memo: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._memo_bytes = 0
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.encoded = 0
+        self.reused = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if self.max_workers > 0:
+            # spawn: the Streamlit server is multi-threaded, forking it is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    async def _run(self, fn, *args) -> bytes:
+        if self._executor is None:
+            return await asyncio.to_thread(fn, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _derive(self, key: tuple, fn, *args) -> bytes:
+        cached = self._memo.get(key)
+        if cached is not None:
+            self._memo.move_to_end(key)
+            self.reused += 1
+            return cached
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.reused += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.ensure_future(self._run(fn, *args))
+        self._inflight[key] = future
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            self._inflight.pop(key, None)
+        self.encoded += 1
+
+        self._memo[key] = data
+        self._memo_bytes += len(data)
+        while self._memo_bytes > self.memo_max_bytes and self._memo:
+            _, evicted = self._memo.popitem(last=False)
+            self._memo_bytes -= len(evicted)
+        return data
+
+    @staticmethod
+    def _digest(image_bytes: bytes) -> bytes:
+        return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+    async def compose(self, image_bytes: bytes, num_products: int, layout: str) -> bytes:
+        key = ("compose", self._digest(image_bytes), num_products, (layout or "").lower(), self.composite_mode)
+        return await self._derive(key, compose_bundle_jpeg, image_bytes, num_products, layout, self.composite_mode)
+
+    async def trim(self, image_bytes: bytes) -> bytes:
+        key = ("trim", self._digest(image_bytes))
+        return await self._derive(key, trimmed_jpeg, image_bytes)
+
+    def summary(self) -> str:
+        return f"Image encoding: {self.encoded} images encoded, {self.reused} reused from identical derivations."
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
@@ -0,0 +1,61 @@
+# Local stand-in for the product image CDN (Bundle&Set throughput runs)
+#
+#   python cdn_standin.py --port 8765 --latency 0.08
+#   BUNDLE_CDN_BASE_URL=http://127.0.0.1:8765 python bundle_cli.py bundles.xlsx --concurrency 1
+#   BUNDLE_CDN_BASE_URL=http://127.0.0.1:8765 python bundle_cli.py bundles.xlsx --concurrency 8
+#
+# Every <code>-p1.jpg answers with the same synthetic product photo after
+# --latency seconds; any other image (p2..p10, language variants) is a 404
+# after the same delay, so a run costs what a bundle without extras costs on
+# the real CDN. The elapsed time of the final "done" line of bundle_cli is
+# the figure to compare.
+
+import re
+import asyncio
+import argparse
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image, ImageDraw
+
+P1_PATH = re.compile(r"/(?P<code>[^/]+)-p1\.jpg$")
+
+
+def product_photo(size: int = 1500) -> bytes:
+    """A white-background JPEG with an off-centre product box, so trim() has work to do."""
+    image = Image.new("RGB", (size, size), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([size // 5, size // 8, size * 3 // 4, size * 7 // 8], fill=(30, 90, 160))
+    draw.rectangle([size // 4, size // 3, size * 2 // 3, size // 2], fill=(240, 200, 40))
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def build_app(latency: float, photo: bytes) -> web.Application:
+    stats = {"hits": 0, "misses": 0}
+
+    async def serve(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        if P1_PATH.search(request.path):
+            stats["hits"] += 1
+            return web.Response(body=photo, content_type="image/jpeg")
+        stats["misses"] += 1
+        return web.Response(status=404)
+
+    async def report(app):
+        print({"served": stats["hits"], "not_found": stats["misses"]})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", serve)
+    app.on_shutdown.append(report)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in CDN for bundle throughput measurements.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.08, help="seconds before every answer")
+    parser.add_argument("--size", type=int, default=1500, help="side of the served photo in pixels")
+    args = parser.parse_args()
+    web.run_app(build_app(args.latency, product_photo(args.size)), host="127.0.0.1", port=args.port)
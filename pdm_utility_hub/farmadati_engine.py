@@ -0,0 +1,256 @@
+# Farmadati engine: image download for the Repository page (TDZ + GetDoc)
+#
+# Independent of Streamlit, like switzerland_engine.py: the page builds one
+# FarmadatiAccount per account (through st.cache_resource, in the script
+# thread) and registers make_farmadati_job(account) with the job runner. The
+# job thread only uses the objects it was given; everything user-facing goes
+# through the job context (info / warning / error / progress /
+# check_cancelled).
+#
+# FarmadatiAccount holds the SOAP executor and the AIC memo of one account.
+# The zeep client (WSDL download, Filter / ArrayOfFilter type discovery) is
+# built by the first job that needs it and rebuilt after CLIENT_TTL_SECONDS;
+# clear() drops client and memo, so the next job asks the service again.
+#
+# A job resolves SKU -> AIC -> image name with TdzLookup (memo, local index,
+# then batched queries), blocks the AICs of the excluded manufacturers with
+# one TR017 pre-pass, then downloads the images from GetDoc one by one and
+# writes them, trimmed and centred on a 1000x1000 canvas, into one ZIP.
+
+import os
+import time
+import zipfile
+import threading
+from io import BytesIO
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import requests
+from PIL import Image, ImageChops, ImageOps, UnidentifiedImageError
+
+from farmadati_index import get_default_farmadati_index, max_age_seconds
+from farmadati_queries import AicMemo, MappingStats, SoapExecutor, TdzLookup, Tr017Lookup, aic_from_sku, create_soap_client
+from placeholder_filter import PlaceholderRejected, check_placeholder, get_default_placeholder_index, rejection_summary
+
+FARMADATI_JOB_KIND = "farmadati"
+FARMADATI_WSDL_URL = "https://webservices.farmadati.it/WS2S/FarmadatiItaliaWebServicesM1.svc?singleWsdl"
+GETDOC_URL = "https://ws.farmadati.it/WS_DOC/GetDoc.aspx"
+CLIENT_TTL_SECONDS = 3600
+DOWNLOAD_TIMEOUT = 45
+CANCEL_CHECK_EVERY = 50
+ZIP_FILE_NAME = "farmadati_images.zip"
+ERRORS_FILE_NAME = "errors_farmadati.csv"
+
+
+def find_filter_types(client) -> Tuple[Any, Any]:
+    """The Filter and ArrayOfFilter types of the Method 1 WSDL (their namespace is not fixed)."""
+    filter_type = array_type = None
+    for t in client.wsdl.types.types:
+        qname = getattr(t, "qname", None)
+        if qname is None:
+            continue
+        if qname.localname == "Filter":
+            filter_type = t
+        elif qname.localname == "ArrayOfFilter":
+            array_type = t
+    if filter_type is None or array_type is None:
+        raise RuntimeError(
+            "The 'Filter' or 'ArrayOfFilter' type was not found in the WSDL. "
+            "Check the WSDL, or print client.wsdl.types to see the available types."
+        )
+    return filter_type, array_type
+
+
+class FarmadatiAccount:
+    """SOAP executor and AIC memo of one Farmadati account, shared by its jobs."""
+
+    def __init__(self, username: str, password: str, wsdl_url: str = FARMADATI_WSDL_URL,
+                 client_ttl: float = CLIENT_TTL_SECONDS):
+        self.username = username
+        self.password = password
+        self.wsdl_url = wsdl_url
+        self.client_ttl = client_ttl
+        self.memo = AicMemo()
+        self._executor: Optional[SoapExecutor] = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def executor(self) -> SoapExecutor:
+        """The shared executor, (re)building the zeep client when missing or older than client_ttl."""
+        with self._lock:
+            if self._executor is None or time.monotonic() - self._built_at > self.client_ttl:
+                client = create_soap_client(self.wsdl_url)
+                filter_type, array_type = find_filter_types(client)
+                self._executor = SoapExecutor(client, filter_type, array_type, self.username, self.password)
+                self._built_at = time.monotonic()
+            return self._executor
+
+    def clear(self):
+        """Forget the client and the memo; the next job rebuilds both."""
+        with self._lock:
+            self._executor = None
+        self.memo.clear()
+
+
+def image_url(image_name: str, access_key: str) -> str:
+    return f"{GETDOC_URL}?accesskey={access_key}&tipodoc=Z&nomefile={requests.utils.quote(image_name)}"
+
+
+def clean_sku(sku: str) -> str:
+    """'IT' + AIC without leading zeros, the name the images are saved under."""
+    upper = str(sku).strip().upper()
+    return "IT" + (upper[2:] if upper.startswith("IT") else upper).lstrip("0")
+
+
+def process_image(img_bytes: bytes) -> BytesIO:
+    """Trimmed image centred on a white 1000x1000 canvas, as a JPEG buffer."""
+    try:
+        try:
+            img = Image.open(BytesIO(img_bytes))
+        except UnidentifiedImageError:
+            content_str = img_bytes.decode('utf-8', errors='ignore')
+            if "System.Web.HttpException" in content_str or "ASP.NET" in content_str:
+                raise ValueError("ASPX error page received instead of image")
+            raise ValueError("Unknown image format")
+
+        # black or blank: known placeholder hashes first, then extrema on a reduced draft
+        check_placeholder(img_bytes, get_default_placeholder_index())
+
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        img = ImageOps.exif_transpose(img)
+
+        bg = Image.new(img.mode, img.size, (255, 255, 255))
+        diff = ImageChops.difference(img, bg)
+        bbox = diff.getbbox()
+        if bbox:
+            img = img.crop(bbox)
+
+        if img.width == 0 or img.height == 0:
+            raise ValueError("Empty image after trimming")
+
+        img.thumbnail((1000, 1000), Image.LANCZOS)
+
+        canvas = Image.new("RGB", (1000, 1000), (255, 255, 255))
+        offset = ((1000 - img.width) // 2, (1000 - img.height) // 2)
+        canvas.paste(img, offset)
+
+        buffer = BytesIO()
+        canvas.save(buffer, "JPEG", quality=95)
+        buffer.seek(0)
+        return buffer
+    except PlaceholderRejected:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Image processing failed: {str(e)}")
+
+
+def resolve_image_names(account: FarmadatiAccount, skus: List[str]) -> Tuple[Dict[str, str], MappingStats]:
+    """{AIC (no leading zeros): image name} from TDZ; memo and local index first, only new AICs are queried."""
+    unique_aics = [aic for aic in (aic_from_sku(sku) for sku in skus) if aic]
+    lookup = TdzLookup(
+        account.executor(), index=get_default_farmadati_index(), max_age=max_age_seconds(), memo=account.memo
+    )
+    return lookup.run(unique_aics)
+
+
+def make_farmadati_job(account: FarmadatiAccount) -> Callable[[Any], None]:
+    """Job handler bound to `account`. Params: "skus" (list)."""
+
+    def run_farmadati_job(ctx):
+        skus = ctx.params["skus"]
+        ctx.info(f"Processing {len(skus)} SKUs for Farmadati...")
+        ctx.progress(0, text="Loading Farmadati mapping (this may take a minute)...", force=True)
+        aic_to_image, mapping_stats = resolve_image_names(account, skus)
+        ctx.info(mapping_stats.summary())
+
+        if not aic_to_image:
+            ctx.error("Farmadati mapping failed (no mapping entries).")
+            return
+
+        # TR017 pre-pass: blocked manufacturers for every AIC of the job, in
+        # batches (FDI_T139 -> FDI_T142); the download loop only checks the set.
+        ctx.progress(0, text="TR017 pre-pass: checking manufacturers...", force=True)
+        job_aics = [aic for aic in (aic_from_sku(sku) for sku in skus) if aic]
+        tr017_lookup = Tr017Lookup(account.executor(), index=get_default_farmadati_index(), max_age=max_age_seconds())
+        blocked_aics, tr017_stats = tr017_lookup.run(job_aics)
+        ctx.info(f"{tr017_stats.summary()} {len(blocked_aics)} AICs blocked.")
+        if tr017_stats.failed:
+            # a failed check lets the AIC through rather than blocking the whole job
+            ctx.warning(f"TR017 check failed for {tr017_stats.failed} AICs; they were not blocked.")
+        prepass_text = f"TR017 pre-pass {tr017_stats.elapsed:.1f}s"
+        ctx.progress(0, text=f"{prepass_text} – starting downloads...", force=True)
+
+        total = len(skus)
+        errors = []
+        rejections = Counter()
+        processed = 0
+        zip_path = ctx.output_path(ZIP_FILE_NAME)
+        short_id = ctx.job_id[:6]
+
+        with ctx.open_output(ZIP_FILE_NAME) as zip_stream, \
+                zipfile.ZipFile(zip_stream, "w", zipfile.ZIP_DEFLATED) as zipf, \
+                requests.Session() as http_session:
+            for i, sku in enumerate(skus):
+                ctx.progress((i + 1) / total, text=f"Processing {sku} ({i + 1}/{total}) · {prepass_text}")
+                if i % CANCEL_CHECK_EVERY == 0:
+                    ctx.check_cancelled()
+                original_sku = str(sku).strip()
+                name = clean_sku(original_sku)
+                if not name[2:]:
+                    errors.append((original_sku, "Invalid AIC (empty after IT)"))
+                    continue
+
+                aic_key = name[2:]
+                if aic_key in blocked_aics:
+                    errors.append((original_sku, "Download not allowed"))
+                    continue
+                image_name = aic_to_image.get(aic_key)
+                if not image_name:
+                    errors.append((original_sku, "AIC not in mapping"))
+                    continue
+
+                try:
+                    response = http_session.get(image_url(image_name, account.password), timeout=DOWNLOAD_TIMEOUT)
+                    response.raise_for_status()
+
+                    content_type = response.headers.get("Content-Type", "").lower()
+                    if "text/html" in content_type or "text/plain" in content_type:
+                        if "System.Web.HttpException" in response.text:
+                            raise ValueError("ASPX error page received")
+                    if not response.content:
+                        raise ValueError("Empty response")
+
+                    zipf.writestr(f"{name}-h1.jpg", process_image(response.content).read())
+                    processed += 1
+                except requests.exceptions.RequestException as req_e:
+                    reason = f"Network Error: {req_e}"
+                    if getattr(req_e, "response", None) is not None:
+                        reason = f"HTTP {req_e.response.status_code}"
+                    errors.append((original_sku, reason))
+                except PlaceholderRejected as e:
+                    rejections[e.label] += 1
+                    errors.append((original_sku, f"Error: {str(e)}"))
+                except Exception as e:
+                    errors.append((original_sku, f"Error: {str(e)}"))
+
+        ctx.progress(1.0, text="Farmadati processing complete!")
+        ctx.info(rejection_summary(rejections))
+
+        if processed > 0:
+            ctx.add_artifact("zip", zip_path, "Download Images (ZIP)", f"farmadati_images_{short_id}.zip", "application/zip")
+        else:
+            os.remove(zip_path)
+            ctx.info("No images processed.")
+
+        if errors:
+            error_df = pd.DataFrame(errors, columns=["SKU", "Reason"]).drop_duplicates().sort_values(by="SKU")
+            err_path = ctx.output_path(ERRORS_FILE_NAME)
+            error_df.to_csv(err_path, index=False, sep=";", encoding="utf-8-sig")
+            ctx.add_artifact("errors", err_path, "Download Error List", f"errors_farmadati_{short_id}.csv", "text/csv")
+        else:
+            ctx.info("No errors found.")
+
+    return run_farmadati_job
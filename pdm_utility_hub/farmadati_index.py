@@ -0,0 +1,179 @@
+# Local Farmadati reference index (TDZ image names, TR017 manufacturers)
+#
+# The same AICs are queried every week and the Farmadati data changes
+# slowly, so the lookups of farmadati_queries go through a SQLite index next
+# to the image cache: one row per (dataset, AIC) with the values found
+# (FDI_T438 image names for TDZ, FDI_T142 manufacturer codes for TR017) and
+# the time they were fetched. An AIC the service answered with no rows is
+# stored too (no values), so it is not asked again until it goes stale.
+#
+# Only unknown AICs and rows older than max_age are sent to the web service
+# (incremental refresh); lookups that failed are not stored. `rebuild`
+# replaces a whole dataset from a dump (CSV / Excel / XML export with the
+# key and value columns), without calling the service:
+#
+#   python farmadati_index.py rebuild TDZ tdz_dump.csv
+#   python farmadati_index.py stats
+#
+# Manufacturer codes are stored as found, not as a blocked flag, so a change
+# of the blocklist applies without a refresh.
+
+import io
+import os
+import sys
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from akeneo_loader import read_akeneo_columns
+from image_cache import DEFAULT_CACHE_DIR
+from farmadati_queries import (
+    DATASET_TDZ, DATASET_TR017, TDZ_AIC_FIELD, TDZ_IMAGE_FIELD, TR017_AIC_FIELD, TR017_MANUFACTURER_FIELD,
+    normalize_code
+)
+
+DEFAULT_MAX_AGE_DAYS = float(os.environ.get("PDM_FARMADATI_INDEX_MAX_AGE_DAYS", 7))
+DATASET_FIELDS = {
+    DATASET_TDZ: (TDZ_AIC_FIELD, TDZ_IMAGE_FIELD),
+    DATASET_TR017: (TR017_AIC_FIELD, TR017_MANUFACTURER_FIELD),
+}
+VALUE_SEPARATOR = "\n"
+SQL_CHUNK = 500
+
+
+class FarmadatiIndex:
+    """(dataset, AIC) -> values with fetch time, in SQLite."""
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR):
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "farmadati.sqlite3"), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " dataset TEXT NOT NULL, aic TEXT NOT NULL, vals TEXT NOT NULL, fetched_at REAL NOT NULL,"
+            " PRIMARY KEY (dataset, aic))"
+        )
+        self._db.commit()
+
+    def lookup(self, dataset: str, aics: Sequence[str],
+               max_age: Optional[float] = None) -> Tuple[Dict[str, List[str]], List[str]]:
+        """
+        ({AIC: values} of the fresh rows, [] when the service had none, AICs
+        still to query) for `aics`; max_age in seconds, None = never stale.
+        """
+        oldest = time.time() - max_age if max_age is not None else None
+        fresh: Dict[str, List[str]] = {}
+        with self._lock:
+            for start in range(0, len(aics), SQL_CHUNK):
+                chunk = aics[start:start + SQL_CHUNK]
+                rows = self._db.execute(
+                    f"SELECT aic, vals, fetched_at FROM entries WHERE dataset = ? AND aic IN ({','.join('?' * len(chunk))})",
+                    (dataset, *chunk),
+                ).fetchall()
+                for aic, vals, fetched_at in rows:
+                    if oldest is None or fetched_at >= oldest:
+                        fresh[aic] = vals.split(VALUE_SEPARATOR) if vals else []
+        return fresh, [aic for aic in aics if aic not in fresh]
+
+    def store(self, dataset: str, queried: Iterable[str], found: Dict[str, List[str]],
+              fetched_at: Optional[float] = None):
+        """Record the answer for every queried AIC (no values when it had no rows)."""
+        fetched_at = fetched_at or time.time()
+        rows = [(dataset, aic, VALUE_SEPARATOR.join(found.get(aic, ())), fetched_at) for aic in queried]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO entries (dataset, aic, vals, fetched_at) VALUES (?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def rebuild(self, dataset: str, rows: Iterable[Tuple[str, str]], fetched_at: Optional[float] = None) -> int:
+        """Replace all rows of `dataset` with the (AIC, value) pairs of a dump; returns the AICs stored."""
+        grouped: Dict[str, List[str]] = {}
+        for aic, value in rows:
+            values = grouped.setdefault(aic, [])
+            if value and value not in values:
+                values.append(value)
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM entries WHERE dataset = ?", (dataset,))
+                self._db.executemany(
+                    "INSERT INTO entries (dataset, aic, vals, fetched_at) VALUES (?, ?, ?, ?)",
+                    ((dataset, aic, VALUE_SEPARATOR.join(values), fetched_at or time.time())
+                     for aic, values in grouped.items()),
+                )
+        return len(grouped)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._db.execute("SELECT dataset, COUNT(*) FROM entries GROUP BY dataset").fetchall())
+
+    def clear(self, dataset: Optional[str] = None):
+        with self._lock:
+            if dataset is None:
+                self._db.execute("DELETE FROM entries")
+            else:
+                self._db.execute("DELETE FROM entries WHERE dataset = ?", (dataset,))
+            self._db.commit()
+
+
+def read_dump(path: str, dataset: str) -> Iterator[Tuple[str, str]]:
+    """(AIC, value) pairs from a dataset export: CSV / Excel (Akeneo loader) or XML (ExecuteQuery output)."""
+    key_field, value_field = DATASET_FIELDS[dataset]
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.lower().endswith(".xml"):
+        df = pd.read_xml(io.BytesIO(data), dtype=str)
+    else:
+        df = read_akeneo_columns(data, path, [key_field, value_field])
+    missing = [c for c in (key_field, value_field) if c not in df.columns]
+    if missing:
+        raise ValueError(f"Columns missing from the {dataset} dump: {', '.join(missing)}")
+    for aic, value in zip(df[key_field], df[value_field]):
+        if pd.isna(aic):
+            continue
+        aic = normalize_code(aic)
+        if aic:
+            yield aic, "" if pd.isna(value) else str(value).strip()
+
+
+def max_age_seconds(days: float = DEFAULT_MAX_AGE_DAYS) -> float:
+    return days * 24 * 3600
+
+
+_default_index: Optional[FarmadatiIndex] = None
+_default_index_lock = threading.Lock()
+
+
+def get_default_farmadati_index() -> Optional[FarmadatiIndex]:
+    """
+    Process-wide index next to the image cache: PDM_FARMADATI_INDEX ("off"
+    disables it), PDM_FARMADATI_INDEX_MAX_AGE_DAYS and PDM_IMAGE_CACHE_DIR.
+    """
+    global _default_index
+    if os.environ.get("PDM_FARMADATI_INDEX", "on").lower() in ("off", "0", "false", "no"):
+        return None
+    with _default_index_lock:
+        if _default_index is None:
+            try:
+                _default_index = FarmadatiIndex(root=os.environ.get("PDM_IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR))
+            except (OSError, sqlite3.Error):
+                return None
+        return _default_index
+
+
+if __name__ == "__main__":
+    # python farmadati_index.py rebuild <TDZ|TR017> <dump.csv|xlsx|xml>
+    # python farmadati_index.py stats
+    index = FarmadatiIndex(root=os.environ.get("PDM_IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR))
+    if len(sys.argv) == 4 and sys.argv[1] == "rebuild" and sys.argv[2].upper() in DATASET_FIELDS:
+        dataset = sys.argv[2].upper()
+        start = time.perf_counter()
+        stored = index.rebuild(dataset, read_dump(sys.argv[3], dataset))
+        print({"dataset": dataset, "aics": stored, "seconds": round(time.perf_counter() - start, 3)})
+    elif len(sys.argv) == 2 and sys.argv[1] == "stats":
+        print(index.counts())
+    else:
+        print("usage: python farmadati_index.py rebuild <TDZ|TR017> <dump> | stats")
+        sys.exit(1)
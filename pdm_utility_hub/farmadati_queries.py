@@ -0,0 +1,482 @@
+# Farmadati (WS2S Method 1) queries for the Repository page
+#
+# Independent of Streamlit: farmadati_engine.FarmadatiAccount passes the
+# shared zeep client and its Filter / ArrayOfFilter types in. ExecuteQuery
+# takes an ArrayOfFilter, and filters sharing one OrGroup are OR-ed, so a
+# single call can look up a batch of AICs (FDI_T218 = a OR FDI_T218 = b ...),
+# read page by page with PageN / PagingN. Paging stops on an EMPTY page, on
+# a short page once every AIC of the batch has rows, or after the pages
+# MAX_ROWS_PER_AIC rows per AIC would need at the page length the server
+# actually serves. A page after the first that still fails keeps the rows
+# already read; only the AICs without rows yet are queried again.
+#
+# The same batching serves TDZ (FDI_T218 -> image name FDI_T438) and the
+# TR017 pre-pass (FDI_T139 -> manufacturer FDI_T142), which resolves the
+# blocked AICs of a whole job before any download.
+#
+# A batch the server refuses is split in halves down to single-AIC queries,
+# so no lookup is lost to a bad batch size, and the following batches are
+# halved too. If the first batch comes back empty it is re-checked AIC by
+# AIC; if that finds rows the server is not OR-ing the filters and the rest
+# of the run uses single-AIC queries.
+#
+# With an index (farmadati_index.FarmadatiIndex) only the AICs it does not
+# know, or knows from too long ago, are sent to the service. In front of it
+# an AicMemo keeps recent answers per AIC in memory (TTL + LRU bound), so a
+# list that changed by one SKU only resolves the new AIC.
+#
+# SoapExecutor runs the calls concurrently: a bounded thread pool shares one
+# zeep client whose Transport holds a keep-alive requests.Session sized to
+# the pool. Every call has the transport timeout and is retried with backoff
+# on transport errors; map() returns results in input order, each with its
+# error, so callers fill their mapping and blocklist as in a serial loop.
+
+import io
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from zeep import Client, Settings
+from zeep.transports import Transport
+
+DATASET_TDZ = "TDZ"
+DATASET_TR017 = "TR017"
+TDZ_AIC_FIELD = "FDI_T218"
+TDZ_IMAGE_FIELD = "FDI_T438"
+DEFAULT_TDZ_BATCH = int(os.environ.get("PDM_FARMADATI_TDZ_BATCH", 100))
+DEFAULT_PAGE_SIZE = 500
+MAX_ROWS_PER_AIC = 4
+TR017_AIC_FIELD = "FDI_T139"
+TR017_MANUFACTURER_FIELD = "FDI_T142"
+BLOCKED_MANUFACTURERS = ("2769", "6681", "088H", "6832")
+DEFAULT_SOAP_WORKERS = int(os.environ.get("PDM_FARMADATI_WORKERS", 8))
+DEFAULT_SOAP_TIMEOUT = 60
+DEFAULT_SOAP_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 1.0
+DEFAULT_MEMO_TTL_SECONDS = float(os.environ.get("PDM_FARMADATI_MEMO_TTL", 3600))
+DEFAULT_MEMO_MAX_ENTRIES = int(os.environ.get("PDM_FARMADATI_MEMO_SIZE", 200000))
+
+
+class QueryError(Exception):
+    """ExecuteQuery failed (transport error or CodEsito other than OK); only transport errors are retryable."""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def aic_from_sku(sku) -> Optional[str]:
+    """AIC without "IT" and leading zeros, as used for the TDZ / TR017 lookups."""
+    clean = str(sku).strip().upper()
+    clean = clean[2:] if clean.startswith("IT") else clean
+    return clean.lstrip("0") or None
+
+
+def normalize_code(value) -> str:
+    text = str(value).strip()
+    if text.endswith(".0"):
+        text = text[:-2]
+    return text.lstrip("0")
+
+
+def execute_query(client, filter_type, array_type, username: str, password: str, dataset: str,
+                  fields: Sequence[str], filters: Sequence[Tuple[str, str, int]],
+                  page: int = 1, page_size: int = 100) -> Optional[pd.DataFrame]:
+    """
+    One ExecuteQuery call; filters are (key, value, or_group) with operator "=".
+    Returns the rows as strings, None when the answer is EMPTY.
+    """
+    filtri = array_type(Filter=[
+        filter_type(Key=key, Operator="=", OrGroup=group, Value=value) for key, value, group in filters
+    ])
+    try:
+        result = client.service.ExecuteQuery(
+            Username=username,
+            Password=password,
+            CodiceSetDati=dataset,
+            CampiDaEstrarre=list(fields),
+            Filtri=filtri,
+            Ordinamento=None,
+            Distinct=False,
+            Count=False,
+            PageN=page,
+            PagingN=page_size
+        )
+    except Exception as e:
+        raise QueryError(f"{type(e).__name__}: {e}", retryable=True) from e
+    if result.CodEsito != "OK":
+        raise QueryError(f"CodEsito {result.CodEsito}")
+    if result.OutputValue == "EMPTY":
+        return None
+    try:
+        return pd.read_xml(io.StringIO(result.OutputValue), dtype=str)
+    except Exception as e:
+        raise QueryError(f"unreadable output: {e}") from e
+
+
+def create_soap_client(wsdl_url: str, pool_size: int = DEFAULT_SOAP_WORKERS,
+                       timeout: float = DEFAULT_SOAP_TIMEOUT) -> Client:
+    """zeep client on a keep-alive Session with room for `pool_size` concurrent calls."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    transport = Transport(session=session, timeout=timeout, operation_timeout=timeout)
+    return Client(wsdl=wsdl_url, settings=Settings(strict=False, xml_huge_tree=True), transport=transport)
+
+
+class SoapExecutor:
+    """ExecuteQuery calls on a shared zeep client, retried and run on a bounded thread pool."""
+
+    def __init__(self, client, filter_type, array_type, username: str, password: str,
+                 workers: int = DEFAULT_SOAP_WORKERS, attempts: int = DEFAULT_SOAP_ATTEMPTS):
+        self.client = client
+        self.filter_type = filter_type
+        self.array_type = array_type
+        self.username = username
+        self.password = password
+        self.workers = max(1, int(workers))
+        self.attempts = max(1, int(attempts))
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def query(self, dataset: str, fields: Sequence[str], filters: Sequence[Tuple[str, str, int]],
+              page: int = 1, page_size: int = 100) -> Optional[pd.DataFrame]:
+        """execute_query with exponential backoff on transport errors."""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return execute_query(
+                    self.client, self.filter_type, self.array_type, self.username, self.password,
+                    dataset, fields, filters, page=page, page_size=page_size
+                )
+            except QueryError as e:
+                if not e.retryable or attempt == self.attempts:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                time.sleep(RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+
+    def map(self, fn: Callable[[Any], Any], items: Sequence) -> List[Tuple[Any, Optional[QueryError]]]:
+        """[(fn(item), None) or (None, QueryError)] in the order of `items`."""
+        results: List[Tuple[Any, Optional[QueryError]]] = []
+        if not items:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items)), thread_name_prefix="farmadati") as pool:
+            for future in [pool.submit(fn, item) for item in items]:
+                try:
+                    results.append((future.result(), None))
+                except QueryError as e:
+                    results.append((None, e))
+        return results
+
+
+class AicMemo:
+    """Per-AIC answers (values, [] for no rows) with a TTL, bounded by max_entries (LRU)."""
+
+    def __init__(self, ttl: float = DEFAULT_MEMO_TTL_SECONDS, max_entries: int = DEFAULT_MEMO_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max(1, int(max_entries))
+        self._entries: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, aics: Sequence[str]) -> Tuple[Dict[str, List[str]], List[str]]:
+        """({AIC: values} still fresh, AICs to resolve)."""
+        now = time.monotonic()
+        found: Dict[str, List[str]] = {}
+        missing: List[str] = []
+        with self._lock:
+            for aic in aics:
+                entry = self._entries.get(aic)
+                if entry is not None and now - entry[0] < self.ttl:
+                    self._entries.move_to_end(aic)
+                    found[aic] = entry[1]
+                else:
+                    if entry is not None:
+                        del self._entries[aic]
+                    missing.append(aic)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, aics: Iterable[str], values: Dict[str, List[str]]):
+        now = time.monotonic()
+        with self._lock:
+            for aic in aics:
+                self._entries[aic] = (now, values.get(aic, []))
+                self._entries.move_to_end(aic)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class MappingStats:
+    def __init__(self, label: str, aics: int, batch_size: int, workers: int = 1):
+        self.label = label
+        self.aics = aics
+        self.batch_size = batch_size
+        self.workers = workers
+        self.mapped = 0
+        self.queries = 0
+        self.rows = 0
+        self.splits = 0
+        self.failed = 0
+        self.failed_aics: List[str] = []
+        self.cached = 0
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.retries = 0
+        self.short_pages = 0
+        self.truncated = 0
+        self.page_failures = 0
+        self.elapsed = 0.0
+        self.batching_disabled = False
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def mark_failed(self, aic: str):
+        with self._lock:
+            self.failed += 1
+            self.failed_aics.append(aic)
+
+    @property
+    def rate(self) -> float:
+        return self.aics / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        text = (
+            f"{self.label}: {self.mapped}/{self.aics} AICs found in {self.elapsed:.1f}s "
+            f"({self.rate:.1f} AICs/s, {self.cached} from the local index, {self.queries} queries on {self.workers} workers, "
+            f"final batch size {self.batch_size}, {self.splits} batch splits, {self.retries} retries, "
+            f"{self.failed} lookups failed)."
+        )
+        if self.batching_disabled:
+            text += " The server did not OR the batched filters; single-AIC queries were used."
+        if self.short_pages:
+            text += (f" {self.short_pages} pages had fewer rows than requested but were followed by more:"
+                     " the server caps the page size.")
+        if self.truncated:
+            text += f" {self.truncated} batches may be truncated (paging did not end on an EMPTY page)."
+        if self.page_failures:
+            text += (f" {self.page_failures} batches failed after their first page; the rows read were kept"
+                     " and only the AICs still missing were queried again.")
+        if self.memo_hits or self.memo_misses:
+            text += f" Memo: {self.memo_hits} hits, {self.memo_misses} misses ({self.memo_hit_ratio:.0%})."
+        return text
+
+    @property
+    def memo_hit_ratio(self) -> float:
+        total = self.memo_hits + self.memo_misses
+        return self.memo_hits / total if total else 0.0
+
+
+class BatchedLookup:
+    """Batched key_field -> value_field lookups on one dataset, run on a SoapExecutor."""
+
+    label = ""
+    dataset = ""
+    key_field = ""
+    value_field = ""
+
+    def __init__(self, executor: SoapExecutor, batch_size: int = DEFAULT_TDZ_BATCH,
+                 page_size: int = DEFAULT_PAGE_SIZE, index=None, max_age: Optional[float] = None,
+                 memo: Optional[AicMemo] = None):
+        self.executor = executor
+        self.batch_size = max(1, int(batch_size))
+        self.page_size = page_size
+        self.index = index
+        self.max_age = max_age
+        self.memo = memo
+
+    def _query_batch(self, batch: List[str], stats: MappingStats) -> Dict[str, List[str]]:
+        """Non-empty values per AIC over all pages of one batch; raises QueryError when the server refuses it."""
+        wanted = set(batch)
+        found: Dict[str, List[str]] = {}
+        filters = [(self.key_field, aic, 0) for aic in batch]
+        previous = None
+        served = 0
+        page = 1
+        while True:
+            if page > 1 and page > self._page_limit(len(batch), served):
+                # More pages than the batch can fill: the server is not paging as asked.
+                stats.add(truncated=1)
+                return found
+            try:
+                df = self._query_page(filters, page, stats)
+            except QueryError:
+                if page == 1:
+                    raise
+                # Pages already read are kept: only the AICs without rows yet are looked up again.
+                stats.add(page_failures=1)
+                missing = [aic for aic in batch if aic not in found]
+                found.update(self._lookup(missing, stats) if missing else {})
+                return found
+            # A short page is not proof of the end when the server caps PagingN; EMPTY is.
+            if df is None or df.empty:
+                return found
+            if previous is not None and df.equals(previous):
+                # PageN ignored: the same page again would repeat forever.
+                stats.add(truncated=1)
+                return found
+            if previous is not None and len(previous) < self.page_size:
+                stats.add(short_pages=1)
+            previous = df
+            served = max(served, len(df))
+            stats.add(rows=len(df))
+            if self.value_field in df.columns:
+                aic_column = df[self.key_field] if self.key_field in df.columns else [batch[0]] * len(df)
+                for aic_value, value in zip(aic_column, df[self.value_field]):
+                    if pd.isna(value) or not str(value).strip():
+                        continue
+                    aic = normalize_code(aic_value) if len(batch) > 1 else batch[0]
+                    if aic in wanted:
+                        found.setdefault(aic, []).append(str(value).strip())
+            if len(df) < self.page_size and len(found) == len(wanted):
+                # Short page and every AIC has its rows: the EMPTY page would add nothing.
+                return found
+            page += 1
+
+    def _query_page(self, filters: List[Tuple[str, str, int]], page: int, stats: MappingStats) -> Optional[pd.DataFrame]:
+        """One page of the batch; a page after the first gets a second try before giving up."""
+        tries = 1 if page == 1 else 2
+        for attempt in range(1, tries + 1):
+            stats.add(queries=1)
+            try:
+                return self.executor.query(
+                    self.dataset, [self.key_field, self.value_field], filters, page=page, page_size=self.page_size
+                )
+            except QueryError:
+                if attempt == tries:
+                    raise
+
+    def _page_limit(self, batch_len: int, served: int) -> int:
+        """Pages needed for MAX_ROWS_PER_AIC rows per AIC at the page length the server serves, plus EMPTY."""
+        return -(-batch_len * MAX_ROWS_PER_AIC // max(1, min(served, self.page_size))) + 1
+
+    def _lookup(self, batch: List[str], stats: MappingStats) -> Dict[str, List[str]]:
+        try:
+            return self._query_batch(batch, stats)
+        except QueryError:
+            if len(batch) == 1:
+                stats.mark_failed(batch[0])
+                return {}
+            stats.add(splits=1)
+            half = len(batch) // 2
+            found = self._lookup(batch[:half], stats)
+            found.update(self._lookup(batch[half:], stats))
+            return found
+
+    def fetch(self, aics: Iterable[str]) -> Tuple[Dict[str, List[str]], MappingStats]:
+        """{AIC: values} for the AICs that have rows, with the run statistics."""
+        ordered = list(dict.fromkeys(a for a in aics if a))
+        stats = MappingStats(self.label, len(ordered), self.batch_size, self.executor.workers)
+        start = time.monotonic()
+        mapping: Dict[str, List[str]] = {}
+        if self.memo is not None:
+            remembered, ordered = self.memo.get_many(ordered)
+            stats.memo_hits, stats.memo_misses = len(remembered), len(ordered)
+            mapping.update((aic, values) for aic, values in remembered.items() if values)
+        known: Dict[str, List[str]] = {}
+        if self.index is not None:
+            known, ordered = self.index.lookup(self.dataset, ordered, self.max_age)
+            stats.cached = len(known)
+            mapping.update((aic, values) for aic, values in known.items() if values)
+        found = self._query(ordered, stats)
+        # "No rows" is only trusted once the answers show the filters are OR-ed (or not batched).
+        failed = set(stats.failed_aics)
+        trusted = found or stats.batch_size == 1 or len(ordered) == 1
+        answered = [aic for aic in ordered if aic not in failed] if trusted else []
+        if self.index is not None and answered:
+            self.index.store(self.dataset, answered, found)
+        if self.memo is not None:
+            self.memo.put_many(list(known) + answered, {**known, **found})
+        mapping.update(found)
+        stats.mapped = len(mapping)
+        stats.elapsed = time.monotonic() - start
+        return mapping, stats
+
+    def _query(self, ordered: List[str], stats: MappingStats) -> Dict[str, List[str]]:
+        retries = self.executor.retries
+        mapping: Dict[str, List[str]] = {}
+        batch_size = self.batch_size
+        if not ordered:
+            return mapping
+
+        # The first batch runs alone: it tells whether the server ORs the filters.
+        first = ordered[:batch_size]
+        i = len(first)
+        found = self._lookup(first, stats)
+        if stats.splits:
+            batch_size = max(1, batch_size // 2)
+        if not found and len(first) > 1:
+            # A whole batch without rows: confirm once that the filters are OR-ed.
+            for aic_found, _ in self.executor.map(lambda aic: self._lookup([aic], stats), first):
+                found.update(aic_found or {})
+            if found:
+                batch_size = 1
+                stats.batching_disabled = True
+        mapping.update(found)
+
+        # Then one wave of batches per pool width; a wave that needed splits halves the next.
+        while i < len(ordered):
+            wave = []
+            while i < len(ordered) and len(wave) < self.executor.workers:
+                wave.append(ordered[i:i + batch_size])
+                i += len(wave[-1])
+            splits = stats.splits
+            for found, _ in self.executor.map(lambda batch: self._lookup(batch, stats), wave):
+                mapping.update(found or {})
+            if stats.splits > splits:
+                batch_size = max(1, batch_size // 2)
+
+        stats.batch_size = batch_size
+        stats.retries = self.executor.retries - retries
+        return mapping
+
+
+class TdzLookup(BatchedLookup):
+    """AIC -> image name (FDI_T218 -> FDI_T438, first non-empty value) from dataset TDZ."""
+
+    label = "TDZ mapping"
+    dataset = DATASET_TDZ
+    key_field = TDZ_AIC_FIELD
+    value_field = TDZ_IMAGE_FIELD
+
+    def run(self, aics: Iterable[str]) -> Tuple[Dict[str, str], MappingStats]:
+        values, stats = self.fetch(aics)
+        return {aic: found[0] for aic, found in values.items()}, stats
+
+
+def is_blocked_manufacturer(codes: Iterable[str]) -> bool:
+    return any(blocked in code for code in codes for blocked in BLOCKED_MANUFACTURERS)
+
+
+class Tr017Lookup(BatchedLookup):
+    """Bulk blocked-manufacturer check (FDI_T139 -> FDI_T142) on dataset TR017."""
+
+    label = "TR017 pre-pass"
+    dataset = DATASET_TR017
+    key_field = TR017_AIC_FIELD
+    value_field = TR017_MANUFACTURER_FIELD
+
+    def run(self, aics: Iterable[str]) -> Tuple[Set[str], MappingStats]:
+        """AICs whose manufacturer is blocked; a failed lookup leaves the AIC allowed (stats.failed)."""
+        values, stats = self.fetch(aics)
+        return {aic for aic, codes in values.items() if is_blocked_manufacturer(codes)}, stats
@@ -0,0 +1,409 @@
+# Persistent on-disk cache for product images (shared by all image pages)
+#
+# Image bodies are stored content-addressed (sha256 of the bytes) under
+# <root>/blobs, and a small SQLite index maps every URL to its blob together
+# with the validators (ETag / Last-Modified) returned by the server.
+# Entries younger than the TTL are served without touching the network; older
+# entries are revalidated with a conditional GET. The total size of the blobs
+# is bounded and the least recently used URLs are evicted first.
+#
+# NegativeLookupIndex is the counterpart for misses: it remembers which
+# {PZN}-p{ext} URLs answered 404 so later runs can skip them until the entry
+# expires.
+
+import os
+import time
+import sqlite3
+import asyncio
+import hashlib
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pdm_image_cache")
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_MISSING_TTL_SECONDS = 3 * 24 * 3600
+
+
+class CacheEntry:
+    __slots__ = ("url", "digest", "size", "etag", "last_modified", "fetched_at")
+
+    def __init__(self, url, digest, size, etag, last_modified, fetched_at):
+        self.url = url
+        self.digest = digest
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+
+class DiskImageCache:
+    """URL-keyed, content-addressed image cache with TTL and LRU size bound."""
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, ttl_seconds: int = DEFAULT_TTL_SECONDS, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "index.sqlite3"), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " url TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL,"
+            " etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed_at)")
+        self._db.commit()
+
+        self._stores_since_evict = 0
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    # ---------- index ----------
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, digest, size, etag, last_modified, fetched_at FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return (time.time() - entry.fetched_at) < self.ttl_seconds
+
+    def read(self, entry: CacheEntry) -> Optional[bytes]:
+        try:
+            with open(self._blob_path(entry.digest), "rb") as f:
+                content = f.read()
+        except OSError:
+            self.forget(entry.url)
+            return None
+        with self._lock:
+            self._db.execute("UPDATE entries SET accessed_at = ? WHERE url = ?", (time.time(), entry.url))
+            self._db.commit()
+        return content
+
+    def store(self, url: str, content: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT digest FROM entries WHERE url = ?", (url,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (url, digest, size, etag, last_modified, fetched_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, digest, len(content), etag, last_modified, now, now),
+            )
+            self._db.commit()
+            if old and old[0] != digest:
+                self._drop_blob_if_unused(old[0])
+            self._stores_since_evict += 1
+            due = self._stores_since_evict >= 64
+        if due:
+            self.evict()
+
+    def mark_revalidated(self, url: str):
+        """The server answered 304: the cached body is still valid for another TTL."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE entries SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self._db.commit()
+
+    def forget(self, url: str):
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM entries WHERE url = ?", (url,)).fetchone()
+            self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self._db.commit()
+            if row:
+                self._drop_blob_if_unused(row[0])
+
+    def _drop_blob_if_unused(self, digest: str):
+        # caller holds self._lock
+        still_used = self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone()
+        if not still_used:
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes_locked()
+
+    def _total_bytes_locked(self) -> int:
+        row = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT digest, MAX(size) AS size FROM entries GROUP BY digest)"
+        ).fetchone()
+        return int(row[0])
+
+    def evict(self):
+        """Drop least recently used URLs until the blobs fit in max_bytes."""
+        with self._lock:
+            self._stores_since_evict = 0
+            total = self._total_bytes_locked()
+            if total <= self.max_bytes:
+                return
+            victims = self._db.execute("SELECT url, digest, size FROM entries ORDER BY accessed_at ASC").fetchall()
+            for url, digest, size in victims:
+                if total <= self.max_bytes:
+                    break
+                self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+                shared = self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone()
+                if not shared:
+                    total -= size
+                    try:
+                        os.remove(self._blob_path(digest))
+                    except OSError:
+                        pass
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._db.commit()
+        for sub in os.listdir(self.blob_dir):
+            sub_path = os.path.join(self.blob_dir, sub)
+            for name in os.listdir(sub_path):
+                try:
+                    os.remove(os.path.join(sub_path, name))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def conditional_headers(entry: Optional[CacheEntry]) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def summary(self) -> str:
+        return (
+            f"Disk image cache: {self.hits} hits, {self.revalidated} revalidated, {self.misses} misses "
+            f"({self.total_bytes() / (1024 * 1024):.1f} MB on disk)."
+        )
+
+
+class NegativeLookupIndex:
+    """Expiring index of image URLs known to be missing (HTTP 404)."""
+
+    COLUMNS = ["product_code", "extension", "url", "status", "first_seen", "last_seen", "expires_at"]
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, ttl_seconds: int = DEFAULT_MISSING_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "missing.sqlite3"), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS missing ("
+            " url TEXT PRIMARY KEY, product_code TEXT, extension TEXT, status INTEGER NOT NULL,"
+            " first_seen REAL NOT NULL, last_seen REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS missing_product ON missing(product_code)")
+        self._db.commit()
+        self.skipped = 0
+        self.recorded = 0
+
+    def is_known_missing(self, url: str) -> bool:
+        with self._lock:
+            row = self._db.execute("SELECT expires_at FROM missing WHERE url = ?", (url,)).fetchone()
+        return bool(row) and row[0] > time.time()
+
+    def record(self, url: str, product_code: Optional[str] = None, extension: Optional[str] = None, status: int = 404):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO missing (url, product_code, extension, status, first_seen, last_seen, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(url) DO UPDATE SET status = excluded.status,"
+                " last_seen = excluded.last_seen, expires_at = excluded.expires_at",
+                (url, product_code, extension, status, now, now, now + self.ttl_seconds),
+            )
+            self._db.commit()
+        self.recorded += 1
+
+    def discard(self, url: str):
+        with self._lock:
+            self._db.execute("DELETE FROM missing WHERE url = ?", (url,))
+            self._db.commit()
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            cur = self._db.execute("DELETE FROM missing WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+        return cur.rowcount
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM missing")
+            self._db.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._db.execute("SELECT COUNT(*) FROM missing WHERE expires_at > ?", (time.time(),)).fetchone()[0])
+
+    def rows(self, product_codes: Optional[Iterable[str]] = None) -> List[Dict]:
+        """Unexpired entries (optionally only for the given product codes), timestamps as ISO strings."""
+        query = "SELECT " + ", ".join(self.COLUMNS) + " FROM missing WHERE expires_at > ?"
+        params: list = [time.time()]
+        codes = sorted(set(product_codes)) if product_codes is not None else None
+        with self._lock:
+            if codes is None:
+                raw = self._db.execute(query + " ORDER BY product_code, extension", params).fetchall()
+            else:
+                raw = []
+                # stay below SQLite's bound-parameter limit
+                for i in range(0, len(codes), 500):
+                    chunk = codes[i:i + 500]
+                    marks = ", ".join("?" for _ in chunk)
+                    raw.extend(self._db.execute(query + f" AND product_code IN ({marks})", params + chunk).fetchall())
+                raw.sort(key=lambda r: (r[0] or "", r[1] or ""))
+        out = []
+        for r in raw:
+            row = dict(zip(self.COLUMNS, r))
+            for k in ("first_seen", "last_seen", "expires_at"):
+                row[k] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[k]))
+            out.append(row)
+        return out
+
+    def summary(self) -> str:
+        return f"Known-missing index: {self.skipped} requests skipped, {self.recorded} new 404s recorded ({self.count()} active entries)."
+
+
+# ---------- shared instances ----------
+_default_cache: Optional[DiskImageCache] = None
+_default_cache_lock = threading.Lock()
+_default_missing_index: Optional[NegativeLookupIndex] = None
+
+
+def get_default_cache() -> Optional[DiskImageCache]:
+    """
+    Process-wide cache configured from the environment:
+    PDM_IMAGE_CACHE ("off" disables it), PDM_IMAGE_CACHE_DIR,
+    PDM_IMAGE_CACHE_TTL (seconds) and PDM_IMAGE_CACHE_MAX_MB.
+    """
+    global _default_cache
+    if os.environ.get("PDM_IMAGE_CACHE", "on").lower() in ("off", "0", "false", "no"):
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            try:
+                _default_cache = DiskImageCache(
+                    root=os.environ.get("PDM_IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR),
+                    ttl_seconds=int(os.environ.get("PDM_IMAGE_CACHE_TTL", DEFAULT_TTL_SECONDS)),
+                    max_bytes=int(os.environ.get("PDM_IMAGE_CACHE_MAX_MB", DEFAULT_MAX_BYTES // (1024 * 1024))) * 1024 * 1024,
+                )
+            except (OSError, sqlite3.Error):
+                return None
+        return _default_cache
+
+
+def get_default_missing_index() -> Optional[NegativeLookupIndex]:
+    """
+    Process-wide known-missing index, next to the disk cache.
+    PDM_MISSING_INDEX ("off" disables it) and PDM_MISSING_INDEX_TTL (seconds).
+    """
+    global _default_missing_index
+    if os.environ.get("PDM_MISSING_INDEX", "on").lower() in ("off", "0", "false", "no"):
+        return None
+    with _default_cache_lock:
+        if _default_missing_index is None:
+            try:
+                _default_missing_index = NegativeLookupIndex(
+                    root=os.environ.get("PDM_IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR),
+                    ttl_seconds=int(os.environ.get("PDM_MISSING_INDEX_TTL", DEFAULT_MISSING_TTL_SECONDS)),
+                )
+            except (OSError, sqlite3.Error):
+                return None
+        return _default_missing_index
+
+
+# ---------- fetch helpers ----------
+def fetch_with_cache(http, url: str, cache: Optional[DiskImageCache], timeout: float = 30) -> Tuple[Optional[bytes], int]:
+    """
+    GET url through the disk cache with a requests-like client (module or Session).
+    Returns (content, status); cache hits and revalidated entries report 200.
+    Exceptions from the client are propagated to the caller.
+    """
+    entry = cache.lookup(url) if cache is not None else None
+    if entry is not None and cache.is_fresh(entry):
+        content = cache.read(entry)
+        if content is not None:
+            cache.hits += 1
+            return content, 200
+        entry = None
+
+    resp = http.get(url, headers=DiskImageCache.conditional_headers(entry), timeout=timeout)
+    if resp.status_code == 304 and entry is not None:
+        content = cache.read(entry)
+        if content is not None:
+            cache.revalidated += 1
+            cache.mark_revalidated(url)
+            return content, 200
+        resp = http.get(url, timeout=timeout)
+
+    if cache is not None:
+        cache.misses += 1
+    if resp.status_code == 200 and resp.content:
+        if cache is not None:
+            cache.store(url, resp.content, resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+        return resp.content, 200
+    return None, resp.status_code
+
+
+async def fetch_with_cache_async(session, url: str, cache: Optional[DiskImageCache]) -> Tuple[Optional[bytes], int]:
+    """aiohttp counterpart of fetch_with_cache; disk access runs in worker threads."""
+    entry = await asyncio.to_thread(cache.lookup, url) if cache is not None else None
+    if entry is not None and cache.is_fresh(entry):
+        content = await asyncio.to_thread(cache.read, entry)
+        if content is not None:
+            cache.hits += 1
+            return content, 200
+        entry = None
+
+    async with session.get(url, headers=DiskImageCache.conditional_headers(entry)) as response:
+        status = response.status
+        if status == 200:
+            content = await response.read()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        else:
+            content = None
+
+    if status == 304 and entry is not None:
+        cached = await asyncio.to_thread(cache.read, entry)
+        if cached is not None:
+            cache.revalidated += 1
+            await asyncio.to_thread(cache.mark_revalidated, url)
+            return cached, 200
+        async with session.get(url) as response:
+            status = response.status
+            content = await response.read() if status == 200 else None
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+    if cache is not None:
+        cache.misses += 1
+    if status == 200 and content:
+        if cache is not None:
+            await asyncio.to_thread(cache.store, url, content, etag, last_modified)
+        return content, 200
+    return None, status
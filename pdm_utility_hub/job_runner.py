@@ -0,0 +1,396 @@
+# Local background job runner for the long image jobs
+#
+# Pages no longer run heavy work inside the Streamlit script thread: they
+# submit a job (kind + JSON params + input files) and render its status.
+# Jobs are persisted in a small SQLite database next to a per-job folder that
+# holds the inputs and the produced artifacts, so results stay downloadable
+# across reruns of the page and two users do not block each other.
+#
+#   <root>/jobs.sqlite3          job rows + progress + log messages
+#   <root>/<job id>/inputs/      uploaded files
+#   <root>/<job id>/...          artifacts written by the handler
+#
+# A handler is a plain function `handler(ctx: JobContext)`; it must not call
+# st.* and reports through the context instead (progress, info/warning/error,
+# add_artifact). Worker threads only pick up kinds that have a registered
+# handler, so jobs queued before a restart wait until their page registers it
+# again. Jobs found "running" when the runner starts were interrupted by a
+# restart and are put back in the queue.
+#
+# Every job row carries the owner token of the browser session that
+# submitted it (see job_ui.current_owner): listings are filtered by owner and
+# the UI refuses to show or serve someone else's job.
+#
+# With at-rest protection on (see at_rest.py) params and messages are sealed
+# in the database, inputs are stored encrypted and every artifact is
+# encrypted at the latest when it is published; the UI decrypts on download.
+
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import tempfile
+import threading
+import traceback
+from typing import Callable, Dict, List, Optional
+
+from at_rest import AtRestCipher, AtRestError, get_default_cipher
+
+DEFAULT_JOBS_ROOT = os.path.join(tempfile.gettempdir(), "pdm_jobs")
+DEFAULT_WORKERS = 2
+DEFAULT_RETENTION_SECONDS = 3 * 24 * 3600
+PROGRESS_MIN_INTERVAL = 0.25
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING)
+
+
+class JobCancelled(Exception):
+    """Raised by JobContext.check_cancelled when the user asked to stop the job."""
+
+
+class JobStore:
+    """SQLite-backed job table; safe to share between threads."""
+
+    def __init__(self, root: str = DEFAULT_JOBS_ROOT, cipher: Optional[AtRestCipher] = None):
+        self.root = root
+        self.cipher = cipher
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "jobs.sqlite3"), check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, params TEXT NOT NULL,"
+            " progress REAL NOT NULL DEFAULT 0, progress_text TEXT, artifacts TEXT NOT NULL DEFAULT '{}',"
+            " error TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, level TEXT NOT NULL,"
+            " text TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            # Rows created before owners existed get none and are listed for nobody.
+            self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs(owner, kind, created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_job ON messages(job_id, seq)")
+        self._db.commit()
+
+    def job_folder(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def _seal(self, text: str) -> str:
+        return self.cipher.seal(text) if self.cipher is not None else text
+
+    def _unseal(self, text: str) -> str:
+        return self.cipher.unseal(text) if self.cipher is not None else text
+
+    def _execute(self, sql: str, args=()):
+        with self._lock:
+            cur = self._db.execute(sql, args)
+            self._db.commit()
+            return cur
+
+    def create(self, kind: str, params: Dict, job_id: Optional[str] = None, owner: Optional[str] = None) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        os.makedirs(os.path.join(self.job_folder(job_id), "inputs"), exist_ok=True)
+        self._execute(
+            "INSERT INTO jobs (id, kind, status, params, created_at, owner) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, kind, JOB_QUEUED, self._seal(json.dumps(params)), time.time(), owner),
+        )
+        return job_id
+
+    def claim_next(self, kinds: List[str]) -> Optional[Dict]:
+        """Atomically move the oldest queued job of one of `kinds` to running."""
+        if not kinds:
+            return None
+        marks = ",".join("?" for _ in kinds)
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT id FROM jobs WHERE status = ? AND kind IN ({marks}) ORDER BY created_at LIMIT 1",
+                (JOB_QUEUED, *kinds),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?",
+                (JOB_RUNNING, time.time(), row["id"], JOB_QUEUED),
+            )
+            self._db.commit()
+        return self.get(row["id"])
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        try:
+            job["params"] = json.loads(self._unseal(job["params"]))
+        except (AtRestError, ValueError):
+            # Sealed with another at-rest key (e.g. an ephemeral key before a restart).
+            job["params"] = None
+        job["artifacts"] = json.loads(job["artifacts"])
+        return job
+
+    def list_jobs(self, kind: Optional[str] = None, limit: int = 10, owner: Optional[str] = None) -> List[Dict]:
+        """Latest jobs of `owner` (all owners when None: maintenance only, never for the UI)."""
+        where, args = [], []
+        if kind is not None:
+            where.append("kind = ?")
+            args.append(kind)
+        if owner is not None:
+            where.append("owner = ?")
+            args.append(owner)
+        sql = "SELECT id FROM jobs" + (" WHERE " + " AND ".join(where) if where else "")
+        with self._lock:
+            rows = self._db.execute(sql + " ORDER BY created_at DESC LIMIT ?", (*args, limit)).fetchall()
+        return [job for job in (self.get(r["id"]) for r in rows) if job is not None]
+
+    def set_progress(self, job_id: str, fraction: float, text: Optional[str]):
+        self._execute("UPDATE jobs SET progress = ?, progress_text = ? WHERE id = ?", (fraction, text, job_id))
+
+    def add_message(self, job_id: str, level: str, text: str):
+        self._execute(
+            "INSERT INTO messages (job_id, level, text, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, level, self._seal(str(text)), time.time()),
+        )
+
+    def messages(self, job_id: str) -> List[Dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT level, text, created_at FROM messages WHERE job_id = ? ORDER BY seq", (job_id,)
+            ).fetchall()
+        messages = []
+        for r in rows:
+            message = dict(r)
+            try:
+                message["text"] = self._unseal(message["text"])
+            except AtRestError:
+                message["text"] = "(message encrypted with a previous key)"
+            messages.append(message)
+        return messages
+
+    def add_artifact(self, job_id: str, name: str, artifact: Dict):
+        with self._lock:
+            row = self._db.execute("SELECT artifacts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            artifacts = json.loads(row["artifacts"]) if row else {}
+            artifacts[name] = artifact
+            self._db.execute("UPDATE jobs SET artifacts = ? WHERE id = ?", (json.dumps(artifacts), job_id))
+            self._db.commit()
+
+    def finish(self, job_id: str, status: str, error: Optional[str] = None):
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, error, time.time(), job_id),
+        )
+
+    def request_cancel(self, job_id: str):
+        self._execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        # Queued jobs are cancelled right away; running ones stop at their next check.
+        self._execute(
+            "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+            (JOB_CANCELLED, time.time(), job_id, JOB_QUEUED),
+        )
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def requeue_interrupted(self) -> int:
+        cur = self._execute(
+            "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?", (JOB_QUEUED, JOB_RUNNING)
+        )
+        return cur.rowcount
+
+    def purge(self, max_age_seconds: int = DEFAULT_RETENTION_SECONDS) -> int:
+        """Delete finished jobs (rows, messages and folders) older than max_age_seconds."""
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE status NOT IN (?, ?) AND created_at < ?", (*ACTIVE_STATES, cutoff)
+            ).fetchall()
+            ids = [r["id"] for r in rows]
+            for job_id in ids:
+                self._db.execute("DELETE FROM messages WHERE job_id = ?", (job_id,))
+                self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self._db.commit()
+        for job_id in ids:
+            shutil.rmtree(self.job_folder(job_id), ignore_errors=True)
+        return len(ids)
+
+
+class JobContext:
+    """What a handler sees: its params, folders and the reporting callbacks."""
+
+    def __init__(self, store: JobStore, job: Dict):
+        self.store = store
+        self.job_id = job["id"]
+        self.kind = job["kind"]
+        self.params = job["params"]
+        self.folder = store.job_folder(self.job_id)
+        self.inputs_folder = os.path.join(self.folder, "inputs")
+        self.cipher = store.cipher
+        self._last_progress = 0.0
+
+    def input_path(self, name: str) -> str:
+        return os.path.join(self.inputs_folder, name)
+
+    def open_input(self, name: str):
+        """Readable binary stream over an uploaded input file (decrypted on the fly when needed)."""
+        if self.cipher is not None:
+            return self.cipher.open_reader(self.input_path(name))
+        return open(self.input_path(name), "rb")
+
+    def read_input(self, name: str) -> bytes:
+        """Content of an uploaded input file (decrypted when at-rest protection is on)."""
+        if self.cipher is not None:
+            return self.cipher.read_bytes(self.input_path(name))
+        with open(self.input_path(name), "rb") as f:
+            return f.read()
+
+    def output_path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def open_output(self, name: str):
+        """Writable binary stream for an output file, encrypted on the fly when at-rest protection is on."""
+        if self.cipher is not None:
+            return self.cipher.open_writer(self.output_path(name))
+        return open(self.output_path(name), "wb")
+
+    def progress(self, fraction: float, text: Optional[str] = None, force: bool = False):
+        now = time.monotonic()
+        if force or fraction >= 1.0 or now - self._last_progress >= PROGRESS_MIN_INTERVAL:
+            self._last_progress = now
+            self.store.set_progress(self.job_id, max(0.0, min(1.0, float(fraction))), text)
+
+    def info(self, message: str):
+        self.store.add_message(self.job_id, "info", message)
+
+    def success(self, message: str):
+        self.store.add_message(self.job_id, "success", message)
+
+    def warning(self, message: str):
+        self.store.add_message(self.job_id, "warning", message)
+
+    def error(self, message: str):
+        self.store.add_message(self.job_id, "error", message)
+
+    def add_artifact(self, name: str, path: str, label: str, file_name: str, mime: str):
+        """Publish a downloadable file produced by the job (encrypting it first if needed)."""
+        if self.cipher is not None:
+            self.cipher.encrypt_file(path)
+        self.store.add_artifact(
+            self.job_id, name,
+            {"path": path, "label": label, "file_name": file_name, "mime": mime, "encrypted": self.cipher is not None}
+        )
+
+    def check_cancelled(self):
+        if self.store.cancel_requested(self.job_id):
+            raise JobCancelled()
+
+
+class JobRunner:
+    """Worker threads pulling queued jobs from the JobStore."""
+
+    def __init__(self, store: JobStore, workers: int = DEFAULT_WORKERS, poll_interval: float = 1.0):
+        self.store = store
+        self.cipher = store.cipher
+        self.workers = max(1, int(workers))
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, Callable[[JobContext], None]] = {}
+        self._wake = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._started = False
+        self._lock = threading.Lock()
+
+    def register(self, kind: str, handler: Callable[[JobContext], None]):
+        """(Re-)register the handler of a job kind; the latest registration wins."""
+        self._handlers[kind] = handler
+        self._wake.set()
+
+    def submit(self, kind: str, params: Dict, files: Optional[Dict[str, bytes]] = None,
+               owner: Optional[str] = None) -> str:
+        # Inputs are written before the row exists, so a worker never claims a job without its files.
+        job_id = uuid.uuid4().hex
+        inputs = os.path.join(self.store.job_folder(job_id), "inputs")
+        os.makedirs(inputs, exist_ok=True)
+        for name, data in (files or {}).items():
+            path = os.path.join(inputs, os.path.basename(name))
+            if self.cipher is not None:
+                self.cipher.write_bytes(path, data)
+            else:
+                with open(path, "wb") as f:
+                    f.write(data)
+        self.store.create(kind, params, job_id, owner=owner)
+        self._wake.set()
+        return job_id
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self.store.requeue_interrupted()
+            self.store.purge(int(os.environ.get("PDM_JOB_RETENTION", DEFAULT_RETENTION_SECONDS)))
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"pdm-job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.store.claim_next(list(self._handlers))
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict):
+        if job["params"] is None:
+            self.store.finish(job["id"], JOB_FAILED, "The job cannot be decrypted (the at-rest key changed).")
+            return
+        ctx = JobContext(self.store, job)
+        handler = self._handlers[job["kind"]]
+        try:
+            handler(ctx)
+        except JobCancelled:
+            ctx.warning("Job cancelled.")
+            self.store.finish(ctx.job_id, JOB_CANCELLED)
+        except Exception as e:
+            self.store.finish(ctx.job_id, JOB_FAILED, f"{e}\n\n{traceback.format_exc()}")
+        else:
+            ctx.progress(1.0, force=True)
+            self.store.finish(ctx.job_id, JOB_DONE)
+
+
+_default_runner: Optional[JobRunner] = None
+_default_runner_lock = threading.Lock()
+
+
+def get_default_runner() -> JobRunner:
+    """
+    Process-wide runner (started on first use): PDM_JOBS_DIR, PDM_JOB_WORKERS
+    and PDM_JOB_RETENTION (seconds) configure it; at-rest protection follows
+    at_rest.get_default_cipher().
+    """
+    global _default_runner
+    with _default_runner_lock:
+        if _default_runner is None:
+            store = JobStore(os.environ.get("PDM_JOBS_DIR", DEFAULT_JOBS_ROOT), cipher=get_default_cipher())
+            _default_runner = JobRunner(store, workers=int(os.environ.get("PDM_JOB_WORKERS", DEFAULT_WORKERS)))
+            _default_runner.start()
+        return _default_runner
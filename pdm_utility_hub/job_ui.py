@@ -0,0 +1,196 @@
+# Streamlit widgets for background jobs (see job_runner.py)
+#
+# The id of the job a page section is showing lives in the URL query string;
+# only the id, never anything that grants access. While the job is active the
+# status block polls the store every second.
+#
+# Jobs belong to the browser session that submitted them: a random owner
+# token is kept only in the session state, so a copied link does not hand the
+# job to whoever opens it. Recent jobs are listed per owner and render_job
+# refuses jobs of another owner, whatever job id the URL carries. A new
+# session (a full browser reload included) starts with a new owner and no
+# longer sees the jobs of the previous one.
+
+import os
+import time
+import uuid
+from typing import Optional
+
+import streamlit as st
+
+from at_rest import AtRestError
+from job_runner import JobRunner, ACTIVE_STATES, JOB_DONE, JOB_FAILED, JOB_CANCELLED
+
+POLL_SECONDS = 1.0
+ARTIFACTS_PER_ROW = 4
+OWNER_PARAM = "owner"
+INLINE_DOWNLOAD_MAX_BYTES = 20 * 1024 * 1024
+
+
+def current_owner() -> str:
+    """Owner token of this browser session, created on first use and kept only in the session state."""
+    if "job_owner" not in st.session_state:
+        st.session_state["job_owner"] = uuid.uuid4().hex
+    if OWNER_PARAM in st.query_params:
+        # links from older versions carried the owner: it grants nothing any more, drop it
+        del st.query_params[OWNER_PARAM]
+    return st.session_state["job_owner"]
+
+
+def current_job_id(param: str) -> Optional[str]:
+    return st.query_params.get(param)
+
+
+def set_current_job(param: str, job_id: Optional[str]):
+    if job_id:
+        st.query_params[param] = job_id
+    elif param in st.query_params:
+        del st.query_params[param]
+
+
+def _render_messages(runner: JobRunner, job_id: str):
+    for message in runner.store.messages(job_id):
+        level = message["level"]
+        if level == "error":
+            st.error(message["text"])
+        elif level == "warning":
+            st.warning(message["text"])
+        elif level == "success":
+            st.success(message["text"])
+        else:
+            st.info(message["text"])
+
+
+def _render_active(runner: JobRunner, job_id: str):
+    job = runner.store.get(job_id)
+    if job is None:
+        return
+    if job["status"] not in ACTIVE_STATES:
+        # Finished while polling: redraw the whole page with the results.
+        st.rerun()
+    text = job["progress_text"] or ("Waiting in queue..." if job["status"] == "queued" else "Running...")
+    st.progress(job["progress"], text=text)
+    with st.expander("Job log", expanded=False):
+        _render_messages(runner, job_id)
+    if st.button("Cancel job", key=f"cancel_{job_id}"):
+        runner.store.request_cancel(job_id)
+
+
+if hasattr(st, "fragment"):
+    _render_active_polling = st.fragment(run_every=POLL_SECONDS)(_render_active)
+else:
+    def _render_active_polling(runner: JobRunner, job_id: str):
+        _render_active(runner, job_id)
+        time.sleep(POLL_SECONDS)
+        st.rerun()
+
+
+def render_job(runner: JobRunner, job_id: str, key: str) -> Optional[dict]:
+    """
+    Show status, progress, log and artifacts of a job. Returns the job row
+    once it is done (so the caller can render extra previews), else None.
+    """
+    job = runner.store.get(job_id)
+    if job is None or job.get("owner") != current_owner():
+        # Someone else's job is reported exactly like a missing one.
+        st.warning("This job is no longer available (it may have expired).")
+        return None
+
+    if job["status"] in ACTIVE_STATES:
+        _render_active_polling(runner, job_id)
+        return None
+
+    _render_messages(runner, job_id)
+    if job["status"] == JOB_FAILED:
+        st.error(f"The job failed: {(job['error'] or '').splitlines()[0] if job['error'] else 'unknown error'}")
+        with st.expander("Error details"):
+            st.code(job["error"] or "")
+        return None
+    if job["status"] == JOB_CANCELLED:
+        st.warning("The job was cancelled.")
+        return None
+
+    if job["started_at"] and job["finished_at"]:
+        elapsed = job["finished_at"] - job["started_at"]
+        st.success(f"Processing finished in {int(elapsed // 60)}m {int(elapsed % 60)}s.")
+    render_artifacts(job, key, runner)
+    return job if job["status"] == JOB_DONE else None
+
+
+def render_artifacts(job: dict, key: str, runner: Optional[JobRunner] = None):
+    artifacts = [a for a in job["artifacts"].values() if a["path"] and os.path.exists(a["path"])]
+    if not artifacts:
+        st.info("No files produced.")
+        return
+    st.markdown("---")
+    for i, artifact in enumerate(artifacts):
+        # At most ARTIFACTS_PER_ROW buttons side by side (streaming jobs publish many ZIP parts).
+        if i % ARTIFACTS_PER_ROW == 0:
+            columns = st.columns(min(ARTIFACTS_PER_ROW, len(artifacts) - i))
+        with columns[i % ARTIFACTS_PER_ROW]:
+            _render_download(runner, artifact, f"{key}_{job['id']}_{i}")
+
+
+def _forget_prepared(ready_key: str):
+    st.session_state.pop(ready_key, None)
+
+
+def read_artifact(runner: Optional[JobRunner], artifact: dict) -> Optional[bytes]:
+    """Bytes of an artifact, decrypted if needed; None (after an st.error) when it cannot be opened."""
+    if not artifact.get("encrypted"):
+        with open(artifact["path"], "rb") as f:
+            return f.read()
+    if runner is None or runner.cipher is None:
+        st.error("At-rest protection is off: this encrypted file cannot be opened.")
+        return None
+    try:
+        return runner.cipher.read_bytes(artifact["path"])
+    except AtRestError:
+        st.error("This file was encrypted with a previous key and cannot be opened.")
+        return None
+
+
+def _render_download(runner: Optional[JobRunner], artifact: dict, button_key: str):
+    """
+    Small plain files are offered directly. Large or encrypted ones are read
+    (and decrypted) only in the run where the user asks for them, and only a
+    flag is kept in the session state. Streamlit has no streamed file
+    endpoint, so the served bytes still sit in its media store until the
+    download is done; static serving is not an option since it would make
+    job outputs public.
+    """
+    path = artifact["path"]
+    ready_key = f"prepared_{button_key}"
+    on_demand = artifact.get("encrypted") or os.path.getsize(path) > INLINE_DOWNLOAD_MAX_BYTES
+    if on_demand and not st.session_state.get(ready_key):
+        if st.button(f"Prepare: {artifact['label']}", key=f"prepare_{button_key}"):
+            st.session_state[ready_key] = True
+            st.rerun()
+        return
+    data = read_artifact(runner, artifact)
+    if data is None:
+        _forget_prepared(ready_key)
+        return
+    st.download_button(
+        label=artifact["label"],
+        data=data,
+        file_name=artifact["file_name"],
+        mime=artifact["mime"],
+        key=button_key,
+        on_click=_forget_prepared,
+        args=(ready_key,)
+    )
+
+
+def render_recent_jobs(runner: JobRunner, kind: str, param: str, limit: int = 5):
+    """Sidebar list of the latest jobs of a kind, to reopen one after a reload."""
+    jobs = runner.store.list_jobs(kind, limit=limit, owner=current_owner())
+    if not jobs:
+        return
+    with st.sidebar.expander("Recent jobs"):
+        for job in jobs:
+            created = time.strftime("%d/%m %H:%M", time.localtime(job["created_at"]))
+            label = f"{created} – {job['status']} – {(job['params'] or {}).get('label', job['id'][:8])}"
+            if st.button(label, key=f"open_{param}_{job['id']}"):
+                set_current_job(param, job["id"])
+                st.rerun()
@@ -2,21 +2,20 @@
 
 import streamlit as st
 import pandas as pd
-import csv
 import os
 import zipfile
 import shutil
-from PIL import Image, ImageOps, ImageChops, UnidentifiedImageError, ImageDraw
-from io import BytesIO
+from PIL import Image, ImageOps, ImageDraw
 import tempfile
 import uuid
-import xml.etree.ElementTree as ET  # libreria standard
 import requests
-from zeep import Client, Settings
-from zeep.wsse.username import UsernameToken
-from zeep.transports import Transport
-from zeep.cache import InMemoryCache
-from zeep.plugins import HistoryPlugin
+from image_cache import get_default_cache, fetch_with_cache
+from akeneo_loader import read_sku_column
+from farmadati_index import get_default_farmadati_index
+from farmadati_engine import FARMADATI_JOB_KIND, FarmadatiAccount, make_farmadati_job
+from job_runner import get_default_runner
+from job_ui import current_job_id, current_owner, set_current_job, render_job, render_recent_jobs
+from switzerland_engine import SWISS_JOB_KIND, DEFAULT_PART_MB, run_switzerland_job
 
 # ======== Import aggiuntivi per Medipim ========
 import io
@@ -207,6 +206,12 @@ if "renaming_uploader_key" not in st.session_state:
 if "renaming_session_id" not in st.session_state:
     st.session_state.renaming_session_id = str(uuid.uuid4())
 
+# ----- Background jobs (Switzerland / Farmadati) -----
+# I job girano nel job runner locale; l'id del job è nella URL (query param).
+job_runner = get_default_runner()
+CH_JOB_KIND, CH_JOB_PARAM = SWISS_JOB_KIND, "ch_job"
+FD_JOB_KIND, FD_JOB_PARAM = FARMADATI_JOB_KIND, "fd_job"
+
 # ---------------------------------------------------------
 # AUTO RESET QUANDO SI CAMBIA SERVER (FOCUS SU SWITZERLAND)
 # ---------------------------------------------------------
@@ -236,31 +241,11 @@ st.session_state.last_page = current_page
 # ---------------------------------------------------------
 def get_sku_list(uploaded_file_obj, manual_text):
     sku_list = []
-    df_file = None
     if uploaded_file_obj is not None:
         try:
-            if uploaded_file_obj.name.lower().endswith("csv"):
-                uploaded_file_obj.seek(0)
-                sample = uploaded_file_obj.read(1024).decode("utf-8", errors='ignore')
-                uploaded_file_obj.seek(0)
-                delimiter = ';'  # Default
-                try:
-                    dialect = csv.Sniffer().sniff(sample, delimiters=';,\t')
-                    delimiter = dialect.delimiter
-                except Exception:
-                    pass  # Use default
-                df_file = pd.read_csv(uploaded_file_obj, delimiter=delimiter, dtype=str)
-            else:
-                df_file = pd.read_excel(uploaded_file_obj, dtype=str)
-
-            sku_column = None
-            for col in df_file.columns:
-                if col.strip().lower() == "sku":
-                    sku_column = col
-                    break
-            if sku_column:
-                file_skus = df_file[sku_column].dropna().astype(str).str.strip()
-                sku_list.extend(file_skus[file_skus != ''].tolist())
+            file_skus = read_sku_column(uploaded_file_obj, uploaded_file_obj.name)
+            if file_skus is not None:
+                sku_list.extend(file_skus)
             else:
                 st.warning("Column 'sku' not found in file.")
 
@@ -276,7 +261,7 @@ def get_sku_list(uploaded_file_obj, manual_text):
 
 
 # ======================================================
-# SECTION: Switzerland (with automatic 2500 SKU batches)
+# SECTION: Switzerland (downloads run in switzerland_engine)
 # ======================================================
 if server_country == "Switzerland":
     st.header("Switzerland Server Image Processing")
@@ -289,6 +274,7 @@ if server_country == "Switzerland":
         - **All Attributes or Grid Context:** (for Grid Context, select ID)
         - **With Codes**
         - **Without Media**
+    - :arrow_right: **More than 10000 sku:** enable **Streaming mode**; images are delivered in ZIP parts.
     """)
 
     # --- RESET BUTTON ---
@@ -306,198 +292,66 @@ if server_country == "Switzerland":
             if key in st.session_state:
                 del st.session_state[key]
         st.session_state.renaming_uploader_key = str(uuid.uuid4())
+        set_current_job(CH_JOB_PARAM, None)
         st.info("Cache cleared. Please re-upload your file.")
         st.rerun()
 
     # INPUTS
     manual_input = st.text_area("Or paste your SKUs here (one per line):", key="manual_input_switzerland")
-    uploaded_file = st.file_uploader("Upload file (Excel or CSV) **Max 10000 sku**", type=["xlsx", "csv"], key=st.session_state.renaming_uploader_key)
-
-    if st.button("Search Images", key="process_switzerland"):
-        st.session_state.renaming_start_processing_ch = True
-        st.session_state.renaming_processing_done_ch = False
-        st.session_state.pop("renaming_zip_path_ch", None)
-        st.session_state.pop("renaming_error_path_ch", None)
-
-    # ======================================================
-    # PROCESSING SECTION (SINCRONO, NO ASYNCIO)
-    # ======================================================
-    if st.session_state.get("renaming_start_processing_ch") and not st.session_state.get("renaming_processing_done_ch", False):
-
-        sku_list = get_sku_list(uploaded_file, manual_input)
+    streaming_mode = st.checkbox(
+        "Streaming mode (no SKU limit)", key="switzerland_streaming",
+        help="The file is read while downloading and images are delivered in ZIP parts of the size below. "
+             "Parts are kept on the server until the job expires: the space used grows with the number of images."
+    )
+    # il limite di 10000 sku vale solo senza streaming
+    uploader_label = "Upload file (Excel or CSV)" if streaming_mode else "Upload file (Excel or CSV) **Max 10000 sku**"
+    uploaded_file = st.file_uploader(uploader_label, type=["xlsx", "csv"], key=st.session_state.renaming_uploader_key)
+    part_mb = DEFAULT_PART_MB
+    if streaming_mode:
+        part_mb = st.number_input("ZIP part size (MB)", min_value=50, max_value=4000, value=DEFAULT_PART_MB, step=50)
 
-        # ======================================================
-        # LIMIT CHECK: MAX 10,000 SKUs
-        # ======================================================
-        MAX_SKU = 10000
-        if sku_list and len(sku_list) > MAX_SKU:
-            st.error(f"Too many SKUs provided: {len(sku_list)}. Maximum allowed is {MAX_SKU}.")
-            st.session_state.renaming_start_processing_ch = False
-            st.stop()
-
-        if not sku_list:
-            st.warning("Please upload a file or paste some SKUs to process.")
-            st.session_state.renaming_start_processing_ch = False
+    job_runner.register(CH_JOB_KIND, run_switzerland_job)
 
+    if st.button("Search Images", key="process_switzerland"):
+        if streaming_mode:
+            manual_skus = [line.strip() for line in (manual_input or "").splitlines() if line.strip()]
+            if uploaded_file is None and not manual_skus:
+                st.warning("Please upload a file or paste some SKUs to process.")
+            else:
+                params = {"label": "Streaming", "skus": manual_skus, "part_mb": int(part_mb)}
+                files = None
+                if uploaded_file is not None:
+                    params.update(label=f"Streaming: {uploaded_file.name}", file_name=uploaded_file.name)
+                    files = {uploaded_file.name: uploaded_file.getvalue()}
+                job_id = job_runner.submit(CH_JOB_KIND, params, files=files, owner=current_owner())
+                set_current_job(CH_JOB_PARAM, job_id)
+                st.rerun()
         else:
-            st.info(f"Total SKUs: {len(sku_list)}")
-            st.info("Batch size: 2500 SKUs per batch")
-
-            # ======================================================
-            # SPLIT INTO BATCHES OF 2500
-            # ======================================================
-            chunk_size = 2500
-            batches = [sku_list[i:i + chunk_size] for i in range(0, len(sku_list), chunk_size)]
-            total_batches = len(batches)
-
-            st.info(f"Number of batches: {total_batches}")
-
-            progress_bar = st.progress(0, text="Preparing...")
-
-            # ======================================================
-            # URL BUILDER
-            # ======================================================
-            def get_image_url(product_code):
-                pharmacode = str(product_code).strip()
-                if pharmacode.upper().startswith("CH"):
-                    pharmacode = pharmacode[2:]
-                return f"https://documedis.hcisolutions.ch/2020-01/api/products/image/PICFRONT3D/Pharmacode/{pharmacode}/F"
+            sku_list = get_sku_list(uploaded_file, manual_input)
 
             # ======================================================
-            # PROCESS IMAGE (CONTROL BLACK ONLY)
+            # LIMIT CHECK: MAX 10,000 SKUs
             # ======================================================
-            def process_and_save(original_sku, content, download_folder):
-                try:
-                    img = Image.open(BytesIO(content))
-                    img = ImageOps.exif_transpose(img)
-
-                    # controllo immagine completamente nera
-                    extrema = img.convert("L").getextrema()
-                    if extrema == (0, 0):
-                        return False
-
-                    img.thumbnail((1000, 1000), Image.LANCZOS)
-
-                    canvas = Image.new("RGB", (1000, 1000), (255, 255, 255))
-                    offset_x = (1000 - img.width) // 2
-                    offset_y = (1000 - img.height) // 2
-                    canvas.paste(img, (offset_x, offset_y))
-
-                    new_filename = f"{original_sku}-h1.jpg"
-                    img_path = os.path.join(download_folder, new_filename)
-                    canvas.save(img_path, "JPEG", quality=75)
-                    return True
-
-                except Exception:
-                    return False
-
-            # ======================================================
-            # DOWNLOAD + PROCESS (SINCRONO) CON RETRY
-            # ======================================================
-            def download_and_process_sku(sku, download_folder, retries=3):
-                url = get_image_url(sku)
-                for attempt in range(retries):
-                    try:
-                        resp = requests.get(url, timeout=30)
-                        if resp.status_code == 200 and resp.content:
-                            ok = process_and_save(sku, resp.content, download_folder)
-                            return sku, ok
-                    except Exception:
-                        pass
-                    time.sleep(0.5 * (attempt + 1))
-                # se arriviamo qui → errore
-                return sku, False
-
-            # ======================================================
-            # MAIN PROCESSING LOOP (BATCH BY BATCH, THREADPOOL)
-            # ======================================================
-            all_errors = []
-
-            with st.spinner("Processing images in batches, please wait..."):
-                with tempfile.TemporaryDirectory() as download_folder:
-
-                    for batch_index, batch_skus in enumerate(batches, start=1):
-
-                        progress_bar.progress(0, text=f"Batch {batch_index}/{total_batches} - starting...")
-
-                        total_in_batch = len(batch_skus)
-                        completed = 0
-
-                        # ThreadPool per il batch corrente
-                        with ThreadPoolExecutor(max_workers=20) as executor:
-                            future_to_sku = {
-                                executor.submit(download_and_process_sku, sku, download_folder): sku
-                                for sku in batch_skus
-                            }
-
-                            for future in as_completed(future_to_sku):
-                                sku, ok = future.result()
-                                if not ok:
-                                    all_errors.append(sku)
-                                completed += 1
-                                frac = completed / total_in_batch
-                                progress_bar.progress(
-                                    frac,
-                                    text=f"Batch {batch_index}/{total_batches} - {completed}/{total_in_batch}"
-                                )
-
-                        st.success(f"Batch {batch_index}/{total_batches} completed")
-
-                    # --- ZIP CREATION ---
-                    if any(os.scandir(download_folder)):
-                        with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp_zip:
-                            zip_path = tmp_zip.name
-                        shutil.make_archive(zip_path[:-4], "zip", download_folder)
-                        st.session_state["renaming_zip_path_ch"] = zip_path
-                    else:
-                        st.session_state["renaming_zip_path_ch"] = None
-
-                    # --- SAVE ERROR CSV ---
-                    if all_errors:
-                        df_errors = pd.DataFrame(sorted(set(all_errors)), columns=["sku"])
-                        with tempfile.NamedTemporaryFile(suffix=".csv", delete=False, mode="w", encoding="utf-8-sig") as tmp_err:
-                            df_errors.to_csv(tmp_err, index=False, sep=";")
-                            st.session_state["renaming_error_path_ch"] = tmp_err.name
-                    else:
-                        st.session_state["renaming_error_path_ch"] = None
-
-            st.session_state["renaming_processing_done_ch"] = True
-            st.session_state.renaming_start_processing_ch = False
+            MAX_SKU = 10000
+            if sku_list and len(sku_list) > MAX_SKU:
+                st.error(f"Too many SKUs provided: {len(sku_list)}. Maximum allowed is {MAX_SKU} (use Streaming mode for more).")
+            elif not sku_list:
+                st.warning("Please upload a file or paste some SKUs to process.")
+            else:
+                job_id = job_runner.submit(
+                    CH_JOB_KIND, {"label": f"{len(sku_list)} SKUs", "skus": sku_list}, owner=current_owner()
+                )
+                set_current_job(CH_JOB_PARAM, job_id)
+                st.rerun()
 
     # ======================================================
-    # DOWNLOAD OUTPUTS
+    # JOB STATUS + DOWNLOAD OUTPUTS (kept for the browser session)
     # ======================================================
-    if st.session_state.get("renaming_processing_done_ch", False):
+    render_recent_jobs(job_runner, CH_JOB_KIND, CH_JOB_PARAM)
+    ch_job_id = current_job_id(CH_JOB_PARAM)
+    if ch_job_id:
         st.markdown("---")
-        col1, col2 = st.columns(2)
-
-        # ZIP
-        with col1:
-            zip_path = st.session_state.get("renaming_zip_path_ch")
-            if zip_path and os.path.exists(zip_path):
-                with open(zip_path, "rb") as f:
-                    st.download_button(
-                        label="Download Images",
-                        data=f,
-                        file_name="switzerland_images.zip",
-                        mime="application/zip"
-                    )
-            else:
-                st.info("No images processed.")
-
-        # ERRORS CSV
-        with col2:
-            err_path = st.session_state.get("renaming_error_path_ch")
-            if err_path and os.path.exists(err_path):
-                with open(err_path, "rb") as f:
-                    st.download_button(
-                        label="Download Missing Image List",
-                        data=f,
-                        file_name="errors_switzerland.csv",
-                        mime="text/csv"
-                    )
-            else:
-                st.info("No errors found.")
+        render_job(job_runner, ch_job_id, key="dl_ch")
 
 
 # ======================================================
@@ -516,6 +370,18 @@ elif server_country == "Farmadati":
         - **Without Media**
     """)
 
+    # === CONFIG: credenziali (WSDL Method 1 e dataset TDZ/TR017 in farmadati_engine / farmadati_queries) ===
+    USERNAME = "BDF250621d"
+    PASSWORD = "wTP1tvSZ"
+
+    # un account per utente Farmadati: executor SOAP (creato dal primo job) + memo per AIC.
+    # Si crea qui, nel thread dello script: il job riceve l'oggetto e non chiama st.cache_resource.
+    @st.cache_resource(show_spinner=False)
+    def get_farmadati_account(username, _password):
+        return FarmadatiAccount(username, _password)
+
+    farmadati_account = get_farmadati_account(USERNAME, PASSWORD)
+
     # --- Reset Button ---
     if st.button("🧹 Clear Cache and Reset Data"):
         keys_to_remove = [
@@ -527,17 +393,18 @@ elif server_country == "Farmadati":
                 "process_images_farmadati"
             ]
         ]
-        if 'get_farmadati_mapping' in globals() and hasattr(get_farmadati_mapping, 'clear'):
-            get_farmadati_mapping.clear()
-        if 'get_farmadati_client' in globals() and hasattr(get_farmadati_client, 'clear'):
-            get_farmadati_client.clear()
-        if 'tr017_has_blocking_manufacturer' in globals() and hasattr(tr017_has_blocking_manufacturer, 'clear'):
-            tr017_has_blocking_manufacturer.clear()
+        # client SOAP + memo: anche il job registrato usa questo oggetto
+        farmadati_account.clear()
+        # anche l'indice locale (TDZ/TR017): il prossimo job rilegge tutto dal web service
+        farmadati_index = get_default_farmadati_index()
+        if farmadati_index is not None:
+            farmadati_index.clear()
 
         for key in keys_to_remove:
             if key in st.session_state:
                 del st.session_state[key]
         st.session_state.renaming_uploader_key = str(uuid.uuid4())
+        set_current_job(FD_JOB_PARAM, None)
         st.info("Cache cleared. Please re-upload your file.")
         st.rerun()
 
@@ -551,399 +418,24 @@ elif server_country == "Farmadati":
         key=st.session_state.renaming_uploader_key
     )
 
+    job_runner.register(FD_JOB_KIND, make_farmadati_job(farmadati_account))
+
     if st.button("Search Images", key="process_farmadati"):
-        st.session_state.renaming_start_processing_fd = True
-        st.session_state.renaming_processing_done_fd = False
-        if "renaming_zip_buffer_fd" in st.session_state:
-            del st.session_state.renaming_zip_buffer_fd
-        if "renaming_error_data_fd" in st.session_state:
-            del st.session_state.renaming_error_data_fd
-
-    if (
-        st.session_state.get("renaming_start_processing_fd")
-        and not st.session_state.get("renaming_processing_done_fd", False)
-    ):
         sku_list_fd = get_sku_list(farmadati_file, manual_input_fd)
         if not sku_list_fd:
             st.warning("Please upload a file or paste some SKUs to process.")
-            st.session_state.renaming_start_processing_fd = False
         else:
-            st.info(f"Processing {len(sku_list_fd)} SKUs for Farmadati...")
-
-            # === CONFIG: credenziali + WSDL Method 1 + dataset TDZ/TR017 ===
-            USERNAME = "BDF250621d"
-            PASSWORD = "wTP1tvSZ"
-            WSDL_URL = "https://webservices.farmadati.it/WS2S/FarmadatiItaliaWebServicesM1.svc?singleWsdl"
-            DATASET_TDZ = "TDZ"
-            DATASET_TR017 = "TR017"
-
-            # ==========================================================
-            # CLIENT SOAP + tipi Filter / ArrayOfFilter (come in Colab)
-            # ==========================================================
-            @st.cache_resource(ttl=3600, show_spinner=False)
-            def get_farmadati_client():
-                """
-                Crea il client SOAP Method 1 e trova dinamicamente i tipi
-                Filter e ArrayOfFilter, come nel codice Colab.
-                """
-                settings = Settings(strict=False, xml_huge_tree=True)
-                client = Client(wsdl=WSDL_URL, settings=settings)
-
-                FilterType = None
-                ArrayOfFilterType = None
-
-                for t in client.wsdl.types.types:
-                    qn = getattr(t, "qname", None)
-                    if qn is None:
-                        continue
-                    if qn.localname == "Filter":
-                        FilterType = t
-                    elif qn.localname == "ArrayOfFilter":
-                        ArrayOfFilterType = t
-
-                if FilterType is None or ArrayOfFilterType is None:
-                    raise RuntimeError(
-                        "Non sono riuscito a trovare i tipi 'Filter' o 'ArrayOfFilter' nel WSDL. "
-                        "Verifica il WSDL o stampa client.wsdl.types per analizzare i tipi disponibili."
-                    )
-
-                return client, FilterType, ArrayOfFilterType
-
-            # ==========================================================
-            # MAPPATURA AIC -> NOME FILE IMMAGINE DA TDZ (FDI_T218 -> FDI_T438)
-            # ==========================================================
-            @st.cache_resource(ttl=3600, show_spinner=False)
-            def get_farmadati_mapping(_username, _password, sku_list):
-                """
-                Per ogni SKU ricava l'AIC (come nel tuo codice),
-                poi interroga TDZ con ExecuteQuery (Method 1)
-                usando FDI_T218 = AIC e legge FDI_T438.
-
-                Restituisce: dict { AIC (senza zeri) : nomefile immagine }.
-                """
-                client, FilterType, ArrayOfFilterType = get_farmadati_client()
-
-                # ricavo gli AIC univoci dalla lista SKU
-                unique_aics = set()
-                for sku in sku_list:
-                    original_sku = str(sku).strip()
-                    clean_sku = original_sku.upper()
-                    if not clean_sku.startswith("IT"):
-                        clean_sku = "IT" + clean_sku.lstrip("0")
-                    else:
-                        clean_sku = "IT" + clean_sku[2:].lstrip("0")
-
-                    aic = clean_sku[2:]  # parte dopo "IT"
-                    aic = aic.lstrip("0")
-                    if aic:
-                        unique_aics.add(aic)
-
-                code_to_image = {}
-
-                for aic in unique_aics:
-                    filtro_obj = FilterType(
-                        Key="FDI_T218",
-                        Operator="=",
-                        OrGroup=0,
-                        Value=aic
-                    )
-                    filtri = ArrayOfFilterType(Filter=[filtro_obj])
-
-                    try:
-                        result = client.service.ExecuteQuery(
-                            Username=_username,
-                            Password=_password,
-                            CodiceSetDati=DATASET_TDZ,
-                            CampiDaEstrarre=["FDI_T438"],
-                            Filtri=filtri,
-                            Ordinamento=None,
-                            Distinct=False,
-                            Count=False,
-                            PageN=1,
-                            PagingN=100
-                        )
-                    except Exception:
-                        continue
-
-                    if result.CodEsito != "OK":
-                        continue
-
-                    if result.OutputValue == "EMPTY":
-                        continue
-
-                    try:
-                        df = pd.read_xml(io.StringIO(result.OutputValue))
-                    except Exception:
-                        continue
-
-                    if "FDI_T438" not in df.columns:
-                        continue
-
-                    img_values = df["FDI_T438"].dropna().unique().tolist()
-                    if img_values:
-                        code_to_image[aic] = img_values[0]
-
-                return code_to_image
-
-            # ==========================================================
-            # CONTROLLO TR017: BLOCCA PRODUTTORI 2769, 6681, 088H, 6832
-            # (FDI_T139 -> FDI_T142)
-            # ==========================================================
-            @st.cache_resource(ttl=3600, show_spinner=False)
-            def tr017_has_blocking_manufacturer(aic: str) -> bool:
-                """
-                Cerca l'AIC nel campo FDI_T139 di TR017 e controlla FDI_T142.
-                Se FDI_T142 contiene uno dei codici 2769, 6681, 088H, 6832
-                restituisce True (download vietato).
-                """
-                client, FilterType, ArrayOfFilterType = get_farmadati_client()
-                filtro_obj = FilterType(
-                    Key="FDI_T139",
-                    Operator="=",
-                    OrGroup=0,
-                    Value=aic
-                )
-                filtri = ArrayOfFilterType(Filter=[filtro_obj])
-
-                try:
-                    result = client.service.ExecuteQuery(
-                        Username=USERNAME,
-                        Password=PASSWORD,
-                        CodiceSetDati=DATASET_TR017,
-                        CampiDaEstrarre=["FDI_T142"],
-                        Filtri=filtri,
-                        Ordinamento=None,
-                        Distinct=False,
-                        Count=False,
-                        PageN=1,
-                        PagingN=50
-                    )
-                except Exception:
-                    # in caso di errore, lascio passare (False) per non bloccare tutto
-                    return False
-
-                if result.CodEsito != "OK":
-                    return False
-
-                if result.OutputValue == "EMPTY":
-                    return False
-
-                try:
-                    df = pd.read_xml(io.StringIO(result.OutputValue))
-                except Exception:
-                    return False
-
-                if "FDI_T142" not in df.columns:
-                    return False
-
-                blocked_codes = {"2769", "6681", "088H", "6832"}
-
-                for val in df["FDI_T142"].dropna().astype(str):
-                    for code in blocked_codes:
-                        if code in val:
-                            return True
-
-                return False
-
-            # ==========================================================
-            # FUNZIONE DI PROCESSING IMMAGINI (come nel tuo codice)
-            # ==========================================================
-            def process_image_fd(img_bytes):
-                try:
-                    try:
-                        img = Image.open(BytesIO(img_bytes))
-                    except UnidentifiedImageError:
-                        content_str = img_bytes.decode('utf-8', errors='ignore')
-                        if "System.Web.HttpException" in content_str or "ASP.NET" in content_str:
-                            raise ValueError("ASPX error page received instead of image")
-                        else:
-                            raise ValueError("Unknown image format")
-
-                    if img.mode not in ('RGB', 'L'):
-                        img = img.convert('RGB')
-
-                    if img.mode == 'L':
-                        extrema = img.getextrema()
-                    else:
-                        gray = img.convert('L')
-                        extrema = gray.getextrema()
-
-                    if extrema == (0, 0) or extrema == (255, 255):
-                        raise ValueError("Empty/blank image")
-
-                    img = ImageOps.exif_transpose(img)
-
-                    bg = Image.new(img.mode, img.size, (255, 255, 255))
-                    diff = ImageChops.difference(img, bg)
-                    bbox = diff.getbbox()
-                    if bbox:
-                        img = img.crop(bbox)
-
-                    if img.width == 0 or img.height == 0:
-                        raise ValueError("Empty image after trimming")
-
-                    img.thumbnail((1000, 1000), Image.LANCZOS)
-
-                    canvas = Image.new("RGB", (1000, 1000), (255, 255, 255))
-                    offset = ((1000 - img.width) // 2, (1000 - img.height) // 2)
-                    canvas.paste(img, offset)
-
-                    buffer = BytesIO()
-                    canvas.save(buffer, "JPEG", quality=95)
-                    buffer.seek(0)
-                    return buffer
-                except Exception as e:
-                    raise RuntimeError(f"Image processing failed: {str(e)}")
-
-            # ==========================================================
-            # MAIN PROCESSING: ora con controllo TR017 prima del download
-            # ==========================================================
-            try:
-                with st.spinner("Loading Farmadati mapping (this may take a minute)..."):
-                    aic_to_image = get_farmadati_mapping(USERNAME, PASSWORD, sku_list_fd)
-
-                if not aic_to_image:
-                    st.error("Farmadati mapping failed (no mapping entries).")
-                    st.session_state.renaming_start_processing_fd = False
-                else:
-                    total_fd = len(sku_list_fd)
-                    progress_bar_fd = st.progress(
-                        0,
-                        text="Starting Farmadati processing..."
-                    )
-                    error_list_fd = []
-                    processed_files_count = 0
-                    zip_buffer = BytesIO()
-
-                    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-                        with requests.Session() as http_session:
-                            for i, sku in enumerate(sku_list_fd):
-                                progress_bar_fd.progress(
-                                    (i + 1) / total_fd,
-                                    text=f"Processing {sku} ({i + 1}/{total_fd})"
-                                )
-                                original_sku = str(sku).strip()
-
-                                clean_sku = original_sku.upper()
-                                if not clean_sku.startswith("IT"):
-                                    clean_sku = "IT" + clean_sku.lstrip("0")
-                                else:
-                                    clean_sku = "IT" + clean_sku[2:].lstrip("0")
-
-                                if not clean_sku[2:]:
-                                    error_list_fd.append(
-                                        (original_sku, "Invalid AIC (empty after IT)")
-                                    )
-                                    continue
-
-                                # AIC senza "IT", senza zeri
-                                aic_key = clean_sku[2:].lstrip("0")
-
-                                # --- NUOVO PASSO: controllo TR017 / FDI_T139 / FDI_T142 ---
-                                if tr017_has_blocking_manufacturer(aic_key):
-                                    error_list_fd.append(
-                                        (original_sku, "Download not allowed")
-                                    )
-                                    continue
-
-                                # mappa TDZ: AIC -> nome file immagine
-                                image_name = aic_to_image.get(aic_key)
-                                if not image_name:
-                                    error_list_fd.append(
-                                        (original_sku, "AIC not in mapping")
-                                    )
-                                    continue
-
-                                image_url = (
-                                    "https://ws.farmadati.it/WS_DOC/GetDoc.aspx"
-                                    f"?accesskey={PASSWORD}&tipodoc=Z&nomefile={requests.utils.quote(image_name)}"
-                                )
-
-                                try:
-                                    response = http_session.get(image_url, timeout=45)
-                                    response.raise_for_status()
-
-                                    content_type = response.headers.get(
-                                        "Content-Type", ""
-                                    ).lower()
-                                    if "text/html" in content_type or "text/plain" in content_type:
-                                        if "System.Web.HttpException" in response.text:
-                                            raise ValueError("ASPX error page received")
-
-                                    if not response.content:
-                                        raise ValueError("Empty response")
-
-                                    processed_buffer = process_image_fd(response.content)
-                                    output_filename = f"{clean_sku}-h1.jpg"
-                                    zipf.writestr(output_filename, processed_buffer.read())
-                                    processed_files_count += 1
-
-                                except requests.exceptions.RequestException as req_e:
-                                    reason = f"Network Error: {req_e}"
-                                    if hasattr(req_e, "response") and req_e.response is not None:
-                                        reason = f"HTTP {req_e.response.status_code}"
-                                    error_list_fd.append((original_sku, reason))
-                                except Exception as e:
-                                    error_list_fd.append(
-                                        (original_sku, f"Error: {str(e)}")
-                                    )
-
-                    progress_bar_fd.progress(
-                        1.0,
-                        text="Farmadati processing complete!"
-                    )
+            job_id = job_runner.submit(
+                FD_JOB_KIND, {"label": f"{len(sku_list_fd)} SKUs", "skus": sku_list_fd}, owner=current_owner()
+            )
+            set_current_job(FD_JOB_PARAM, job_id)
+            st.rerun()
 
-                    if processed_files_count > 0:
-                        zip_buffer.seek(0)
-                        st.session_state["renaming_zip_buffer_fd"] = zip_buffer
-                    else:
-                        st.session_state["renaming_zip_buffer_fd"] = None
-
-                    if error_list_fd:
-                        error_df = pd.DataFrame(error_list_fd, columns=["SKU", "Reason"])
-                        error_df = error_df.drop_duplicates().sort_values(by="SKU")
-                        csv_error = error_df.to_csv(
-                            index=False,
-                            sep=";",
-                            encoding="utf-8-sig"
-                        ).encode("utf-8-sig")
-                        st.session_state["renaming_error_data_fd"] = csv_error
-                    else:
-                        st.session_state["renaming_error_data_fd"] = None
-
-            except Exception as critical_e:
-                st.error(f"Critical Error during Farmadati processing: {critical_e}")
-
-            st.session_state["renaming_processing_done_fd"] = True
-            st.session_state.renaming_start_processing_fd = False
-
-    if st.session_state.get("renaming_processing_done_fd"):
+    render_recent_jobs(job_runner, FD_JOB_KIND, FD_JOB_PARAM)
+    fd_job_id = current_job_id(FD_JOB_PARAM)
+    if fd_job_id:
         st.markdown("---")
-        col1_fd_dl, col2_fd_dl = st.columns(2)
-        with col1_fd_dl:
-            zip_data = st.session_state.get("renaming_zip_buffer_fd")
-            if zip_data:
-                st.download_button(
-                    "Download Images (ZIP)",
-                    data=zip_data,
-                    file_name=f"farmadati_images_{st.session_state.renaming_session_id[:6]}.zip",
-                    mime="application/zip",
-                    key="dl_fd_zip"
-                )
-            else:
-                st.info("No images processed.")
-        with col2_fd_dl:
-            error_data = st.session_state.get("renaming_error_data_fd")
-            if error_data:
-                st.download_button(
-                    "Download Error List",
-                    data=error_data,
-                    file_name=f"errors_farmadati_{st.session_state.renaming_session_id[:6]}.csv",
-                    mime="text/csv",
-                    key="dl_fd_err"
-                )
-            else:
-                st.info("No errors found.")
+        render_job(job_runner, fd_job_id, key="dl_fd")
 
 
 
@@ -1444,14 +936,7 @@ elif server_country == "Medipim":
 
         if uploaded_file is not None:
             try:
-                if uploaded_file.name.lower().endswith(".csv"):
-                    df = pd.read_csv(uploaded_file, dtype=str)
-                else:
-                    df = pd.read_excel(uploaded_file, engine="openpyxl")
-                df.columns = [c.lower().strip() for c in df.columns]
-                if "sku" in df.columns:
-                    ex_skus = df["sku"].astype(str).map(lambda x: x.strip()).tolist()
-                    skus.extend([x for x in ex_skus if x])
+                skus.extend(read_sku_column(uploaded_file, uploaded_file.name) or [])
             except Exception as e:
                 st.error(f"Failed to read uploaded file: {e}")
 
@@ -1530,12 +1015,10 @@ elif server_country == "Medipim":
     # ===============================
     @st.cache_data(show_spinner=False, ttl=24*3600, max_entries=10000)
     def _fetch_url_cached(url: str) -> Optional[bytes]:
-        """Download and cache image bytes by URL (24h cache)."""
+        """Download and cache image bytes by URL (24h in-process cache, backed by the persistent disk cache)."""
         try:
-            r = requests.get(url, timeout=15)
-            if r.status_code != 200 or not r.content:
-                return None
-            return r.content
+            content, _status = fetch_with_cache(requests, url, get_default_cache(), timeout=15)
+            return content
         except Exception:
             return None
 
@@ -0,0 +1,142 @@
+# Cheap rejection of placeholder images (Switzerland and Farmadati downloads)
+#
+# The servers answer some products with an all-black or all-white image
+# instead of a 404. Two checks reject them before any full-size decode:
+#
+#   - PlaceholderIndex: sha256 of image bodies already rejected. Placeholders
+#     are byte-identical across products, so after the first rejection the
+#     next ones cost a hash and a dict lookup. Persisted in SQLite next to
+#     the image cache, so the index survives restarts.
+#   - detect_blank: decodes a reduced draft (JPEG DCT scaling, 1/8 size or
+#     less, luminance only) and checks its extrema instead of converting the
+#     full-size image.
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from io import BytesIO
+from collections import Counter
+from typing import Dict, Optional
+
+from PIL import Image
+
+from image_cache import DEFAULT_CACHE_DIR
+
+BLANK_BLACK = "black"
+BLANK_WHITE = "white"
+DRAFT_EDGE = 64
+
+
+class PlaceholderRejected(ValueError):
+    """Raised for an image rejected as placeholder; `kind` is black/white, `known` tells a hash hit."""
+
+    def __init__(self, kind: str, known: bool = False):
+        super().__init__(f"Empty/blank image ({kind}{', known placeholder' if known else ''})")
+        self.kind = kind
+        self.known = known
+
+    @property
+    def label(self) -> str:
+        return f"known {self.kind}" if self.known else self.kind
+
+
+def image_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def detect_blank(data: bytes, draft_edge: int = DRAFT_EDGE) -> Optional[str]:
+    """BLANK_BLACK / BLANK_WHITE when the image is a single flat black or white, else None."""
+    img = Image.open(BytesIO(data))
+    # JPEG only: decode at a reduced scale, at least draft_edge pixels per side.
+    img.draft("L", (draft_edge, draft_edge))
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    extrema = img.convert("L").getextrema()
+    if extrema == (0, 0):
+        return BLANK_BLACK
+    if extrema == (255, 255):
+        return BLANK_WHITE
+    return None
+
+
+class PlaceholderIndex:
+    """Digests of image bodies rejected as placeholders, kept in memory and in SQLite."""
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR):
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "placeholders.sqlite3"), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS placeholders ("
+            " digest TEXT PRIMARY KEY, kind TEXT NOT NULL, size INTEGER NOT NULL, first_seen REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._known: Dict[str, str] = dict(self._db.execute("SELECT digest, kind FROM placeholders").fetchall())
+
+    def lookup(self, digest: str) -> Optional[str]:
+        return self._known.get(digest)
+
+    def add(self, digest: str, kind: str, size: int = 0):
+        with self._lock:
+            if digest in self._known:
+                return
+            self._known[digest] = kind
+            self._db.execute(
+                "INSERT OR IGNORE INTO placeholders (digest, kind, size, first_seen) VALUES (?, ?, ?, ?)",
+                (digest, kind, size, time.time()),
+            )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._known.clear()
+            self._db.execute("DELETE FROM placeholders")
+            self._db.commit()
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+
+def check_placeholder(data: bytes, index: Optional["PlaceholderIndex"], reject=(BLANK_BLACK, BLANK_WHITE)):
+    """Raise PlaceholderRejected for a known or detected placeholder of one of the `reject` kinds."""
+    digest = image_digest(data) if index is not None else None
+    if digest is not None:
+        kind = index.lookup(digest)
+        if kind in reject:
+            raise PlaceholderRejected(kind, known=True)
+    kind = detect_blank(data)
+    if kind in reject:
+        if digest is not None:
+            index.add(digest, kind, len(data))
+        raise PlaceholderRejected(kind)
+
+
+def rejection_summary(counts: Counter) -> str:
+    """Run report line, e.g. "Placeholder rejections: 12 black, 30 known black"."""
+    if not counts:
+        return "Placeholder rejections: none."
+    return "Placeholder rejections: " + ", ".join(f"{n} {label}" for label, n in counts.most_common()) + "."
+
+
+_default_index: Optional[PlaceholderIndex] = None
+_default_index_lock = threading.Lock()
+
+
+def get_default_placeholder_index() -> Optional[PlaceholderIndex]:
+    """
+    Process-wide index next to the image cache: PDM_PLACEHOLDER_INDEX ("off"
+    disables it) and PDM_IMAGE_CACHE_DIR.
+    """
+    global _default_index
+    if os.environ.get("PDM_PLACEHOLDER_INDEX", "on").lower() in ("off", "0", "false", "no"):
+        return None
+    with _default_index_lock:
+        if _default_index is None:
+            try:
+                _default_index = PlaceholderIndex(root=os.environ.get("PDM_IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR))
+            except (OSError, sqlite3.Error):
+                return None
+        return _default_index
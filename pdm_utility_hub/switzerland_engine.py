@@ -0,0 +1,553 @@
+# Switzerland engine: image download for the Repository page (HCI documedis)
+#
+# Independent of Streamlit, like bundle_engine.py: the page registers
+# run_switzerland_job with the job runner and everything user-facing goes
+# through the job context (info / success / warning / error / progress /
+# check_cancelled).
+#
+# Downloads run on one pooled aiohttp session (keep-alive to
+# documedis.hcisolutions.ch instead of a new TLS handshake per SKU) with a
+# sliding window: a new SKU starts as soon as one finishes, there are no
+# batch barriers. The window size follows AIMD (additive increase,
+# multiplicative decrease) on the observed latency and error rate.
+#
+# Image work (decode, black check, resize, JPEG encode) is CPU-bound and runs
+# in a process pool, not on the event loop or the I/O side:
+#
+#   fetch window --> bounded queue --> process pool --> ZIP
+#
+# When the queue is full the window stops starting downloads, so memory
+# holds at most window + queue + workers images regardless of the SKU count.
+#
+# Images are written straight into the ZIP (no temporary images folder) and
+# failures are appended to the error CSV as they happen. In streaming mode
+# the SKUs are read lazily from the uploaded file and the ZIP rolls over into
+# parts of a configurable size, each published as soon as it is complete, so
+# there is no cap on the number of SKUs.
+#
+# What does NOT stay bounded: finished parts are job artifacts, kept in the
+# job folder until the job expires (job_runner purge), so the disk used grows
+# with the size of the output (the same as the single ZIP of the normal
+# mode, only split). The duplicate filter keeps every SKU seen (O(n) strings,
+# roughly 10 MB per 100k SKUs); a bounded filter would let far-apart
+# duplicates through and write them twice.
+#
+# Retries depend on the cause: a 404 is final (the pharmacode has no image),
+# while timeouts, network errors, 429 and 5xx are re-queued after a jittered
+# backoff. A waiting retry holds no window slot; the error CSV records the
+# final reason of every SKU.
+#
+# Black placeholders are rejected cheaply (placeholder_filter.py): bodies
+# already known as placeholders are dropped by hash before reaching the pool,
+# and the pool checks a reduced draft decode before the full-size work.
+
+import os
+import time
+import heapq
+import random
+import asyncio
+import zipfile
+import threading
+import multiprocessing
+import csv
+import codecs
+from io import BytesIO, StringIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import aiohttp
+from PIL import Image, ImageOps
+
+from akeneo_loader import iter_column
+from bundle_imaging import default_image_workers
+from http_pool import DEFAULT_LIMIT_PER_HOST, ConnectionStats, HttpPoolSettings, create_client_session
+from image_cache import DiskImageCache, get_default_cache, fetch_with_cache_async
+from placeholder_filter import (
+    BLANK_BLACK, PlaceholderIndex, detect_blank, get_default_placeholder_index, image_digest, rejection_summary
+)
+
+SWISS_JOB_KIND = "switzerland"
+SWISS_IMAGE_URL = "https://documedis.hcisolutions.ch/2020-01/api/products/image/PICFRONT3D/Pharmacode/{}/F"
+DEFAULT_REQUEST_TIMEOUT = 30.0
+DEFAULT_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+CANCEL_CHECK_SECONDS = 1.0
+# Downloaded images waiting for a worker, per worker.
+QUEUE_PER_WORKER = 4
+ZIP_FILE_NAME = "switzerland_images.zip"
+ERRORS_FILE_NAME = "errors_switzerland.csv"
+DEFAULT_PART_MB = 500
+BLACK_IMAGE_REASON = "Black image"
+
+
+def get_image_url(product_code) -> str:
+    pharmacode = str(product_code).strip()
+    if pharmacode.upper().startswith("CH"):
+        pharmacode = pharmacode[2:]
+    return SWISS_IMAGE_URL.format(pharmacode)
+
+
+def process_image(content: bytes) -> Tuple[Optional[bytes], Optional[str]]:
+    """(square 1000x1000 JPEG on white, None) or (None, reason) for rejected images (runs in the pool)."""
+    try:
+        # controllo immagine completamente nera (on a reduced draft, see placeholder_filter)
+        if detect_blank(content) == BLANK_BLACK:
+            return None, BLACK_IMAGE_REASON
+
+        img = Image.open(BytesIO(content))
+        img = ImageOps.exif_transpose(img)
+
+        img.thumbnail((1000, 1000), Image.LANCZOS)
+
+        canvas = Image.new("RGB", (1000, 1000), (255, 255, 255))
+        offset_x = (1000 - img.width) // 2
+        offset_y = (1000 - img.height) // 2
+        canvas.paste(img, (offset_x, offset_y))
+
+        buffer = BytesIO()
+        canvas.save(buffer, "JPEG", quality=75)
+        return buffer.getvalue(), None
+
+    except Exception as e:
+        return None, f"Unreadable image: {e}"
+
+
+class RollingZipSink:
+    """
+    ZIP writer for the processed images. With part_bytes set, a new part
+    (<stem>_part001.zip, ...) starts once that many bytes went into the
+    current one, and every finished part is passed to on_part(path, number).
+    Without it everything goes into a single <stem>.zip. Safe to call from
+    worker threads.
+    """
+
+    def __init__(self, file_name: str, open_stream: Callable[[str], object], path_of: Callable[[str], str],
+                 part_bytes: Optional[int] = None, on_part: Optional[Callable[[str, int], None]] = None):
+        self.stem = file_name[:-4] if file_name.endswith(".zip") else file_name
+        self.open_stream = open_stream
+        self.path_of = path_of
+        self.part_bytes = part_bytes
+        self.on_part = on_part
+        self.parts: List[str] = []
+        self.files = 0
+        self._lock = threading.Lock()
+        self._number = 0
+        self._stream = None
+        self._zip = None
+        self._name = None
+        self._part_files = 0
+        self._part_size = 0
+
+    def _open_next(self):
+        self._number += 1
+        self._name = f"{self.stem}_part{self._number:03d}.zip" if self.part_bytes else f"{self.stem}.zip"
+        self._stream = self.open_stream(self._name)
+        # JPEGs are already compressed: store them.
+        self._zip = zipfile.ZipFile(self._stream, "w", zipfile.ZIP_STORED)
+        self._part_files = 0
+        self._part_size = 0
+
+    def _close_current(self):
+        if self._zip is None:
+            return
+        self._zip.close()
+        self._stream.close()
+        path = self.path_of(self._name)
+        self._zip = self._stream = None
+        if not self._part_files:
+            os.remove(path)
+            return
+        self.parts.append(path)
+        if self.on_part is not None:
+            self.on_part(path, self._number)
+
+    def write(self, arcname: str, data: bytes):
+        with self._lock:
+            if self._zip is None:
+                self._open_next()
+            self._zip.writestr(arcname, data)
+            self._part_files += 1
+            self._part_size += len(data)
+            self.files += 1
+            if self.part_bytes and self._part_size >= self.part_bytes:
+                self._close_current()
+
+    def close(self) -> List[str]:
+        with self._lock:
+            self._close_current()
+        return self.parts
+
+
+class ErrorCsvLog:
+    """Error CSV (';' separated, UTF-8 with BOM) appended as failures happen."""
+
+    def __init__(self, stream, flush_every: int = 100):
+        self._stream = stream
+        self._lock = threading.Lock()
+        self.flush_every = flush_every
+        self.count = 0
+        self._stream.write(codecs.BOM_UTF8)
+        self._write_row(["sku", "reason"])
+
+    def _write_row(self, row: List[str]):
+        line = StringIO()
+        csv.writer(line, delimiter=";", lineterminator="\n").writerow(row)
+        self._stream.write(line.getvalue().encode("utf-8"))
+
+    def write(self, sku: str, reason: str):
+        with self._lock:
+            self._write_row([sku, reason])
+            self.count += 1
+            if self.count % self.flush_every == 0:
+                self._stream.flush()
+
+    def close(self) -> int:
+        with self._lock:
+            self._stream.close()
+        return self.count
+
+
+class AimdLimiter:
+    """
+    Concurrency window for the downloads. Every window's worth of fast
+    answers adds one slot; a failure (timeout, 5xx, 429) or an answer slower
+    than target_latency halves the window, at most once per window so a burst
+    of failures from the same round counts once. The window never exceeds
+    the connector's per-host limit (http_pool settings) unless `maximum` is
+    given: slots beyond it would only queue for a connection.
+    """
+
+    def __init__(self, initial: int = 8, minimum: int = 2, maximum: Optional[int] = None, target_latency: float = 3.0):
+        if maximum is None:
+            settings = HttpPoolSettings.from_env()
+            # 0 = no limit in aiohttp: fall back to the total limit, then to the default
+            maximum = settings.limit_per_host or settings.limit or DEFAULT_LIMIT_PER_HOST
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self._limit = float(max(minimum, min(maximum, initial)))
+        self._since_decrease = 0
+        self.peak = int(self._limit)
+        self.decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def on_success(self, latency: float):
+        if latency > self.target_latency:
+            self.on_failure()
+            return
+        self._since_decrease += 1
+        self._limit = min(self.maximum, self._limit + 1.0 / self._limit)
+        self.peak = max(self.peak, self.limit)
+
+    def on_failure(self):
+        self._since_decrease += 1
+        if self._since_decrease < self.limit:
+            return
+        previous = self.limit
+        self._limit = max(self.minimum, self._limit / 2)
+        self._since_decrease = 0
+        if self.limit < previous:
+            self.decreases += 1
+
+    def summary(self) -> str:
+        return f"Concurrency: final {self.limit}, peak {self.peak}, {self.decreases} back-offs."
+
+
+class SwissRunResult:
+    def __init__(self, error_log: ErrorCsvLog):
+        self.saved = 0
+        self.failed = 0
+        self.error_log = error_log
+        self.processed = 0
+        self.elapsed = 0.0
+        self.workers = 0
+        self.process_seconds = 0.0
+        self.backpressure_waits = 0
+        self.retries = 0
+        self.reasons: Counter = Counter()
+        self.rejections: Counter = Counter()
+
+    def record(self, sku: str, reason: Optional[str] = None):
+        """Final outcome of a SKU: saved when reason is None."""
+        self.processed += 1
+        if reason is None:
+            self.saved += 1
+        else:
+            self.failed += 1
+            self.reasons[reason] += 1
+            self.error_log.write(sku, reason)
+
+    @property
+    def rate(self) -> float:
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"{self.processed} SKUs in {self.elapsed:.1f}s ({self.rate:.1f} SKUs/s): "
+            f"{self.saved} images saved, {self.failed} without image."
+        )
+
+    def reasons_summary(self) -> str:
+        top = ", ".join(f"{reason}: {count}" for reason, count in self.reasons.most_common(5))
+        return f"Retries scheduled: {self.retries}. Failures by reason: {top or 'none'}."
+
+    def pipeline_summary(self) -> str:
+        where = f"{self.workers} worker processes" if self.workers else "threads"
+        return (
+            f"Image processing: {self.process_seconds:.1f}s in {where}; "
+            f"downloads paused {self.backpressure_waits} times waiting for a free queue slot."
+        )
+
+
+def retry_delay(attempt: int) -> float:
+    """Jittered exponential backoff before retry number `attempt` (1-based)."""
+    return random.uniform(0.5, 1.0) * min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (attempt - 1)))
+
+
+async def _fetch_once(session, sku: str, attempt: int, cache: Optional[DiskImageCache],
+                      limiter: AimdLimiter) -> Tuple[str, int, Optional[bytes], Optional[str], bool]:
+    """One request: (sku, attempt, content, failure reason, retryable). Never sleeps."""
+    start = time.monotonic()
+    try:
+        content, status = await fetch_with_cache_async(session, get_image_url(sku), cache)
+    except asyncio.TimeoutError:
+        limiter.on_failure()
+        return sku, attempt, None, "Timeout", True
+    except aiohttp.ClientError as e:
+        limiter.on_failure()
+        return sku, attempt, None, f"Network error: {type(e).__name__}", True
+    except Exception as e:
+        # Anything else (bad URL, cache I/O...) fails this SKU only: it goes to the error CSV, not the job.
+        return sku, attempt, None, f"Unexpected error: {type(e).__name__}: {e}", False
+    if status >= 500 or status == 429:
+        limiter.on_failure()
+        return sku, attempt, None, f"HTTP {status}", True
+    limiter.on_success(time.monotonic() - start)
+    if status == 404:
+        return sku, attempt, None, "Not found (HTTP 404)", False
+    if status != 200:
+        return sku, attempt, None, f"HTTP {status}", False
+    if not content:
+        return sku, attempt, None, "Empty response", False
+    return sku, attempt, content, None, False
+
+
+async def _process_images(queue: asyncio.Queue, executor: Optional[ProcessPoolExecutor], sink: RollingZipSink,
+                          result: SwissRunResult, placeholders: Optional[PlaceholderIndex], on_done):
+    """Consumer: known placeholders dropped by hash, image work in the pool, ZIP write in a thread; None ends it."""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        try:
+            if item is None:
+                return
+            sku, content = item
+            digest = image_digest(content) if placeholders is not None else None
+            if digest is not None and placeholders.lookup(digest) == BLANK_BLACK:
+                result.rejections[f"known {BLANK_BLACK}"] += 1
+                result.record(sku, f"{BLACK_IMAGE_REASON} (known placeholder)")
+                on_done()
+                continue
+            start = time.monotonic()
+            outcome = None
+            if executor is not None:
+                try:
+                    outcome = await loop.run_in_executor(executor, process_image, content)
+                except BrokenProcessPool:
+                    # A crashed worker takes the pool down: finish the run in threads.
+                    executor = None
+            if executor is None:
+                outcome = await asyncio.to_thread(process_image, content)
+            jpeg, reason = outcome
+            result.process_seconds += time.monotonic() - start
+            if reason == BLACK_IMAGE_REASON:
+                result.rejections[BLANK_BLACK] += 1
+                if digest is not None:
+                    await asyncio.to_thread(placeholders.add, digest, BLANK_BLACK, len(content))
+            if jpeg is not None:
+                await asyncio.to_thread(sink.write, f"{sku}-h1.jpg", jpeg)
+            result.record(sku, reason)
+            on_done()
+        finally:
+            queue.task_done()
+
+
+async def download_switzerland_async(skus: Iterable[str], total: int, sink: RollingZipSink, error_log: ErrorCsvLog,
+                                     reporter,
+                                     limiter: Optional[AimdLimiter] = None,
+                                     cache: Optional[DiskImageCache] = None,
+                                     request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+                                     attempts: int = DEFAULT_ATTEMPTS,
+                                     image_workers: Optional[int] = None,
+                                     placeholders: Optional[PlaceholderIndex] = None) -> SwissRunResult:
+    """
+    Download every SKU through a sliding AIMD window and process the images
+    in a process pool. Retryable failures wait in a delay heap (ready time,
+    sequence, sku, attempt) and re-enter the window before new SKUs.
+    """
+    limiter = limiter or AimdLimiter()
+    stats = ConnectionStats()
+    result = SwissRunResult(error_log)
+    result.workers = default_image_workers() if image_workers is None else max(0, int(image_workers))
+    consumers = max(1, result.workers)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=consumers * QUEUE_PER_WORKER)
+    sku_iter = iter(skus)
+    exhausted = False
+    pending = set()
+    delayed: List[Tuple[float, int, str, int]] = []
+    delayed_seq = 0
+    start = time.monotonic()
+    last_cancel_check = start
+
+    def report_progress():
+        reporter.progress(
+            result.processed / total if total else 1.0,
+            text=f"{result.processed}/{total} SKUs – window {limiter.limit}"
+        )
+
+    executor = None
+    if result.workers > 0:
+        # spawn: the Streamlit server is multi-threaded, forking it is unsafe
+        executor = ProcessPoolExecutor(max_workers=result.workers, mp_context=multiprocessing.get_context("spawn"))
+    workers = [
+        asyncio.create_task(_process_images(queue, executor, sink, result, placeholders, report_progress))
+        for _ in range(consumers)
+    ]
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    try:
+        async with create_client_session(stats=stats, timeout=timeout) as session:
+            while True:
+                now = time.monotonic()
+                while len(pending) < limiter.limit:
+                    if delayed and delayed[0][0] <= now:
+                        _, _, sku, attempt = heapq.heappop(delayed)
+                    elif not exhausted:
+                        sku, attempt = next(sku_iter, None), 1
+                        if sku is None:
+                            exhausted = True
+                            continue
+                    else:
+                        break
+                    pending.add(asyncio.create_task(_fetch_once(session, sku, attempt, cache, limiter)))
+                if not pending and not delayed:
+                    break
+                # Wake up for the next finished download or the next due retry, whichever comes first.
+                wait_for = max(0.0, delayed[0][0] - now) if delayed else None
+                if not pending:
+                    await asyncio.sleep(wait_for)
+                    continue
+                done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    sku, attempt, content, reason, retryable = task.result()
+                    if retryable and attempt < attempts:
+                        result.retries += 1
+                        delayed_seq += 1
+                        heapq.heappush(delayed, (time.monotonic() + retry_delay(attempt), delayed_seq, sku, attempt + 1))
+                        continue
+                    if content is None:
+                        result.record(sku, reason)
+                        continue
+                    if queue.full():
+                        # Backpressure: no new downloads start until a worker frees a slot.
+                        result.backpressure_waits += 1
+                    await queue.put((sku, content))
+                report_progress()
+                now = time.monotonic()
+                if now - last_cancel_check >= CANCEL_CHECK_SECONDS:
+                    last_cancel_check = now
+                    reporter.check_cancelled()
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in list(pending) + workers:
+            task.cancel()
+        await asyncio.gather(*pending, *workers, return_exceptions=True)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    result.elapsed = time.monotonic() - start
+    reporter.info(limiter.summary())
+    reporter.info(result.pipeline_summary())
+    reporter.info(result.reasons_summary())
+    reporter.info(rejection_summary(result.rejections))
+    reporter.info(stats.summary())
+    return result
+
+
+def iter_job_skus(ctx) -> Iterator[str]:
+    """Pasted SKUs first, then the uploaded file read lazily; duplicates dropped (O(n) set, see header)."""
+    seen = set()
+    sources = [iter(ctx.params.get("skus") or [])]
+    if ctx.params.get("file_name"):
+        sources.append(iter_column(ctx.open_input(ctx.params["file_name"]), ctx.params["file_name"], "sku"))
+    for source in sources:
+        for sku in source:
+            if sku and sku not in seen:
+                seen.add(sku)
+                yield sku
+
+
+def run_switzerland_job(ctx):
+    """
+    Job handler. Params: "skus" (pasted list) and, in streaming mode,
+    "file_name" (uploaded input read lazily) and "part_mb" (ZIP part size).
+    """
+    part_mb = ctx.params.get("part_mb")
+    try:
+        # Counting pass (streamed, nothing kept) so the progress bar has a total.
+        total = sum(1 for _ in iter_job_skus(ctx))
+    except ValueError as e:
+        ctx.error(str(e))
+        return
+    ctx.info(f"Total SKUs: {total}")
+    if part_mb:
+        ctx.info(
+            f"Streaming mode: ZIP parts of {part_mb} MB. Finished parts stay on the server until the job expires, "
+            "so the space used grows with the number of images."
+        )
+
+    def publish_part(path: str, number: int):
+        ctx.add_artifact(
+            f"zip_part{number:03d}", path, f"Download Images (part {number})",
+            os.path.basename(path), "application/zip"
+        )
+        ctx.info(f"ZIP part {number} is ready.")
+
+    sink = RollingZipSink(
+        ZIP_FILE_NAME, ctx.open_output, ctx.output_path,
+        part_bytes=int(part_mb * 1024 * 1024) if part_mb else None,
+        on_part=publish_part if part_mb else None
+    )
+    error_log = ErrorCsvLog(ctx.open_output(ERRORS_FILE_NAME))
+    cache = get_default_cache()
+    try:
+        result = asyncio.run(download_switzerland_async(
+            iter_job_skus(ctx), total, sink, error_log, ctx, cache=cache, placeholders=get_default_placeholder_index()
+        ))
+    finally:
+        parts = sink.close()
+        failed = error_log.close()
+    ctx.progress(1.0, text="Switzerland processing complete!")
+    ctx.success(result.summary())
+    if cache is not None:
+        ctx.info(cache.summary())
+
+    # --- ZIP ---
+    if not parts:
+        ctx.info("No images processed.")
+    elif not part_mb:
+        ctx.add_artifact("zip", parts[0], "Download Images", ZIP_FILE_NAME, "application/zip")
+
+    # --- ERROR CSV ---
+    err_path = ctx.output_path(ERRORS_FILE_NAME)
+    if failed:
+        ctx.add_artifact("errors", err_path, "Download Missing Image List", ERRORS_FILE_NAME, "text/csv")
+    else:
+        os.remove(err_path)
+        ctx.info("No errors found.")
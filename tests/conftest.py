@@ -0,0 +1,6 @@
+# The app modules import each other flat, as when Streamlit runs from pdm_utility_hub/.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pdm_utility_hub"))
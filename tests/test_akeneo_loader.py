@@ -0,0 +1,83 @@
+# Columnar XLSX / CSV reads of Akeneo exports
+
+import io
+
+import openpyxl
+import pytest
+from openpyxl.cell.rich_text import CellRichText, TextBlock
+from openpyxl.cell.text import InlineFont
+
+from akeneo_loader import iter_column, read_akeneo_columns
+
+
+def _xlsx(rows):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def test_xlsx_reads_only_the_requested_columns():
+    data = _xlsx([
+        ["name", " SKU ", "other", "pzns_in_set"],
+        ["a", "B001", "x", "123,456"],
+        ["b", 10000001, "y", 12345678],
+        ["c", 2000000.0, "z", None],
+        [None, None, "only other", None],
+        ["d", 1.5, None, "7"],
+    ])
+
+    df = read_akeneo_columns(data, "export.xlsx", ["sku", "pzns_in_set"])
+
+    assert list(df.columns) == ["sku", "pzns_in_set"]
+    assert df.values.tolist() == [
+        ["B001", "123,456"], ["10000001", "12345678"], ["2000000", None], ["1.5", "7"]
+    ]
+
+
+def test_xlsx_finds_columns_past_blank_cells():
+    # openpyxl omits empty cells, so the row has fewer <c> than columns
+    header = [f"attr_{i}" for i in range(40)] + ["sku"]
+    rows = [header]
+    for i in range(5):
+        rows.append([None] * 40 + [f"S{i}"])
+    rows.append(["x"] * 20 + [None] * 21)
+
+    df = read_akeneo_columns(_xlsx(rows), "export.xlsx", ["sku"])
+
+    assert df["sku"].tolist() == [f"S{i}" for i in range(5)]
+
+
+def test_xlsx_rich_text_and_missing_columns():
+    rich = CellRichText([TextBlock(InlineFont(b=True), "AB"), "12"])
+    df = read_akeneo_columns(_xlsx([["sku"], [rich]]), "export.xlsx", ["sku", "pzns_in_set"])
+
+    assert list(df.columns) == ["sku"]
+    assert df["sku"].tolist() == ["AB12"]
+
+
+def test_xlsx_without_a_matching_header_is_empty():
+    df = read_akeneo_columns(_xlsx([["foo"], ["bar"]]), "export.xlsx", ["sku"])
+
+    assert df.empty
+
+
+def test_csv_sniffs_the_delimiter():
+    data = "id;SKU;pzns_in_set\n1;A;1,2\n2;B;3\n".encode()
+
+    df = read_akeneo_columns(data, "export.csv", ["sku", "pzns_in_set"])
+
+    assert df.values.tolist() == [["A", "1,2"], ["B", "3"]]
+
+
+@pytest.mark.parametrize("name", ["export.xlsx", "export.csv"])
+def test_iter_column_matches_read(name):
+    rows = [["sku", "x"], ["A", 1], [" B ", 2], [None, 3], ["C", 4]]
+    data = _xlsx(rows) if name.endswith(".xlsx") else "\n".join(
+        ";".join("" if v is None else str(v) for v in row) for row in rows
+    ).encode()
+
+    assert list(iter_column(io.BytesIO(data), name, "sku")) == ["A", "B", "C"]
@@ -0,0 +1,124 @@
+# Farmadati job handler run outside Streamlit (stub ExecuteQuery, stub GetDoc)
+
+import os
+import zipfile
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import farmadati_engine as fe
+from farmadati_queries import TDZ_AIC_FIELD, TDZ_IMAGE_FIELD, TR017_AIC_FIELD, TR017_MANUFACTURER_FIELD
+from test_farmadati_queries import StubService
+
+
+def _type(localname):
+    return type(localname, (SimpleNamespace,), {"qname": SimpleNamespace(localname=localname)})
+
+
+def _client(service):
+    types = [SimpleNamespace(qname=None), _type("Filter"), _type("ArrayOfFilter")]
+    return SimpleNamespace(service=service, wsdl=SimpleNamespace(types=SimpleNamespace(types=types)))
+
+
+def _photo():
+    image = Image.new("RGB", (400, 300), (255, 255, 255))
+    image.paste((30, 90, 160), (100, 50, 300, 250))
+    buffer = BytesIO()
+    image.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+class StubHttp:
+    """requests.Session stand-in answering every GetDoc URL with the same photo."""
+
+    seen = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get(self, url, timeout=None):
+        StubHttp.seen.append(url)
+        return SimpleNamespace(raise_for_status=lambda: None, headers={"Content-Type": "image/jpeg"},
+                               content=_photo(), text="")
+
+
+class Ctx:
+    def __init__(self, folder, skus):
+        self.folder = folder
+        self.job_id = "abcdef123456"
+        self.params = {"skus": skus}
+        self.messages = []
+        self.artifacts = {}
+
+    def info(self, text):
+        self.messages.append(("info", text))
+
+    warning = error = success = info
+
+    def progress(self, fraction, text=None, force=False):
+        pass
+
+    def check_cancelled(self):
+        pass
+
+    def output_path(self, name):
+        return os.path.join(self.folder, name)
+
+    def open_output(self, name):
+        return open(self.output_path(name), "wb")
+
+    def add_artifact(self, name, path, label, file_name, mime):
+        self.artifacts[name] = path
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = StubService({
+        "TDZ": [{TDZ_AIC_FIELD: "0" + aic, TDZ_IMAGE_FIELD: f"{aic}.jpg"} for aic in ("101", "102", "103")],
+        "TR017": [{TR017_AIC_FIELD: aic, TR017_MANUFACTURER_FIELD: "X6681" if aic == "102" else "X1000"}
+                  for aic in ("101", "102", "103")],
+    })
+    built = []
+    monkeypatch.setattr(fe, "create_soap_client", lambda url: built.append(url) or _client(service))
+    monkeypatch.setattr(fe, "get_default_farmadati_index", lambda: None)
+    monkeypatch.setattr(fe, "get_default_placeholder_index", lambda: None)
+    monkeypatch.setattr(fe.requests, "Session", StubHttp)
+    StubHttp.seen = []
+    service.built = built
+    return service
+
+
+def test_job_writes_images_and_errors(service, tmp_path):
+    account = fe.FarmadatiAccount("user", "secret")
+    ctx = Ctx(str(tmp_path), ["IT000101", "102", "103", "999", "IT"])
+
+    fe.make_farmadati_job(account)(ctx)
+
+    with zipfile.ZipFile(ctx.artifacts["zip"]) as zf:
+        assert sorted(zf.namelist()) == ["IT101-h1.jpg", "IT103-h1.jpg"]
+    errors = open(ctx.artifacts["errors"], encoding="utf-8-sig").read()
+    assert "102;Download not allowed" in errors
+    assert "999;AIC not in mapping" in errors
+    assert "IT;Invalid AIC (empty after IT)" in errors
+    assert all("accesskey=secret" in url for url in StubHttp.seen)
+
+
+def test_account_builds_the_client_once_and_clear_forgets_it(service, tmp_path):
+    account = fe.FarmadatiAccount("user", "secret")
+    executor = account.executor()
+    account.memo.put_many(["101"], {"101": ["101.jpg"]})
+
+    assert account.executor() is executor and len(service.built) == 1
+    account.clear()
+    assert account.executor() is not executor and len(service.built) == 2
+    assert len(account.memo) == 0
+
+
+def test_clean_sku():
+    assert fe.clean_sku(" it000123 ") == "IT123"
+    assert fe.clean_sku("000123") == "IT123"
@@ -0,0 +1,248 @@
+# Farmadati queries against a stub ExecuteQuery service (no network, no WSDL)
+
+import threading
+import time
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
+
+import pytest
+
+import farmadati_queries as fq
+from farmadati_queries import (
+    AicMemo, QueryError, SoapExecutor, TdzLookup, Tr017Lookup, TDZ_AIC_FIELD, TDZ_IMAGE_FIELD,
+    TR017_AIC_FIELD, TR017_MANUFACTURER_FIELD
+)
+
+
+def _xml(rows):
+    tables = "".join(
+        "<Table>" + "".join(f"<{k}>{escape(v)}</{k}>" for k, v in row.items()) + "</Table>" for row in rows
+    )
+    return f"<NewDataSet>{tables}</NewDataSet>"
+
+
+class StubService:
+    """
+    ExecuteQuery over an in-memory table (AICs match without leading zeros):
+    filters of one OrGroup are OR-ed (unless ors=False), pages are capped at
+    max_page rows, and `fail` maps a call number to the exception to raise
+    or the CodEsito to answer.
+    """
+
+    def __init__(self, tables, ors=True, max_page=None, fail=None, max_filters=None, delay=0.0):
+        self.tables = tables
+        self.ors = ors
+        self.max_page = max_page
+        self.fail = fail or {}
+        self.max_filters = max_filters
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def ExecuteQuery(self, Username, Password, CodiceSetDati, CampiDaEstrarre, Filtri, PageN, PagingN, **_):
+        with self._lock:
+            self.calls.append((CodiceSetDati, [f.Value for f in Filtri.Filter], PageN))
+            call = len(self.calls)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(self.delay)
+            outcome = self.fail.get(call)
+            if isinstance(outcome, Exception):
+                raise outcome
+            if outcome is not None:
+                return SimpleNamespace(CodEsito=outcome, OutputValue="")
+            values = [f.Value for f in Filtri.Filter]
+            if self.max_filters and len(values) > self.max_filters:
+                return SimpleNamespace(CodEsito="ERR_TOO_MANY_FILTERS", OutputValue="")
+            key = Filtri.Filter[0].Key
+            rows = [r for r in self.tables[CodiceSetDati] if r[key].lstrip("0") in values]
+            if not self.ors and len(values) > 1:
+                rows = []
+            size = min(PagingN, self.max_page or PagingN)
+            page = [{f: r[f] for f in CampiDaEstrarre} for r in rows[(PageN - 1) * size:PageN * size]]
+            return SimpleNamespace(CodEsito="OK", OutputValue=_xml(page) if page else "EMPTY")
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def _executor(service, **kwargs):
+    client = SimpleNamespace(service=service)
+    return SoapExecutor(client, SimpleNamespace, SimpleNamespace, "user", "secret", **kwargs)
+
+
+def _tdz_rows(aics):
+    # leading zero as served by Farmadati; AICs divisible by 3 have no image
+    return [{TDZ_AIC_FIELD: "0" + aic, TDZ_IMAGE_FIELD: f"{aic}.jpg"} for aic in aics if int(aic) % 3]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(fq, "RETRY_BASE_SECONDS", 0)
+
+
+AICS = [str(i) for i in range(1, 241)]
+
+
+def test_query_retries_transport_errors():
+    service = StubService({"TDZ": _tdz_rows(["1"])}, fail={1: ConnectionError("reset")})
+    executor = _executor(service, attempts=3)
+
+    df = executor.query("TDZ", [TDZ_AIC_FIELD, TDZ_IMAGE_FIELD], [(TDZ_AIC_FIELD, "1", 0)])
+
+    assert list(df[TDZ_IMAGE_FIELD]) == ["1.jpg"]
+    assert executor.retries == 1
+    assert len(service.calls) == 2
+
+
+def test_query_does_not_retry_refused_queries():
+    service = StubService({"TDZ": []}, fail={1: "ERR"})
+    executor = _executor(service, attempts=3)
+
+    with pytest.raises(QueryError) as raised:
+        executor.query("TDZ", [TDZ_AIC_FIELD], [(TDZ_AIC_FIELD, "1", 0)])
+
+    assert not raised.value.retryable
+    assert len(service.calls) == 1
+
+
+def test_query_gives_up_after_attempts():
+    service = StubService({"TDZ": []}, fail={n: TimeoutError() for n in (1, 2, 3)})
+
+    with pytest.raises(QueryError) as raised:
+        _executor(service, attempts=3).query("TDZ", [TDZ_AIC_FIELD], [(TDZ_AIC_FIELD, "1", 0)])
+
+    assert raised.value.retryable
+    assert len(service.calls) == 3
+
+
+def test_map_keeps_input_order_within_the_worker_bound():
+    executor = _executor(StubService({}), workers=3)
+    lock = threading.Lock()
+    running = {"now": 0, "peak": 0}
+
+    def lookup(n):
+        with lock:
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+        time.sleep(0.002 * (12 - n))  # later items finish first
+        with lock:
+            running["now"] -= 1
+        if n == 4:
+            raise QueryError("CodEsito ERR")
+        return n * 10
+
+    results = executor.map(lookup, list(range(12)))
+
+    assert [value for value, _ in results] == [n * 10 if n != 4 else None for n in range(12)]
+    assert [n for n, (_, error) in enumerate(results) if error is not None] == [4]
+    assert running["peak"] <= 3
+
+
+def test_tdz_lookup_batches_and_pages():
+    service = StubService({"TDZ": _tdz_rows(AICS)})
+    mapping, stats = TdzLookup(_executor(service, workers=4), batch_size=50, page_size=20).run(AICS)
+
+    assert mapping == {aic: f"{aic}.jpg" for aic in AICS if int(aic) % 3}
+    assert max(len(values) for _, values, _ in service.calls) == 50
+    assert stats.failed == 0 and not stats.batching_disabled
+
+
+def test_tdz_lookup_reads_past_short_pages():
+    # the server caps PagingN: a short page is not the last one
+    service = StubService({"TDZ": _tdz_rows(AICS)}, max_page=7)
+    mapping, stats = TdzLookup(_executor(service), batch_size=40, page_size=20).run(AICS)
+
+    assert len(mapping) == sum(1 for aic in AICS if int(aic) % 3)
+    assert stats.short_pages > 0
+    assert "caps the page size" in stats.summary()
+
+
+def test_tdz_lookup_stops_on_a_short_page_with_every_aic_found():
+    aics = [aic for aic in AICS if int(aic) % 3][:40]
+    service = StubService({"TDZ": _tdz_rows(aics)})
+    mapping, stats = TdzLookup(_executor(service), batch_size=40, page_size=50).run(aics)
+
+    assert len(mapping) == 40
+    assert len(service.calls) == 1
+
+
+def test_tdz_lookup_caps_pages_per_batch():
+    # 30 rows for one AIC: more than MAX_ROWS_PER_AIC per AIC can explain
+    rows = [{TDZ_AIC_FIELD: "01", TDZ_IMAGE_FIELD: f"{n}.jpg"} for n in range(30)]
+    service = StubService({"TDZ": rows})
+    mapping, stats = TdzLookup(_executor(service), batch_size=2, page_size=5).run(["1", "2"])
+
+    assert mapping == {"1": "0.jpg"}
+    assert len(service.calls) == 3  # ceil(2 AICs * 4 rows / 5) pages + EMPTY
+    assert stats.truncated == 1
+
+
+def test_tdz_lookup_retries_a_failed_later_page():
+    service = StubService({"TDZ": _tdz_rows(AICS)}, fail={2: "ERR"})
+    mapping, stats = TdzLookup(_executor(service, attempts=1), batch_size=60, page_size=20).run(AICS[:60])
+
+    assert len(mapping) == sum(1 for aic in AICS[:60] if int(aic) % 3)
+    assert [page for _, _, page in service.calls[:3]] == [1, 2, 2]
+    assert stats.splits == 0 and stats.page_failures == 0
+
+
+def test_tdz_lookup_keeps_pages_read_before_a_failure():
+    service = StubService({"TDZ": _tdz_rows(AICS)}, fail={2: "ERR", 3: "ERR"})
+    mapping, stats = TdzLookup(_executor(service, attempts=1), batch_size=60, page_size=20).run(AICS[:60])
+
+    assert len(mapping) == sum(1 for aic in AICS[:60] if int(aic) % 3)
+    assert stats.page_failures == 1 and stats.splits == 0 and stats.failed == 0
+    # the AICs of page 1 are not asked again
+    assert len(service.calls[3][1]) == 60 - 20
+
+
+def test_tdz_lookup_falls_back_to_single_aic_queries_when_filters_are_not_ored():
+    service = StubService({"TDZ": _tdz_rows(AICS)}, ors=False)
+    mapping, stats = TdzLookup(_executor(service), batch_size=50).run(AICS)
+
+    assert mapping == {aic: f"{aic}.jpg" for aic in AICS if int(aic) % 3}
+    assert stats.batching_disabled and stats.batch_size == 1
+
+
+def test_tdz_lookup_splits_refused_batches():
+    service = StubService({"TDZ": _tdz_rows(AICS)}, max_filters=12)
+    mapping, stats = TdzLookup(_executor(service), batch_size=50).run(AICS)
+
+    assert len(mapping) == sum(1 for aic in AICS if int(aic) % 3)
+    assert stats.splits > 0 and stats.batch_size < 50 and stats.failed == 0
+
+
+def test_tdz_lookup_uses_the_memo():
+    service = StubService({"TDZ": _tdz_rows(AICS)})
+    memo = AicMemo()
+    TdzLookup(_executor(service), memo=memo).run(AICS[:100])
+    calls = len(service.calls)
+
+    mapping, stats = TdzLookup(_executor(service), memo=memo).run(AICS[:101])
+
+    assert stats.memo_hits == 100 and stats.memo_misses == 1
+    assert mapping["101"] == "101.jpg"
+    assert all(values == ["101"] for _, values, _ in service.calls[calls:])
+
+
+def test_tr017_lookup_returns_blocked_aics():
+    rows = [{TR017_AIC_FIELD: aic, TR017_MANUFACTURER_FIELD: "X6681" if int(aic) % 5 == 0 else "X1000"}
+            for aic in AICS]
+    service = StubService({"TR017": rows})
+    blocked, stats = Tr017Lookup(_executor(service)).run(AICS)
+
+    assert blocked == {aic for aic in AICS if int(aic) % 5 == 0}
+    assert stats.failed == 0
+
+
+def test_tr017_failed_lookup_leaves_the_aic_allowed():
+    rows = [{TR017_AIC_FIELD: "5", TR017_MANUFACTURER_FIELD: "6681"}]
+    service = StubService({"TR017": rows}, fail={1: "ERR"})
+    blocked, stats = Tr017Lookup(_executor(service, attempts=1)).run(["5"])
+
+    assert blocked == set()
+    assert stats.failed_aics == ["5"]
@@ -0,0 +1,145 @@
+# Benchmarks for the PDM Utility Hub engines (kept out of the app modules)
+#
+#   python tools/bench.py composite <image.jpg> [--products 2|3] [--layout automatic|horizontal|vertical]
+#   python tools/bench.py parse <bundles.xlsx|csv> [--rounds 3]
+#   python tools/bench.py load <export.xlsx|csv> [column ...]
+#
+# Each subcommand prints one line per measured variant. Throughput of the
+# whole Bundle&Set pipeline is measured with bundle_cli.py against
+# cdn_standin.py instead.
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from io import BytesIO
+from typing import Dict, Sequence
+
+# the app modules import each other flat, as when Streamlit runs from pdm_utility_hub/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pdm_utility_hub"))
+
+import pandas as pd
+from PIL import Image
+
+from akeneo_loader import EXCEL_SUFFIXES, read_akeneo_columns
+from bundle_engine import read_bundle_table
+from bundle_imaging import (
+    CANVAS_SIZE, COMPOSITE_MERGE, COMPOSITE_TILED, _open_reduced, _resolve_layout, compose_bundle_jpeg, trim
+)
+
+
+def bench_composite(image_bytes: bytes, num_products: int = 3, layout: str = "horizontal", repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Time both compositing modes on one source image. Peak memory is reported
+    as the largest intermediate pixel buffer each mode allocates (Pillow
+    allocates outside the Python heap, so tracemalloc cannot see it).
+    """
+    source = Image.open(BytesIO(image_bytes))
+    source_pixels = source.size[0] * source.size[1]
+    trimmed_width, trimmed_height = trim(source).size
+    chosen_layout = _resolve_layout(layout, trimmed_width, trimmed_height)
+    merged_pixels = trimmed_width * trimmed_height * num_products
+
+    reduced, _ = _open_reduced(image_bytes, num_products, layout)
+    reduced.load()
+    reduced_pixels = reduced.size[0] * reduced.size[1]
+
+    results: Dict[str, Dict[str, float]] = {}
+    for mode in (COMPOSITE_MERGE, COMPOSITE_TILED):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            compose_bundle_jpeg(image_bytes, num_products, layout, mode)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / repeat
+        if mode == COMPOSITE_MERGE:
+            peak_pixels = max(source_pixels, merged_pixels, CANVAS_SIZE * CANVAS_SIZE)
+        else:
+            peak_pixels = max(reduced_pixels, CANVAS_SIZE * CANVAS_SIZE)
+        results[mode] = {"ms_per_bundle": round(elapsed_ms, 1), "peak_buffer_mb": round(peak_pixels * 3 / (1024 * 1024), 1)}
+    results["layout"] = {"chosen": chosen_layout}
+    return results
+
+
+def bench_parse(path: str, rounds: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Parse time and peak traced memory of the upload, comparing the former
+    Fernet encrypt/decrypt round-trip with the direct buffer parse.
+    """
+    from cryptography.fernet import Fernet
+
+    file_bytes = _read(path)
+    file_name = os.path.basename(path)
+
+    def legacy():
+        fernet = Fernet(Fernet.generate_key())
+        return read_bundle_table(fernet.decrypt(fernet.encrypt(file_bytes)), file_name)
+
+    def direct():
+        return read_bundle_table(file_bytes, file_name)
+
+    results = {}
+    for name, fn in (("fernet_roundtrip", legacy), ("direct_buffer", direct)):
+        timings, peaks = [], []
+        for _ in range(rounds):
+            tracemalloc.start()
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        results[name] = {"best_s": round(min(timings), 3), "peak_mib": round(max(peaks) / (1024 * 1024), 1)}
+    return results
+
+
+def bench_load(path: str, columns: Sequence[str] = ("sku", "pzns_in_set")) -> Dict[str, float]:
+    """Seconds to load an Akeneo export fully (pd.read_*) versus columnar."""
+    data = _read(path)
+    start = time.perf_counter()
+    if path.lower().endswith(EXCEL_SUFFIXES + (".xls",)):
+        pd.read_excel(BytesIO(data), dtype=str)
+    else:
+        pd.read_csv(BytesIO(data), sep=None, engine="python", dtype=str)
+    full = time.perf_counter() - start
+    start = time.perf_counter()
+    df = read_akeneo_columns(data, path, columns)
+    columnar = time.perf_counter() - start
+    return {"rows": len(df), "full_s": round(full, 3), "columnar_s": round(columnar, 3)}
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks for the PDM Utility Hub engines.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    composite = commands.add_parser("composite", help="merge vs tiled compositing of one product image")
+    composite.add_argument("image", help="source product JPEG")
+    composite.add_argument("--products", type=int, choices=(2, 3), default=3)
+    composite.add_argument("--layout", choices=("automatic", "horizontal", "vertical"), default="automatic")
+    composite.add_argument("--repeat", type=int, default=5)
+
+    parse = commands.add_parser("parse", help="Bundle&Set upload parse: Fernet round-trip vs direct buffer")
+    parse.add_argument("table", help="bundle export (.xlsx or .csv)")
+    parse.add_argument("--rounds", type=int, default=3)
+
+    load = commands.add_parser("load", help="Akeneo export: full pandas read vs columnar loader")
+    load.add_argument("export", help="Akeneo export (.xlsx or .csv)")
+    load.add_argument("columns", nargs="*", default=["sku", "pzns_in_set"])
+
+    args = parser.parse_args(argv)
+    if args.command == "composite":
+        results = bench_composite(_read(args.image), args.products, args.layout, args.repeat)
+    elif args.command == "parse":
+        results = bench_parse(args.table, args.rounds)
+    else:
+        results = {"load": bench_load(args.export, args.columns)}
+    for name, values in results.items():
+        print(name, values)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())